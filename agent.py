@@ -1,61 +1,145 @@
 import os
+import copy
 import json
 import logging
 import re
+import time
+import asyncio
+from collections import OrderedDict, deque
 from dotenv import load_dotenv
 
 load_dotenv()
 
 from typing import List, Dict, Optional
-from cachetools import TTLCache
-import httpx
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 import litellm
 
 import avail_checker
-from api import load_details
+import chatwoot_client
+import conversation_store
+import email_outbox
+import media
+import prompt_builder
+import services
+from services import load_details
 
 # --- Logger Setup ---
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("Agent")
 
 # --- Configure LLM Router (LiteLLM) ---
+# Large model: booking, pricing and tool-heavy turns. Fast model: greetings, thanks and
+# other simple turns (empty = LLM_MODEL for everything).
 LLM_MODEL = os.environ.get("LLM_MODEL", "gpt-4o-mini")
+LLM_FAST_MODEL = os.environ.get("LLM_FAST_MODEL", "")
+# Tried in order when a model times out, is rate limited (429) or overloaded (503)
+LLM_FALLBACK_MODELS = [m.strip() for m in os.environ.get("LLM_FALLBACK_MODELS", "").split(",") if m.strip()]
+LLM_TIMEOUT_SECONDS = float(os.environ.get("LLM_TIMEOUT_SECONDS", 30))
 
 # LiteLLM allows fallback and picks up standard env vars automatically:
 # OPENAI_API_KEY, GROQ_API_KEY, GEMINI_API_KEY, ANTHROPIC_API_KEY, etc.
-logger.info(f"Using LLM Model Router: {LLM_MODEL}")
+logger.info(f"Using LLM Model Router: {LLM_MODEL} (fast: {LLM_FAST_MODEL or LLM_MODEL}, fallbacks: {LLM_FALLBACK_MODELS})")
 
-# --- Caching for memory ---
-chat_memory = TTLCache(maxsize=1000, ttl=7200)
-
-SMTP_SERVER = os.environ.get("SMTP_SERVER", "smtp.gmail.com")
-SMTP_PORT = int(os.environ.get("SMTP_PORT", 587))
-SMTP_USER = os.environ.get("SMTP_USER", "")
-SMTP_PASSWORD = os.environ.get("SMTP_PASSWORD", "")
 ADMIN_EMAIL = os.environ.get("ADMIN_EMAIL", "amazonminimalist11@gmail.com")
-CHATWOOT_API_URL = os.environ.get("CHATWOOT_API_URL", "https://chatwoot.parallext.cloud")
-CHATWOOT_API_TOKEN = os.environ.get("CHATWOOT_API_TOKEN", "")
+CHATWOOT_API_URL = chatwoot_client.CHATWOOT_API_URL
+CHATWOOT_API_TOKEN = chatwoot_client.CHATWOOT_API_TOKEN
+
+# Conversations processed at the same time on the API event loop; the rest wait their turn
+AGENT_MAX_CONCURRENCY = int(os.environ.get("AGENT_MAX_CONCURRENCY", 50))
+_agent_slots = asyncio.Semaphore(AGENT_MAX_CONCURRENCY)
+
+# query_apartment results are reused for identical arguments for this long, unless a block
+# write or calendar change bumps avail_checker.data_version() first (0 disables the cache)
+QUERY_CACHE_TTL_SECONDS = float(os.environ.get("QUERY_CACHE_TTL_SECONDS", 60))
+QUERY_CACHE_MAX_ENTRIES = 512
+
+# Streaming mode: text replies are sent to Chatwoot sentence by sentence while the model
+# is still generating, in messages of at least STREAM_MIN_CHUNK_CHARS characters
+STREAM_REPLIES = os.environ.get("STREAM_REPLIES", "false").lower() in ("1", "true", "yes")
+STREAM_MIN_CHUNK_CHARS = int(os.environ.get("STREAM_MIN_CHUNK_CHARS", 120))
+
+# --- Static Prompt Prefix ---
+# System prompt + tools are identical for every call so providers can cache them;
+# everything that changes per turn (clock, contact context, history) goes after them.
+SYSTEM_PROMPT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "system_prompt.md")
+PROMPT_MINIFY = os.environ.get("PROMPT_MINIFY", "true").lower() in ("1", "true", "yes")
+
+# The current time travels in each user message ([Fecha y hora actual: ...]), not in the prefix
+CLOCK_RULE = (
+    "--- RELOJ DEL SISTEMA ---\n"
+    "Cada mensaje del cliente trae la fecha y hora actual en la línea [Fecha y hora actual: ...]. "
+    "SIEMPRE asume que cualquier mes o día solicitado corresponde a fechas iguales o futuras respecto a ese reloj. "
+    "NUNCA asumas años pasados."
+)
+
+SYSTEM_PROMPT = prompt_builder.load_system_prompt(
+    SYSTEM_PROMPT_FILE, "Eres Sofía de Amazon Minimalist, una persona real.", minify=PROMPT_MINIFY
+) + "\n" + CLOCK_RULE
 
-# Load System Prompt
-try:
-    with open('system_prompt.md', 'r', encoding='utf-8') as f:
-        SYSTEM_PROMPT = f.read()
-except FileNotFoundError:
-    SYSTEM_PROMPT = "Eres Sofía de Amazon Minimalist, una persona real."
+# Header of the per-contact context message stored with the conversation
+LONG_TERM_HEADER = "--- CONTEXTO HISTÓRICO DE ESTE CONTACTO (NO VISIBLE PARA ÉL) ---"
+
+# --- Tool Result Cache ---
+# { (question_type, check_in, check_out, num_guests): (expires_at, data_version, result) } in LRU order
+_query_cache = OrderedDict()
+_query_cache_stats = {"hits": 0, "misses": 0}
+
+def _query_cache_key(question_type, check_in, check_out, num_guests) -> tuple:
+    """
+    Normalized query_apartment arguments. apartment_id is left out on purpose:
+    the tool always answers for every apartment.
+    """
+    try:
+        guests = max(0, int(num_guests or 0))
+    except (TypeError, ValueError):
+        guests = 0
+    return (
+        (question_type or "all").strip().lower(),
+        (check_in or "").strip(),
+        (check_out or "").strip(),
+        guests,
+    )
+
+def _cacheable(result: dict) -> bool:
+    # Failsafe answers (a calendar could not be fetched) must be retried, not reused
+    return not any("Error fetching" in apt_info.get("availability_error", "") for apt_info in result.values())
+
+def query_cache_stats() -> dict:
+    return dict(_query_cache_stats, entries=len(_query_cache), ttl_seconds=QUERY_CACHE_TTL_SECONDS)
 
 # --- Helper Functions (Tools for Groq) ---
-def query_apartment(
+async def query_apartment(
     question_type: str = "all", 
     apartment_id: str = None, 
     check_in: str = None, 
     check_out: str = None, 
     num_guests: int = None
 ) -> dict:
-    """Check apartment availability, prices, details."""
+    """Check apartment availability, prices, details (memoized, see QUERY_CACHE_TTL_SECONDS)."""
     logger.info(f"Tool query_apartment called: type={question_type}, apt={apartment_id}, dates={check_in} to {check_out}")
+    if QUERY_CACHE_TTL_SECONDS <= 0:
+        return await _query_apartment(question_type, check_in, check_out, num_guests)
+
+    key = _query_cache_key(question_type, check_in, check_out, num_guests)
+    version = avail_checker.data_version()
+    cached = _query_cache.get(key)
+    if cached and cached[0] > time.monotonic() and cached[1] == version:
+        _query_cache.move_to_end(key)
+        _query_cache_stats["hits"] += 1
+        # Callers annotate tool results in place: never hand out the cached object itself
+        return copy.deepcopy(cached[2])
+
+    _query_cache_stats["misses"] += 1
+    result = await _query_apartment(question_type, check_in, check_out, num_guests)
+    if _cacheable(result):
+        _query_cache[key] = (time.monotonic() + QUERY_CACHE_TTL_SECONDS, version, copy.deepcopy(result))
+        _query_cache.move_to_end(key)
+        while len(_query_cache) > QUERY_CACHE_MAX_ENTRIES:
+            _query_cache.popitem(last=False)
+    else:
+        _query_cache.pop(key, None)
+    return result
+
+async def _query_apartment(question_type: str, check_in: str, check_out: str, num_guests: int) -> dict:
     details = load_details()
     config = avail_checker.load_config()
     
@@ -98,7 +182,7 @@ def query_apartment(
                         apt_info["availability_status"] = "OCUPADO_Y_BLOQUEADO_NO_VENDER"
                         apt_info["availability_error"] = f"CRITICAL: OVERBOOKING. El apartamento solo admite un máximo de {max_guests_allowed} huéspedes. No puedes venderlo para {num_guests} bajo ninguna circunstancia."
                     else:
-                        res = avail_checker.check_apartment_availability(apt, check_in, check_out, config)
+                        res = await avail_checker.check_apartment_availability_async(apt, check_in, check_out, config)
                         if res.get("error", "").startswith("Invalid date format"):
                             apt_info["availability_status"] = "UNKNOWN"
                             apt_info["availability_error"] = "CRITICAL: Formato de fecha invalido. DEBES usar EXACTAMENTE YYYY-MM-DD. Vuelve a ejecutar la herramienta."
@@ -134,8 +218,69 @@ def query_apartment(
         response_data[apt] = apt_info
     return response_data
 
-def include_photos(apartment_id: str, account_id: int = None, conversation_id: int = None) -> dict:
-    """Send apartment photos to the user."""
+async def find_free_windows(nights: int, num_guests: int = None, start_date: str = None, limit: int = 3) -> dict:
+    """Search the nearest free stays of the given length across both apartments."""
+    logger.info(f"Tool find_free_windows called: nights={nights}, guests={num_guests}, from={start_date}")
+    details = load_details()
+    config = avail_checker.load_config()
+    max_guests = {
+        apt: details.get(apt, {}).get("capacity", {}).get("max_guests", 99) for apt in config
+    }
+    res = await avail_checker.find_free_windows_async(
+        config, nights, start=start_date, limit=limit, num_guests=num_guests, max_guests=max_guests
+    )
+    if res.get("error"):
+        return {"error": res["error"]}
+    # Failsafe: a calendar that could not be read hides that apartment, so "no windows" would be a guess
+    unknown = [config[apt]["name"] for apt in res.get("failsafe", {})]
+    if not res["windows"]:
+        if unknown:
+            return {
+                "windows": [],
+                "availability_status": "UNKNOWN",
+                "mensaje": "CRITICAL: No se pudo consultar el calendario en este momento, la disponibilidad es DESCONOCIDA. NO digas que no hay fechas libres; dile al cliente que en un momento le confirmas.",
+            }
+        search_range = res["search_range"]
+        return {
+            "windows": [],
+            "mensaje": f"No hay fechas libres de esa duración entre el {search_range['start']} y el {search_range['end']}.",
+        }
+    result = {"windows": res["windows"]}
+    if unknown:
+        result["aviso"] = f"Disponibilidad DESCONOCIDA (calendario no disponible) para: {', '.join(unknown)}. No afirmes que esos apartamentos están ocupados."
+    return result
+
+# Keeps references to photo uploads running in the background so they are not garbage collected mid-run
+_photo_tasks = set()
+
+async def _upload_photo(path_url: str, filename: str, body: bytes, content_type: str):
+    data = {"message_type": "outgoing", "private": "false"}
+    files = {"attachments[]": (filename, body, content_type)}
+    resp = await chatwoot_client.request("upload_photo", "POST", path_url, data=data, files=files, timeout=20.0)
+    resp.raise_for_status()
+
+async def _send_photos(apartment_id: str, path_url: str, paths: list):
+    """
+    Encodes the WhatsApp derivatives in parallel (off the event loop), then posts them one by one
+    in list order so the guest sees them in the intended sequence (front of the house first).
+    """
+    encoded = await asyncio.gather(
+        *(asyncio.to_thread(media.whatsapp_derivative, path) for path in paths), return_exceptions=True
+    )
+    sent_count = 0
+    for path, result in zip(paths, encoded):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to prepare photo {path}: {result}")
+            continue
+        try:
+            await _upload_photo(path_url, *result)
+            sent_count += 1
+        except Exception as e:
+            logger.error(f"Failed to send photo {path}: {e}")
+    logger.info(f"Sent {sent_count}/{len(paths)} photos of {apartment_id}")
+
+async def include_photos(apartment_id: str, account_id: int = None, conversation_id: int = None) -> dict:
+    """Send apartment photos to the user (uploaded in the background; returns right away)."""
     logger.info(f"Tool include_photos called: apt={apartment_id}")
     
     if not account_id or not conversation_id or not CHATWOOT_API_TOKEN:
@@ -158,26 +303,17 @@ def include_photos(apartment_id: str, account_id: int = None, conversation_id: i
         ]
     }
     
-    paths = photos_map.get(apartment_id, [])
-    url = f"{CHATWOOT_API_URL}/api/v1/accounts/{account_id}/conversations/{conversation_id}/messages"
-    headers = {"api_access_token": CHATWOOT_API_TOKEN}
-    data = {"message_type": "outgoing", "private": "false"}
-    
-    sent_count = 0
-    for rel_path in paths:
-        path = os.path.join(base_dir, rel_path)
-        if os.path.exists(path):
-            try:
-                with open(path, "rb") as f:
-                    files = {"attachments[]": (os.path.basename(path), f, "image/jpeg")}
-                    httpx.post(url, headers=headers, data=data, files=files, timeout=20.0)
-                    sent_count += 1
-            except Exception as e:
-                logger.error(f"Failed to send photo {path}: {e}")
-                
-    return {"status": f"Sent {sent_count} photos to the user", "apartment_id": apartment_id}
+    paths = [os.path.join(base_dir, rel_path) for rel_path in photos_map.get(apartment_id, [])]
+    paths = [path for path in paths if os.path.exists(path)]
+    path_url = f"/api/v1/accounts/{account_id}/conversations/{conversation_id}/messages"
+
+    task = asyncio.create_task(_send_photos(apartment_id, path_url, paths))
+    _photo_tasks.add(task)
+    task.add_done_callback(_photo_tasks.discard)
 
-def confirm_booking(
+    return {"status": f"Queued {len(paths)} photos to the user", "apartment_id": apartment_id}
+
+async def confirm_booking(
     apartment_id: str, check_in: str, check_out: str, num_guests: int,
     guest_name: str, guest_email: str, guest_phone: str, guest_id: str,
     total_price: int, notes: str = ""
@@ -185,37 +321,31 @@ def confirm_booking(
     """Confirms a booking and blocks the dates."""
     logger.info(f"Tool confirm_booking called for {guest_name} at {apartment_id}")
     try:
-        url = "http://localhost:8000/bookings"
-        payload = {
-            "apt": apartment_id, "check_in": check_in, "check_out": check_out,
-            "num_guests": num_guests, "guest_name": guest_name, "guest_email": guest_email,
-            "guest_phone": guest_phone, "guest_id": guest_id, "total_price": total_price,
-            "price_per_night": int(total_price / max(1, num_guests)) if total_price else 0, # Approximation if not passed specifically
-            "notes": notes
-        }
-        headers = {"X-API-Key": os.environ.get("API_KEY", "dev-key-change-me")}
-        with httpx.Client() as client_http:
-            resp = client_http.post(url, json=payload, headers=headers, timeout=10.0)
-            if resp.status_code == 200:
-                return {"success": True, "message": "Booking successful and dates blocked"}
-            return {"success": False, "error": resp.text}
+        booking = services.BookingRequest(
+            apt=apartment_id, check_in=check_in, check_out=check_out,
+            num_guests=num_guests, guest_name=guest_name, guest_email=guest_email,
+            guest_phone=guest_phone, total_price=total_price,
+            price_per_night=int(total_price / max(1, num_guests)) if total_price else 0, # Approximation if not passed specifically
+            notes=notes
+        )
+        # In-process service call (no HTTP round trip to ourselves)
+        await services.create_booking(booking)
+        return {"success": True, "message": "Booking successful and dates blocked"}
+    except services.ServiceError as e:
+        return {"success": False, "error": e.detail}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
-def label_conversation(conversation_id: int, labels: list) -> dict:
+async def label_conversation(conversation_id: int, labels: list) -> dict:
     """Labels the chatwoot conversation."""
     logger.info(f"Tool label_conversation called: {labels}")
     try:
-        url = "http://localhost:8000/conversations/label"
-        headers = {"X-API-Key": os.environ.get("API_KEY", "dev-key-change-me")}
-        with httpx.Client() as client_http:
-            client_http.post(url, json={"conversation_id": conversation_id, "labels": labels}, headers=headers)
-        return {"success": True}
+        return {"success": await services.apply_labels(conversation_id, labels)}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
 # OPENAI-STYLE TOOLS (Agnostic format)
-LLM_TOOLS = [
+RAW_LLM_TOOLS = [
     {
         "type": "function",
         "function": {
@@ -251,6 +381,23 @@ LLM_TOOLS = [
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "find_free_windows",
+            "description": "Busca las fechas libres mas cercanas (en ambos apartamentos) para una estadia de N noches. Usala cuando las fechas pedidas estan OCUPADAS en vez de adivinar otras fechas.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "nights": {"type": "integer", "minimum": 1, "maximum": avail_checker.MAX_SEARCH_NIGHTS, "description": "Cantidad de noches de la estadia"},
+                    "num_guests": {"type": "integer", "description": "Cantidad de personas (0 si no se sabe)"},
+                    "start_date": {"type": "string", "description": "Buscar desde esta fecha YYYY-MM-DD (por defecto hoy)"},
+                    "limit": {"type": "integer", "minimum": 1, "maximum": avail_checker.MAX_SEARCH_RESULTS, "description": "Cuantas opciones devolver (por defecto 3)"}
+                },
+                "required": ["nights"]
+            }
+        }
+    },
     {
         "type": "function",
         "function": {
@@ -306,6 +453,213 @@ LLM_TOOLS = [
     }
 ]
 
+LLM_TOOLS = prompt_builder.compact_tools(RAW_LLM_TOOLS) if PROMPT_MINIFY else RAW_LLM_TOOLS
+
+def _uses_cache_control(model: str) -> bool:
+    """Anthropic models only cache up to explicit cache_control breakpoints; OpenAI & co. cache prefixes automatically."""
+    try:
+        provider = litellm.get_llm_provider(model)[1]
+    except Exception:
+        return False
+    return provider == "anthropic" or (provider in ("bedrock", "vertex_ai") and "claude" in model)
+
+def build_llm_messages(model: str, conversation: list) -> list:
+    """Static system prefix (with a cache breakpoint where the provider needs one) + the stored conversation."""
+    if _uses_cache_control(model):
+        # Breakpoint at the end of the system prompt: tools + system are cached together
+        system = {"role": "system", "content": [
+            {"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}
+        ]}
+    else:
+        system = {"role": "system", "content": SYSTEM_PROMPT}
+    return [system] + conversation
+
+# --- Token Usage ---
+_usage_stats = {"calls": 0, "prompt_tokens": 0, "cached_prompt_tokens": 0, "cache_write_tokens": 0, "completion_tokens": 0}
+
+def _record_usage(conversation_id: int, turn: int, usage) -> None:
+    """Logs the token usage of one completion and adds it to the running totals."""
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    # OpenAI-style cached_tokens, or Anthropic cache reads as normalized by litellm
+    cached = (getattr(details, "cached_tokens", 0) if details else 0) or getattr(usage, "cache_read_input_tokens", 0) or 0
+    cache_write = getattr(usage, "cache_creation_input_tokens", 0) or 0
+
+    _usage_stats["calls"] += 1
+    _usage_stats["prompt_tokens"] += prompt_tokens
+    _usage_stats["cached_prompt_tokens"] += cached
+    _usage_stats["cache_write_tokens"] += cache_write
+    _usage_stats["completion_tokens"] += completion_tokens
+    logger.info(
+        f"LLM usage conv_id={conversation_id} turn={turn}: prompt={prompt_tokens} "
+        f"(cached={cached}, cache_write={cache_write}) completion={completion_tokens}"
+    )
+
+def llm_usage_stats() -> dict:
+    total = _usage_stats["prompt_tokens"]
+    return dict(_usage_stats, cached_ratio=round(_usage_stats["cached_prompt_tokens"] / total, 3) if total else 0.0)
+
+# --- Streaming ---
+# End of a paragraph, or of a sentence (punctuation, optional closing quote/bracket, whitespace)
+_CHUNK_BOUNDARY = re.compile(r"\n\s*\n|[.!?…][\"')\]»]*\s+")
+
+def split_ready_text(buffer: str, min_chars: int) -> int:
+    """
+    Length of the longest prefix of `buffer` that ends on a paragraph or sentence
+    boundary and is at least `min_chars` long (0 if there is none yet).
+    """
+    ready = 0
+    for match in _CHUNK_BOUNDARY.finditer(buffer):
+        if match.end() >= min_chars:
+            ready = match.end()
+    return ready
+
+async def _stream_completion(account_id: int, conversation_id: int, **completion_kwargs):
+    """
+    Streams a completion, sending finished sentences of a text reply to Chatwoot as they arrive.
+    Once the model starts a tool call nothing else is sent (its text stays hidden as before).
+    Returns (full response rebuilt from the chunks, number of characters of content already sent).
+    """
+    stream = await litellm.acompletion(stream=True, stream_options={"include_usage": True}, **completion_kwargs)
+    chunks = []
+    buffer = ""
+    sent_chars = 0
+    calling_tool = False
+    try:
+        async for chunk in stream:
+            chunks.append(chunk)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if getattr(delta, "tool_calls", None):
+                calling_tool = True
+            if calling_tool or not getattr(delta, "content", None):
+                continue
+            buffer += delta.content
+            # The first message waits for a full chunk so short preliminary text before a tool call is not sent
+            ready = split_ready_text(buffer, STREAM_MIN_CHUNK_CHARS)
+            if ready:
+                text, buffer = buffer[:ready], buffer[ready:]
+                sent_chars += len(text)
+                if text.strip():
+                    await send_chatwoot_message(account_id, conversation_id, text.strip())
+                    await send_typing_indicator(account_id, conversation_id, "on")
+    except Exception as e:
+        if sent_chars:
+            # Part of the reply already reached the guest: falling back to another model would repeat it
+            raise RuntimeError(f"LLM stream interrupted after a partial reply: {e}") from e
+        raise
+    return litellm.stream_chunk_builder(chunks, messages=completion_kwargs.get("messages")), sent_chars
+
+# --- Model Routing ---
+# Longest consolidated message that can still be a "simple" turn
+ROUTE_FAST_MAX_CHARS = 80
+# Anything about dates, guests, money, bookings, photos or complaints goes to the large model
+_LARGE_ROUTE_HINTS = re.compile(
+    r"\d|@|reserv|precio|cu[aá]nto|cuesta|valor|tarifa|descuento|disponib|fecha|noche|hu[eé]sped|persona|somos|"
+    r"pago|pagar|tarjeta|transfer|nequi|abono|cancel|foto|check|llega|salida|semana|puente|navidad|"
+    r"enero|febrero|marzo|abril|mayo|junio|julio|agosto|septiembre|octubre|noviembre|diciembre|"
+    r"queja|problema|humano|asesor|correo|email",
+    re.IGNORECASE,
+)
+RETRYABLE_LLM_ERRORS = (litellm.Timeout, litellm.RateLimitError, litellm.ServiceUnavailableError)
+
+def classify_turn(message_content: str, conversation: list) -> str:
+    """Cheap heuristic route of a user turn: "fast" for simple small talk, "large" otherwise."""
+    text = (message_content or "").strip()
+    if not text or len(text) > ROUTE_FAST_MAX_CHARS or _LARGE_ROUTE_HINTS.search(text):
+        return "large"
+    # Conversations in the middle of a quote or booking stay on the large model
+    if any(m.get("role") == "tool" or m.get("tool_calls") for m in conversation[-8:]):
+        return "large"
+    return "fast"
+
+def model_chain(route: str) -> list:
+    """Models to try for a route, in order, without duplicates."""
+    chain = ([LLM_FAST_MODEL] if route == "fast" else []) + [LLM_MODEL] + LLM_FALLBACK_MODELS
+    return list(dict.fromkeys(m for m in chain if m))
+
+# { route: {"calls", "errors", "fallbacks", "total_ms", "max_ms", "cost_usd", "latencies", "models"} }
+_route_metrics = {}
+
+def _record_route(route: str, model: str, started: float, response, ok: bool, fallbacks: int) -> None:
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    m = _route_metrics.setdefault(route, {
+        "calls": 0, "errors": 0, "fallbacks": 0, "total_ms": 0.0, "max_ms": 0.0,
+        "cost_usd": 0.0, "latencies": deque(maxlen=500), "models": {},
+    })
+    m["calls"] += 1
+    m["fallbacks"] += fallbacks
+    m["total_ms"] += elapsed_ms
+    m["max_ms"] = max(m["max_ms"], elapsed_ms)
+    m["latencies"].append(elapsed_ms)
+    m["models"][model] = m["models"].get(model, 0) + 1
+    if not ok:
+        m["errors"] += 1
+    elif response is not None:
+        try:
+            m["cost_usd"] += litellm.completion_cost(completion_response=response) or 0.0
+        except Exception:
+            pass  # Model without pricing info in litellm
+
+def llm_route_stats() -> dict:
+    def percentile(values, q):
+        ordered = sorted(values)
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 1) if ordered else 0.0
+
+    return {
+        route: {
+            "calls": m["calls"],
+            "errors": m["errors"],
+            "fallbacks": m["fallbacks"],
+            "avg_ms": round(m["total_ms"] / m["calls"], 1) if m["calls"] else 0.0,
+            "p50_ms": percentile(m["latencies"], 0.5),
+            "p95_ms": percentile(m["latencies"], 0.95),
+            "max_ms": round(m["max_ms"], 1),
+            "cost_usd": round(m["cost_usd"], 6),
+            "models": dict(m["models"]),
+        }
+        for route, m in _route_metrics.items()
+    }
+
+async def routed_completion(route: str, conversation: list, account_id: int, conversation_id: int):
+    """
+    Runs one completion on the route's model chain, falling back to the next model on
+    timeouts, 429 and 503. Returns (response, characters already streamed to the guest).
+    """
+    chain = model_chain(route)
+    started = time.perf_counter()
+    for attempt, model in enumerate(chain):
+        completion_kwargs = dict(
+            model=model,
+            messages=build_llm_messages(model, conversation),
+            tools=LLM_TOOLS,
+            tool_choice="auto",
+            max_tokens=600,
+            temperature=0.8,
+            timeout=LLM_TIMEOUT_SECONDS,
+        )
+        try:
+            if STREAM_REPLIES:
+                response, sent_chars = await _stream_completion(account_id, conversation_id, **completion_kwargs)
+            else:
+                response, sent_chars = await litellm.acompletion(**completion_kwargs), 0
+        except RETRYABLE_LLM_ERRORS as e:
+            if attempt == len(chain) - 1:
+                _record_route(route, model, started, None, False, attempt)
+                raise
+            logger.warning(f"LLM {model} failed on route {route} ({type(e).__name__}: {e}), falling back to {chain[attempt + 1]}")
+            continue
+        except Exception:
+            _record_route(route, model, started, None, False, attempt)
+            raise
+        _record_route(route, model, started, response, True, attempt)
+        logger.info(f"LLM route {route} answered by {model} in {(time.perf_counter() - started) * 1000:.0f} ms")
+        return response, sent_chars
+
 # --- Router & Error Fallback Logic ---
 def is_valid_name(name: str) -> bool:
     if not name or not name.strip(): return False
@@ -313,68 +667,45 @@ def is_valid_name(name: str) -> bool:
     if not re.match(r'^[a-zA-ZáéíóúÁÉÍÓÚñÑ \-]+$', name.strip()): return False
     return True
 
-def send_chatwoot_message(account_id: int, conversation_id: int, content: str):
+async def send_chatwoot_message(account_id: int, conversation_id: int, content: str):
     """Send message to Chatwoot."""
     logger.info(f"Sending message to Chatwoot conv_id={conversation_id}: {content}")
     if not CHATWOOT_API_TOKEN:
         logger.warning("No CHATWOOT_API_TOKEN set, cannot send message.")
         return
     
-    url = f"{CHATWOOT_API_URL}/api/v1/accounts/{account_id}/conversations/{conversation_id}/messages"
-    headers = {"api_access_token": CHATWOOT_API_TOKEN}
+    path_url = f"/api/v1/accounts/{account_id}/conversations/{conversation_id}/messages"
     payload = {"content": content, "message_type": "outgoing", "private": False}
     try:
-        with httpx.Client() as client_http:
-            client_http.post(url, json=payload, headers=headers, timeout=5.0)
+        resp = await chatwoot_client.request("send_message", "POST", path_url, json=payload, timeout=5.0)
+        resp.raise_for_status()
     except Exception as e:
         logger.error(f"Failed to send Chatwoot message: {e}")
-        # Notify admin of exact silent failure
-        if not SMTP_USER or not SMTP_PASSWORD: return
+        # Notify admin of exact silent failure (queued; delivered by the email outbox worker)
+        body = f"🚨 ¡Hola Equipo!\n\nEl Agente IA generó una respuesta pero Chatwoot no respondió a tiempo o se cayó y el mensaje NO llegó al cliente (La IA se quedó en silencio).\n\nConversación ID: {conversation_id}\n\nMensaje que intentó enviar:\n{content}\n\nError Técnico:\n{e}"
         try:
-            from email.mime.multipart import MIMEMultipart
-            from email.mime.text import MIMEText
-            import smtplib
-            
-            msg = MIMEMultipart()
-            msg['From'] = SMTP_USER
-            msg['To'] = ADMIN_EMAIL
-            msg['Subject'] = "⚠️ ALERTA CRÍTICA: Fallo publicando mensaje en WhatsApp"
-            body = f"🚨 ¡Hola Equipo!\n\nEl Agente IA generó una respuesta pero Chatwoot no respondió a tiempo o se cayó y el mensaje NO llegó al cliente (La IA se quedó en silencio).\n\nConversación ID: {conversation_id}\n\nMensaje que intentó enviar:\n{content}\n\nError Técnico:\n{e}"
-            msg.attach(MIMEText(body, 'plain'))
-            
-            server = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT) if SMTP_PORT == 465 else smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-            if SMTP_PORT != 465: server.starttls()
-            server.login(SMTP_USER, SMTP_PASSWORD)
-            server.send_message(msg)
-            server.quit()
+            email_outbox.enqueue([ADMIN_EMAIL], "⚠️ ALERTA CRÍTICA: Fallo publicando mensaje en WhatsApp", body)
         except Exception as mail_e:
-            logger.error(f"Failed to send critical alert email: {mail_e}")
+            logger.error(f"Failed to queue critical alert email: {mail_e}")
 
-def send_typing_indicator(account_id: int, conversation_id: int, status: str = "on"):
+async def send_typing_indicator(account_id: int, conversation_id: int, status: str = "on"):
     """Toggle typing status in Chatwoot (on/off)."""
     if not CHATWOOT_API_TOKEN: return
     
-    url = f"{CHATWOOT_API_URL}/api/v1/accounts/{account_id}/conversations/{conversation_id}/toggle_typing_status"
-    headers = {"api_access_token": CHATWOOT_API_TOKEN}
+    path_url = f"/api/v1/accounts/{account_id}/conversations/{conversation_id}/toggle_typing_status"
     payload = {"typing_status": status}
     try:
-        with httpx.Client() as client_http:
-            client_http.post(url, json=payload, headers=headers, timeout=2.0)
+        await chatwoot_client.request("typing", "POST", path_url, json=payload, timeout=2.0)
     except Exception as e:
         logger.warning(f"Failed to toggle typing status: {e}")
 
-def trigger_error_contingency(account_id: int, conversation_id: int, sender_name: str, sender_phone: str, last_message: str, error_detail: str = "Error desconocido"):
+async def trigger_error_contingency(account_id: int, conversation_id: int, sender_name: str, sender_phone: str, last_message: str, error_detail: str = "Error desconocido"):
     """Sends email to admin and fallback message to user."""
     logger.error(f"Triggering Error Contingency: {error_detail}")
-    send_chatwoot_message(account_id, conversation_id, "Disculpa, regálame un momento por favor y ya te confirmo el dato.")
-    label_conversation(conversation_id, ["requiere-humano"])
+    await send_chatwoot_message(account_id, conversation_id, "Disculpa, regálame un momento por favor y ya te confirmo el dato.")
+    await label_conversation(conversation_id, ["requiere-humano"])
     
-    if not SMTP_USER or not SMTP_PASSWORD: return
     try:
-        msg = MIMEMultipart()
-        msg['From'] = SMTP_USER
-        msg['To'] = ADMIN_EMAIL
-        msg['Subject'] = "⚠️ ALERTA: Intervención requerida en WhatsApp"
         body = f"""🚨 ¡Hola Equipo!
 
 El agente IA (Sofía) no pudo generar una respuesta debido a un fallo inferencial del Motor LLM. Por favor atiendan este chat de inmediato.
@@ -386,42 +717,116 @@ El agente IA (Sofía) no pudo generar una respuesta debido a un fallo inferencia
 
 🛠️ DETALLE TÉCNICO DEL ERROR:
 {error_detail}"""
-        msg.attach(MIMEText(body, 'plain'))
-        
-        server = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT) if SMTP_PORT == 465 else smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        if SMTP_PORT != 465: server.starttls()
-        server.login(SMTP_USER, SMTP_PASSWORD)
-        server.send_message(msg)
-        server.quit()
-        logger.info("Alert email sent.")
+        if email_outbox.enqueue([ADMIN_EMAIL], "⚠️ ALERTA: Intervención requerida en WhatsApp", body):
+            logger.info("Alert email queued.")
     except Exception as e:
-        logger.error(f"Failed to send alert email: {e}")
+        logger.error(f"Failed to queue alert email: {e}")
 
-def fetch_chatwoot_history(account_id: int, conversation_id: int) -> list:
+async def fetch_chatwoot_history(account_id: int, conversation_id: int) -> list:
     """Fetch last 20 messages from Chatwoot to reconstruct short-term memory."""
     if not CHATWOOT_API_TOKEN:
         return []
-    url = f"{CHATWOOT_API_URL}/api/v1/accounts/{account_id}/conversations/{conversation_id}/messages"
-    headers = {"api_access_token": CHATWOOT_API_TOKEN}
+    path_url = f"/api/v1/accounts/{account_id}/conversations/{conversation_id}/messages"
     try:
-        with httpx.Client() as client_http:
-            resp = client_http.get(url, headers=headers, timeout=5.0)
-            if resp.status_code == 200:
-                data = resp.json()
-                payload = data.get("payload", [])
-                history = []
-                for m in reversed(payload[:15]):
-                    if m.get("message_type") in (0, 1) and m.get("content"):
-                        role = "user" if m["message_type"] == 0 else "assistant"
-                        history.append({"role": role, "content": m["content"]})
-                return history
+        resp = await chatwoot_client.request("history", "GET", path_url, timeout=5.0)
+        if resp.status_code == 200:
+            data = resp.json()
+            payload = data.get("payload", [])
+            history = []
+            for m in reversed(payload[:15]):
+                if m.get("message_type") in (0, 1) and m.get("content"):
+                    role = "user" if m["message_type"] == 0 else "assistant"
+                    history.append({"role": role, "content": m["content"]})
+            return history
     except Exception as e:
         logger.error(f"Failed to fetch history: {e}")
     return []
 
+# --- Tool Dispatch ---
+# Tools without side effects on bookings or labels order; consecutive calls to them
+# run concurrently. Any other tool is awaited on its own, in the order the model asked.
+PARALLEL_SAFE_TOOLS = {"query_apartment", "find_free_windows", "include_photos"}
+
+def _parse_tool_call(tool_call) -> tuple:
+    """(function_name, function_args) of a tool call, with numeric args coerced to int."""
+    function_name = tool_call.function.name
+    try:
+        function_args = json.loads(tool_call.function.arguments)
+    except Exception:
+        function_args = {}
+    
+    # Convert string numbers to int to satisfy Python functions
+    for key in ['num_guests', 'total_price', 'nights', 'limit']:
+        if key in function_args:
+            try:
+                function_args[key] = int(function_args[key])
+            except Exception:
+                pass
+    return function_name, function_args
+
+async def _run_tool(function_name: str, function_args: dict, account_id: int, conversation_id: int) -> dict:
+    """Executes one mapped tool; errors are returned to the model as {"error": ...}."""
+    try:
+        if function_name == "query_apartment":
+            tool_result = await query_apartment(**function_args)
+            await label_conversation(conversation_id, ["cotizando"])
+        elif function_name == "find_free_windows":
+            tool_result = await find_free_windows(**function_args)
+        elif function_name == "include_photos":
+            function_args['account_id'] = account_id
+            function_args['conversation_id'] = conversation_id
+            tool_result = await include_photos(**function_args)
+        elif function_name == "confirm_booking":
+            tool_result = await confirm_booking(**function_args)
+            await label_conversation(conversation_id, ["reservado"])
+        elif function_name == "escalate_to_human":
+            await label_conversation(conversation_id, ["requiere-humano"])
+            tool_result = {"success": True, "message": "Atención humana solicitada."}
+        else:
+            tool_result = {"error": "Unknown function"}
+    except Exception as e:
+        tool_result = {"error": str(e)}
+    return tool_result
+
+async def _run_tool_calls(calls: list, account_id: int, conversation_id: int) -> list:
+    """
+    Runs [(function_name, function_args)] and returns their results in the same order.
+    Runs of parallel-safe tools are gathered; side-effecting tools act as barriers.
+    """
+    results = [None] * len(calls)
+    batch = []
+
+    async def flush_batch():
+        outcomes = await asyncio.gather(
+            *(_run_tool(calls[i][0], calls[i][1], account_id, conversation_id) for i in batch)
+        )
+        for i, outcome in zip(batch, outcomes):
+            results[i] = outcome
+        batch.clear()
+
+    for i, (function_name, function_args) in enumerate(calls):
+        if function_name in PARALLEL_SAFE_TOOLS:
+            batch.append(i)
+            continue
+        if batch:
+            await flush_batch()
+        results[i] = await _run_tool(function_name, function_args, account_id, conversation_id)
+    if batch:
+        await flush_batch()
+    return results
+
 # --- Main Agent Processing ---
-def process_message(account_id: int, conversation_id: int, sender_name: str, sender_phone: str, message_content: str):
-    """Main workflow to process an incoming message natively with LLM Router."""
+async def process_message(account_id: int, conversation_id: int, sender_name: str, sender_phone: str, message_content: str):
+    """
+    Main workflow to process an incoming message natively with LLM Router.
+    Runs on the API event loop; at most AGENT_MAX_CONCURRENCY conversations are processed at once,
+    and the turns of one conversation never interleave.
+    """
+    async with conversation_store.lock(conversation_id):
+        async with _agent_slots:
+            await _process_message(account_id, conversation_id, sender_name, sender_phone, message_content)
+
+async def _process_message(account_id: int, conversation_id: int, sender_name: str, sender_phone: str, message_content: str):
     logger.info(f"Processing message from {sender_name} - {sender_phone}: {message_content}")
     # 2. IA Processing (Multi-Model)
     
@@ -430,44 +835,38 @@ def process_message(account_id: int, conversation_id: int, sender_name: str, sen
     # are automatically picked up by LiteLLM. If missing, it will raise an Exception
     # that is safely caught at the bottom, triggering the Error Contingency flow.
     
-    # Initialize memory if new
-    if conversation_id not in chat_memory:
+    # Initialize memory if new (or expired). The stored conversation excludes the
+    # static system prefix, which build_llm_messages() adds to every request.
+    messages = await conversation_store.get(conversation_id)
+    if messages is not None:
+        # Conversations saved before the prefix was split out still carry the prompt and clock
+        messages = [m for m in messages if m["role"] != "system" or m["content"].startswith(LONG_TERM_HEADER)]
+    if messages is None:
         # Fetch REST Short history
-        history = fetch_chatwoot_history(account_id, conversation_id)
+        history = await fetch_chatwoot_history(account_id, conversation_id)
         
-        # Fetch Long-Term context from Postgres (via internal API)
+        # Fetch Long-Term context from Postgres (contact service, in-process)
         long_term_prompt = ""
         try:
-            url_context = f"http://localhost:8000/bookings/contact/{sender_phone}"
-            headers_ctx = {"X-API-Key": os.environ.get("API_KEY", "dev-key-change-me")}
-            with httpx.Client() as client_http:
-                resp_ctx = client_http.get(url_context, headers=headers_ctx, timeout=5.0)
-                if resp_ctx.status_code == 200:
-                    data_ctx = resp_ctx.json()
-                    contact_name = data_ctx.get("name", "")
-                    last_summary = data_ctx.get("last_summary", "")
-                    past_bookings = data_ctx.get("past_bookings", [])
-                    
-                    if contact_name or last_summary or past_bookings:
-                        long_term_prompt = "--- CONTEXTO HISTÓRICO DE ESTE CONTACTO (NO VISIBLE PARA ÉL) ---\n"
-                        if contact_name:
-                            long_term_prompt += f"Nombre recordado: {contact_name}\n"
-                        if last_summary:
-                            long_term_prompt += f"Resumen última vez que hablaron: {last_summary}\n"
-                        if past_bookings:
-                            long_term_prompt += f"Cantidad de reservas previas exitosas: {len(past_bookings)}\n"
-                        long_term_prompt += "------------------------------------------------------------\n"
+            if sender_phone:
+                data_ctx = await services.get_contact_history(sender_phone)
+                contact_name = data_ctx.get("name", "")
+                last_summary = data_ctx.get("last_summary", "")
+                past_bookings = data_ctx.get("past_bookings", [])
+                
+                if contact_name or last_summary or past_bookings:
+                    long_term_prompt = LONG_TERM_HEADER + "\n"
+                    if contact_name:
+                        long_term_prompt += f"Nombre recordado: {contact_name}\n"
+                    if last_summary:
+                        long_term_prompt += f"Resumen última vez que hablaron: {last_summary}\n"
+                    if past_bookings:
+                        long_term_prompt += f"Cantidad de reservas previas exitosas: {len(past_bookings)}\n"
+                    long_term_prompt += "------------------------------------------------------------\n"
         except Exception as e:
             logger.error(f"Failed to fetch long term context: {e}")
 
-        base_msgs = [{"role": "system", "content": SYSTEM_PROMPT}]
-        
-        # --- INJECT CURRENT DATE & TIME ---
-        from datetime import datetime
-        now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        time_prompt = f"--- RELOJ DEL SISTEMA ---\nLa fecha y hora actual es: {now_str}. SIEMPRE asume que cualquier mes o día solicitado ({now_str[:4]}) corresponde a fechas iguales o futuras respecto al reloj actual. NUNCA asumas años pasados.\n-------------------------\n"
-        base_msgs.append({"role": "system", "content": time_prompt})
-        
+        base_msgs = []
         if long_term_prompt:
             base_msgs.append({"role": "system", "content": long_term_prompt})
             
@@ -475,11 +874,12 @@ def process_message(account_id: int, conversation_id: int, sender_name: str, sen
             history = history[:-1] # Pop the last message to avoid duplication with our prompt below
         if history:
             base_msgs.extend(history)
-        chat_memory[conversation_id] = base_msgs
+        messages = base_msgs
 
-    # Reference the conversation
-    messages = chat_memory[conversation_id]
-    user_prompt = f"[Contact Name (if available): {sender_name}]\n[Contact Phone: {sender_phone}]\n[Message]: {message_content}"
+    # --- INJECT CURRENT DATE & TIME (dynamic part, after the cacheable prefix) ---
+    from datetime import datetime
+    now_str = datetime.now().strftime("%Y-%m-%d %H:%M")
+    user_prompt = f"[Fecha y hora actual: {now_str}]\n[Contact Name (if available): {sender_name}]\n[Contact Phone: {sender_phone}]\n[Message]: {message_content}"
     messages.append({"role": "user", "content": user_prompt})
     
     # Truncate memory safely to avoid splitting 'tool' and 'tool_calls' pairs
@@ -496,24 +896,19 @@ def process_message(account_id: int, conversation_id: int, sender_name: str, sen
                 break
                 
         messages = sys_msgs + recent[cut_idx:]
-        chat_memory[conversation_id] = messages
     
     # Activar "escribiendo..."
-    send_typing_indicator(account_id, conversation_id, "on")
+    await send_typing_indicator(account_id, conversation_id, "on")
     
     try:
         max_turns = 3
         turn_count = 0
         
         while turn_count < max_turns:
-            response = litellm.completion(
-                model=LLM_MODEL,
-                messages=messages,
-                tools=LLM_TOOLS,
-                tool_choice="auto",
-                max_tokens=600,
-                temperature=0.8
-            )
+            # Tool results (quotes, bookings) are always presented by the large model
+            route = classify_turn(message_content, messages) if turn_count == 0 else "large"
+            response, sent_chars = await routed_completion(route, messages, account_id, conversation_id)
+            _record_usage(conversation_id, turn_count, getattr(response, "usage", None))
             response_message = response.choices[0].message
             # litellm returns its own Object classes, converting directly
             messages.append(response_message.model_dump(exclude_unset=True))
@@ -523,46 +918,18 @@ def process_message(account_id: int, conversation_id: int, sender_name: str, sen
             if tool_calls:
                 # Si el LLM adjuntó un texto junto a la petición de herramienta (ej. alucinaciones preliminares) lo silenciamos hacia el cliente para evitar confusiones.
                 final_text = getattr(response_message, 'content', '') or ''
-                if final_text.strip():
+                if sent_chars:
+                    logger.warning(f"LLM text streamed to user before a tool call: {final_text[:sent_chars].strip()}")
+                elif final_text.strip():
                     logger.info(f"LLM preliminary text hidden from user: {final_text.strip()}")
 
-                for tool_call in tool_calls:
-                    function_name = tool_call.function.name
-                    try:
-                        function_args = json.loads(tool_call.function.arguments)
-                    except Exception:
-                        function_args = {}
-                    
-                    # Convert string numbers to int to satisfy Python functions
-                    for key in ['num_guests', 'total_price']:
-                        if key in function_args:
-                            try:
-                                function_args[key] = int(function_args[key])
-                            except Exception:
-                                pass
-                    
+                # Independent tools of the turn run concurrently; results keep the order of tool_calls
+                calls = [_parse_tool_call(tool_call) for tool_call in tool_calls]
+                for function_name, function_args in calls:
                     logger.info(f"LLM tool call [{turn_count}]: {function_name} with args {function_args}")
-                    
-                    # Execute mapped function
-                    try:
-                        if function_name == "query_apartment":
-                            tool_result = query_apartment(**function_args)
-                            label_conversation(conversation_id, ["cotizando"])
-                        elif function_name == "include_photos":
-                            function_args['account_id'] = account_id
-                            function_args['conversation_id'] = conversation_id
-                            tool_result = include_photos(**function_args)
-                        elif function_name == "confirm_booking":
-                            tool_result = confirm_booking(**function_args)
-                            label_conversation(conversation_id, ["reservado"])
-                        elif function_name == "escalate_to_human":
-                            label_conversation(conversation_id, ["requiere-humano"])
-                            tool_result = {"success": True, "message": "Atención humana solicitada."}
-                        else:
-                            tool_result = {"error": "Unknown function"}
-                    except Exception as e:
-                        tool_result = {"error": str(e)}
+                results = await _run_tool_calls(calls, account_id, conversation_id)
 
+                for tool_call, (function_name, _), tool_result in zip(tool_calls, calls, results):
                     messages.append({
                         "tool_call_id": tool_call.id,
                         "role": "tool",
@@ -573,25 +940,30 @@ def process_message(account_id: int, conversation_id: int, sender_name: str, sen
                 turn_count += 1
             else:
                 # Normal Response
-                send_typing_indicator(account_id, conversation_id, "off")
+                await send_typing_indicator(account_id, conversation_id, "off")
                 final_text = getattr(response_message, 'content', '') or ''
                 if not final_text.strip():
                     raise Exception("LLM response text empty. (Tool loop ended without text)")
                     
-                send_chatwoot_message(account_id, conversation_id, final_text)
+                # In streaming mode the first sent_chars characters already reached the guest
+                remaining_text = final_text[sent_chars:].strip()
+                if remaining_text:
+                    await send_chatwoot_message(account_id, conversation_id, remaining_text)
                 
                 # Auto-apply "interesado" on pure text responses without major tools in the first turn
                 if turn_count == 0:
-                    label_conversation(conversation_id, ["interesado"])
+                    await label_conversation(conversation_id, ["interesado"])
 
                 break
                 
         if turn_count >= max_turns:
-            send_typing_indicator(account_id, conversation_id, "off")
+            await send_typing_indicator(account_id, conversation_id, "off")
             raise Exception("Maximum tool call loops exceeded.")
             
     except Exception as e:
-        send_typing_indicator(account_id, conversation_id, "off")
+        await send_typing_indicator(account_id, conversation_id, "off")
         logger.error(f"Error during LLM Multi-Model inference: {e}")
         # En caso de Limit Quota o error interno, se detona el Error Contingency
-        trigger_error_contingency(account_id, conversation_id, sender_name, sender_phone, message_content, str(e))
+        await trigger_error_contingency(account_id, conversation_id, sender_name, sender_phone, message_content, str(e))
+    finally:
+        await conversation_store.put(conversation_id, messages)
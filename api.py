@@ -6,31 +6,36 @@ Deploy with: uvicorn api:app --host 0.0.0.0 --port 8000
 import os
 import json
 import mimetypes
+import datetime
 from dotenv import load_dotenv
 
 load_dotenv()
 
 from fastapi import FastAPI, HTTPException, Security, Query, Request
 from fastapi.security import APIKeyHeader
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from pydantic import BaseModel, model_validator
 from typing import Optional, List, Dict, Any
 import asyncio
-import httpx
 import time
-import asyncpg
 
 # Import existing modules
 import avail_checker
 import block_dates
+import calendar_sync
+import chatwoot_client
+import conversation_store
+import email_outbox
+import media
+import services
+from services import BookingRequest, ServiceError, load_details
 
 # --- Configuration ---
 API_KEY = os.environ.get("API_KEY", "dev-key-change-me")
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "data")
-DETAILS_FILE = os.path.join(DATA_DIR, "apartments_details.json")
 MEDIA_DIR = os.path.join(BASE_DIR, "multimedia")
 
 # --- App ---
@@ -48,8 +53,7 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Mount static files for public access (used in emails)
-app.mount("/static", StaticFiles(directory=BASE_DIR), name="static")
+# Mount static files for public access (logo and cover photos used in emails)
 app.mount("/multimedia", StaticFiles(directory=MEDIA_DIR), name="multimedia")
 
 # --- Webhook Proxy Config ---
@@ -58,44 +62,44 @@ DEBOUNCE_WAIT_SECONDS = 4.0
 # Store pending messages by conversation_id: { conversation_id: {"timer": task, "payload": original_payload, "messages": [text1, text2]} }
 pending_webhooks: Dict[int, Any] = {}
 
-# --- Database Config ---
-DB_USER = os.environ.get("DB_USER", "postgres")
-DB_PASSWORD = os.environ.get("DB_PASSWORD", "postgres")
-DB_HOST = os.environ.get("DB_HOST", "localhost")
-DB_PORT = os.environ.get("DB_PORT", "5432")
-DB_NAME = os.environ.get("DB_NAME", "postgres")
-
-# Global pool
-db_pool = None
-
-# --- SMTP Config ---
-SMTP_SERVER = os.environ.get("SMTP_SERVER", "smtp.gmail.com")
-SMTP_PORT = int(os.environ.get("SMTP_PORT", 587))
-SMTP_USER = os.environ.get("SMTP_USER", "")
-SMTP_PASSWORD = os.environ.get("SMTP_PASSWORD", "")
-
-# --- Chatwoot Config ---
-CHATWOOT_API_URL = os.environ.get("CHATWOOT_API_URL", "https://chatwoot.parallext.cloud")
-CHATWOOT_API_TOKEN = os.environ.get("CHATWOOT_API_TOKEN", "")
-CHATWOOT_USER_TOKEN = os.environ.get("CHATWOOT_USER_TOKEN", CHATWOOT_API_TOKEN)
-CHATWOOT_ACCOUNT_ID = os.environ.get("CHATWOOT_ACCOUNT_ID", "1")
+# Keeps references to background startup work so it is not garbage collected mid-run
+_startup_tasks = set()
 
 @app.on_event("startup")
 async def startup():
-    global db_pool
-    try:
-        db_pool = await asyncpg.create_pool(
-            user=DB_USER, password=DB_PASSWORD, database=DB_NAME, host=DB_HOST, port=DB_PORT
+    await services.open_db_pool()
+
+    # Shared pooled HTTP/2 client for OTA feeds, then pre-warm the calendars
+    # so availability never fetches on the request path
+    await avail_checker.open_http_client()
+    await calendar_sync.start(reservations_loader=load_reserved_ranges)
+    email_outbox.start()
+    await conversation_store.start()
+
+    # Photo variants are encoded in a worker thread; /media serves originals until it finishes
+    media_task = asyncio.create_task(asyncio.to_thread(media.build_manifest, load_details()))
+    _startup_tasks.add(media_task)
+    media_task.add_done_callback(_startup_tasks.discard)
+
+async def load_reserved_ranges(apt_id: str):
+    """Upcoming confirmed reservas of an apartment as (check_in, check_out) dates."""
+    if not services.db_pool:
+        return []
+    async with services.db_pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT check_in, check_out FROM reservas WHERE apartamento_id = $1 AND status = 'activa' AND check_out >= CURRENT_DATE",
+            apt_id
         )
-        print("Connected to PostgreSQL database.")
-    except Exception as e:
-        print(f"Warning: Could not connect to database at startup: {e}")
+    return [(r["check_in"], r["check_out"]) for r in rows]
 
 @app.on_event("shutdown")
 async def shutdown():
-    global db_pool
-    if db_pool:
-        await db_pool.close()
+    await calendar_sync.stop()
+    email_outbox.stop()
+    await conversation_store.stop()
+    await chatwoot_client.close()
+    await avail_checker.close_http_client()
+    await services.close_db_pool()
 
 # --- Security ---
 api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
@@ -108,174 +112,34 @@ async def verify_api_key(api_key: str = Security(api_key_header)):
 
 
 # --- Helpers ---
-def load_details():
-    """Load the full apartment details JSON."""
-    try:
-        with open(DETAILS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
-
-
 def get_media_url(request: Request, apt_id: str, filename: str) -> str:
-    """Build a full media URL for a photo/video."""
+    """Build a full media URL for a photo/video (versioned by content hash once the media manifest is built)."""
     base = str(request.base_url).rstrip("/")
-    return f"{base}/media/{apt_id}/{filename}"
-
-def send_confirmation_email(booking, apt_name, apt_address, base_url):
-    """Sends a professional V2 confirmation email to the guest and hosts using SMTP."""
-    if not SMTP_USER or not SMTP_PASSWORD or not booking.guest_email:
-        print("Skipping email: Missing SMTP credentials or guest email.")
-        return False
-
-    import smtplib
-    from email.mime.text import MIMEText
-    from email.mime.multipart import MIMEMultipart
-
-    msg = MIMEMultipart()
-    msg['From'] = SMTP_USER
-    msg['To'] = booking.guest_email
-    msg['Bcc'] = "nirlevin89@gmail.com, sofia.henao96@gmail.com"
-    msg['Subject'] = f"Tu Reserva Está Confirmada 🌿 - {apt_name}"
-
-    # Clean phone number for WhatsApp link
-    clean_phone = "".join(filter(str.isdigit, booking.guest_phone))
-    if clean_phone and not clean_phone.startswith("57") and len(clean_phone) == 10:
-        clean_phone = "57" + clean_phone # Assume Colombia if not provided
-
-    wa_link = f"https://wa.me/{clean_phone}" if clean_phone else "#"
-    host_wa_link = "https://wa.me/573208010737"
-    
-    # Static URLs
-    base_url = "https://availability-api.parallext.cloud"
-    logo_url = f"{base_url}/multimedia/Logo.png"
-    
-    apt_id = booking.apt
-    if apt_id == "amazon_minimalist":
-        cover_image = f"{base_url}/multimedia/Amazon_minimalist/Casa_frente.jpg"
-    else:
-        cover_image = f"{base_url}/multimedia/Family_Amazon_minimalist/Casa_frente.jpg"
-
-    html = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="utf-8">
-        <style>
-            body {{ font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; color: #2c3e50; line-height: 1.6; margin: 0; padding: 0; background-color: #f4f6f8; }}
-            .container {{ max-width: 650px; margin: 30px auto; background: #ffffff; border-radius: 12px; box-shadow: 0 8px 20px rgba(0,0,0,0.06); overflow: hidden; }}
-            .header {{ background-color: #ffffff; padding: 25px; text-align: center; border-bottom: 1px solid #eee; }}
-            .header img {{ max-width: 180px; height: auto; }}
-            .cover-img {{ width: 100%; height: 260px; object-fit: cover; display: block; }}
-            .content {{ padding: 35px; }}
-            .title {{ color: #2E7D32; font-size: 26px; text-align: center; margin-top: 0; margin-bottom: 10px; font-weight: 800; }}
-            .subtitle {{ color: #7f8c8d; text-align: center; font-size: 16px; margin-bottom: 35px; }}
-            
-            .card {{ background-color: #f9fafe; border-left: 5px solid #4CAF50; padding: 20px 25px; border-radius: 6px; margin-bottom: 30px; }}
-            .card h3 {{ margin-top: 0; color: #1abc9c; font-size: 18px; margin-bottom: 15px; border-bottom: 1px solid #e1e8ed; padding-bottom: 10px; }}
-            .info-row {{ margin: 10px 0; display: flex; align-items: flex-start; }}
-            .label {{ font-weight: 700; color: #34495e; min-width: 140px; display: inline-block; }}
-            .value {{ color: #2c3e50; font-weight: 500; }}
-            
-            .total-box {{ background-color: #e8f5e9; border: 1px solid #c8e6c9; border-radius: 8px; padding: 20px; text-align: center; margin-top: 25px; }}
-            .total-title {{ color: #2E7D32; font-size: 16px; font-weight: bold; margin: 0 0 5px 0; text-transform: uppercase; }}
-            .total-price {{ color: #1b5e20; font-size: 32px; font-weight: 900; margin: 0; }}
-            
-            .map-box {{ margin-top: 30px; text-align: center; padding: 20px; border: 1px dashed #bdc3c7; border-radius: 8px; }}
-            .map-box p {{ margin-top: 0; font-weight: bold; color: #34495e; }}
-            .btn-outline {{ display: inline-block; background-color: transparent; border: 2px solid #3498db; color: #3498db; text-decoration: none; padding: 10px 20px; border-radius: 25px; font-weight: bold; margin-top: 10px; transition: all 0.3s; }}
-            
-            .payment-box {{ margin-top: 30px; background-color: #fff9e6; border-left: 5px solid #f1c40f; padding: 20px 25px; border-radius: 6px; }}
-            .payment-box h3 {{ margin-top: 0; color: #d35400; font-size: 18px; border-bottom: 1px solid #fdebd0; padding-bottom: 10px; }}
-            .payment-method {{ margin-bottom: 15px; }}
-            .payment-method strong {{ color: #e67e22; }}
-            
-            .contact-section {{ text-align: center; margin-top: 40px; padding-top: 30px; border-top: 1px solid #eee; }}
-            .btn-whatsapp {{ display: inline-block; background-color: #25D366; color: white; text-decoration: none; padding: 14px 30px; border-radius: 30px; font-size: 16px; font-weight: bold; box-shadow: 0 4px 6px rgba(37,211,102,0.3); }}
-            .footer {{ background-color: #2c3e50; color: #bdc3c7; text-align: center; padding: 20px; font-size: 14px; margin-top: 40px; }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <div class="header">
-                <img src="{logo_url}" alt="Amazon Minimalist Logo">
-            </div>
-            <img src="{cover_image}" alt="Fachada del Apartamento" class="cover-img">
-            
-            <div class="content">
-                <h1 class="title">¡Tu reserva es oficial, {booking.guest_name}! 🎉</h1>
-                <p class="subtitle">Estamos preparando todo para recibirte en Leticia, Amazonas.</p>
-                
-                <div class="card">
-                    <h3>Detalles de la Estadía</h3>
-                    <div class="info-row"><span class="label">📍 Alojamiento:</span> <span class="value">{apt_name}</span></div>
-                    <div class="info-row"><span class="label">📅 Check-in:</span> <span class="value">{booking.check_in} (A partir de las 3:00 PM)</span></div>
-                    <div class="info-row"><span class="label">📅 Check-out:</span> <span class="value">{booking.check_out} (Hasta las 11:00 AM)</span></div>
-                    <div class="info-row"><span class="label">👥 Huéspedes:</span> <span class="value">{booking.num_guests} personas</span></div>
-                    <div class="info-row"><span class="label">📞 Teléfono:</span> <span class="value">{booking.guest_phone}</span></div>
-                    <div class="info-row" style="margin-top:15px; border-top:1px dashed #ccc; padding-top:10px;"><span class="label">📝 Notas:</span> <span class="value" style="color:#e67e22;">{booking.notes if booking.notes else "Ninguna"}</span></div>
-                </div>
-
-                <div class="total-box">
-                    <p class="total-title">Balance Total a Pagar</p>
-                    <p class="total-price">${booking.total_price:,.0f} COP</p>
-                </div>
-                
-                <div class="payment-box">
-                    <h3>💳 Información de Pago</h3>
-                    <p>Puedes realizar el pago mediante efectivo, o transferencia a las siguientes cuentas:</p>
-                    <div class="payment-method">
-                        <strong>Nequi:</strong> 3208010737
-                    </div>
-                    <div class="payment-method">
-                        <strong>Bancolombia (Ahorros):</strong> 174-803785-98<br>
-                        Titular: Nir Levin Bermudez
-                    </div>
-                    <div class="payment-method">
-                        <strong>PayPal (USD):</strong> nirlevin89@gmail.com
-                    </div>
-                </div>
-                
-                <div class="map-box">
-                    <p>🗺️ ¿Cómo llegar al apartamento?</p>
-                    <span style="display:block; margin-bottom:10px; color:#7f8c8d;">Transversal 3a #14-111, Barrio San Jose/Simón Bolivar.</span>
-                    <a href="https://maps.app.goo.gl/B8QJWoVeSHf2kvSNA" class="btn-outline">Ver en Google Maps</a>
-                </div>
-                
-                <div class="contact-section">
-                    <p style="color: #34495e; font-weight: bold; margin-bottom: 20px;">¿Alguna duda sobre tu viaje o cómo conseguir transporte?</p>
-                    <a href="{host_wa_link}" class="btn-whatsapp">📲 Escríbeme a WhatsApp</a>
-                </div>
-            </div>
-            
-            <div class="footer">
-                <p>Guarda este correo electrónico. Contiene los detalles vitales de tu estadía.</p>
-                <p>© Amazon Minimalist Leticia</p>
-            </div>
-        </div>
-    </body>
-    </html>
-    """
-    
-    msg.attach(MIMEText(html, 'html'))
-
-    try:
-        if SMTP_PORT == 465:
-            server = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT)
-        else:
-            server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-            server.starttls()
-            
-        server.login(SMTP_USER, SMTP_PASSWORD)
-        recipients = [booking.guest_email, "nirlevin89@gmail.com", "sofia.henao96@gmail.com"]
-        server.send_message(msg, to_addrs=recipients)
-        server.quit()
-        print(f"Elite confirmation email sent to {booking.guest_email} and hosts")
-        return True
-    except Exception as e:
-        print(f"Failed to send elite email to {booking.guest_email}: {e}")
-        return False
+    v = media.version(apt_id, filename)
+    return f"{base}/media/{apt_id}/{filename}?v={v}" if v else f"{base}/media/{apt_id}/{filename}"
 
+def accepts_gzip(accept_encoding: str) -> bool:
+    """
+    True if an Accept-Encoding header allows gzip: a "gzip" token with q > 0,
+    or "*" with q > 0 when gzip is not listed itself.
+    """
+    qvalues = {}
+    for item in accept_encoding.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding.lower()] = q
+    if "gzip" in qvalues:
+        return qvalues["gzip"] > 0
+    return qvalues.get("*", 0) > 0
 
 # --- Models ---
 class BlockRequest(BaseModel):
@@ -286,7 +150,8 @@ class BlockRequest(BaseModel):
 
 class BlockDeleteRequest(BaseModel):
     apt: str
-    start: str  # YYYY-MM-DD
+    start: Optional[str] = None  # YYYY-MM-DD
+    uid: Optional[str] = None    # alternative to start: remove exactly this block
 
 
 class IcalSourceRequest(BaseModel):
@@ -317,6 +182,8 @@ async def update_ical_config(apt_id: str, request: IcalSourceRequest, api_key: s
         
         with open(config_path, 'w', encoding='utf-8') as f:
             json.dump(config, f, indent=2)
+
+        calendar_sync.request_resync(apt_id)
             
         return {"status": "success", "message": f"Updated sources for {apt_id}", "data": config[apt_id]}
     except FileNotFoundError:
@@ -343,6 +210,24 @@ async def health_check():
     return {"status": "ok", "service": "availability-checker", "version": "2.0.0"}
 
 
+@app.get("/stats")
+async def get_stats(api_key: str = Security(verify_api_key)):
+    """Runtime counters (calendar feed cache, occupancy model, sync loop, email outbox, Chatwoot calls, media, agent conversations, tool cache, LLM token usage and per-route LLM latency/cost)."""
+    import agent
+    return {
+        "feed_cache": avail_checker.feed_cache.stats(),
+        "occupancy": avail_checker.occupancy_stats(),
+        "calendar_sync": calendar_sync.stats(),
+        "email_outbox": email_outbox.stats(),
+        "chatwoot": chatwoot_client.stats(),
+        "media": media.manifest_stats(),
+        "conversations": conversation_store.stats(),
+        "query_cache": agent.query_cache_stats(),
+        "llm_usage": agent.llm_usage_stats(),
+        "llm_routes": agent.llm_route_stats(),
+    }
+
+
 @app.get("/apartments")
 async def list_apartments(api_key: str = Security(verify_api_key)):
     """List all configured apartments and their names."""
@@ -368,7 +253,7 @@ async def check_availability(
     """
     Check apartment availability for a date range.
 
-    Fetches calendars from Airbnb and Booking.com, checks for conflicts
+    Reads the calendars of Airbnb and Booking.com kept warm by the background sync, checks for conflicts
     with existing bookings and manual blocks.
     If num_guests is provided and dates are available, also returns pricing.
     """
@@ -377,7 +262,7 @@ async def check_availability(
     if apt not in config:
         raise HTTPException(status_code=404, detail=f"Apartment '{apt}' not found. Available: {list(config.keys())}")
 
-    result = avail_checker.check_apartment_availability(apt, start, end, config)
+    result = await avail_checker.check_apartment_availability_async(apt, start, end, config)
 
     if "error" in result:
         raise HTTPException(status_code=400, detail=result["error"])
@@ -430,6 +315,79 @@ async def check_availability(
     return result
 
 
+class AvailabilityWindow(BaseModel):
+    apt: str
+    start: str  # YYYY-MM-DD
+    end: str    # YYYY-MM-DD
+
+    @model_validator(mode="after")
+    def check_dates(self):
+        # Invalid windows are rejected (422) instead of being reported as available
+        try:
+            start = datetime.datetime.strptime(self.start, "%Y-%m-%d").date()
+            end = datetime.datetime.strptime(self.end, "%Y-%m-%d").date()
+        except ValueError:
+            raise ValueError("start and end must be dates in YYYY-MM-DD format")
+        if start >= end:
+            raise ValueError("start must be before end")
+        return self
+
+
+class AvailabilityBatchRequest(BaseModel):
+    windows: List[AvailabilityWindow] = []
+    month: Optional[str] = None  # YYYY-MM
+
+
+@app.post("/availability/batch")
+async def check_availability_batch(
+    query: AvailabilityBatchRequest,
+    api_key: str = Security(verify_api_key),
+):
+    """
+    Check many date windows (and/or a whole month) in one call.
+
+    Calendars are loaded once per apartment; returns the result of every
+    window plus per-night free/occupied maps for every apartment.
+    """
+    config = avail_checker.load_config()
+    result = await avail_checker.check_availability_batch_async(
+        config,
+        windows=[(w.apt, w.start, w.end) for w in query.windows],
+        month=query.month,
+    )
+
+    if "error" in result:
+        raise HTTPException(status_code=400, detail=result["error"])
+
+    return result
+
+
+@app.get("/availability/search")
+async def search_free_windows(
+    nights: int = Query(..., ge=1, le=avail_checker.MAX_SEARCH_NIGHTS, description="Length of stay in nights"),
+    num_guests: Optional[int] = Query(None, ge=0, description="Number of guests (skips apartments that cannot host them)"),
+    start: Optional[str] = Query(None, description="Search from this date (YYYY-MM-DD, default today)"),
+    horizon_days: int = Query(90, ge=1, le=avail_checker.MAX_BATCH_NIGHTS, description="How many days ahead to search"),
+    limit: int = Query(5, ge=1, le=avail_checker.MAX_SEARCH_RESULTS, description="Maximum number of windows to return"),
+    api_key: str = Security(verify_api_key),
+):
+    """Find the nearest free stays of the requested length across all apartments."""
+    config = avail_checker.load_config()
+    details = load_details()
+    max_guests = {
+        apt_id: details.get(apt_id, {}).get("capacity", {}).get("max_guests", 99) for apt_id in config
+    }
+    result = await avail_checker.find_free_windows_async(
+        config, nights, start=start, horizon_days=horizon_days, limit=limit,
+        num_guests=num_guests, max_guests=max_guests,
+    )
+
+    if "error" in result:
+        raise HTTPException(status_code=400, detail=result["error"])
+
+    return result
+
+
 # --- Photos Endpoint (lightweight, for n8n direct call) ---
 
 @app.get("/apartments/{apt_id}/photos")
@@ -598,7 +556,7 @@ async def query_apartment(
         if query.question_type in ("availability", "all"):
             if query.check_in and query.check_out:
                 if apt_id in config:
-                    avail_result = avail_checker.check_apartment_availability(
+                    avail_result = await avail_checker.check_apartment_availability_async(
                         apt_id, query.check_in, query.check_out, config
                     )
                     apt_info["availability"] = avail_result
@@ -640,53 +598,72 @@ async def query_apartment(
 # --- Media Endpoint ---
 
 @app.get("/media/{apt_id}/{filename}")
-async def serve_media(apt_id: str, filename: str):
+async def serve_media(
+    apt_id: str,
+    filename: str,
+    request: Request,
+    size: str = Query("full", description="thumb (320 px), medium (960 px) o full"),
+    format: Optional[str] = Query(None, description="jpeg o webp (por defecto el formato original)"),
+    v: Optional[str] = Query(None, description="Hash de contenido; con él la respuesta es cacheable para siempre"),
+):
     """
     Serve apartment photos and videos.
     No authentication required so WhatsApp can fetch the media URLs.
+    Photos come from the precomputed media manifest (strong ETag, 304, Range);
+    versioned URLs (?v=) are served as immutable.
     """
-    # Map apt_id to folder names
-    folder_map = {
-        "amazon_minimalist": "Amazon_minimalist",
-        "family_amazon_minimalist": "Family_Amazon_minimalist",
-    }
-
-    folder = folder_map.get(apt_id)
-    if not folder:
+    filepath = media.media_path(apt_id, filename)
+    if not filepath:
         raise HTTPException(status_code=404, detail=f"Unknown apartment: {apt_id}")
+    if size not in media.SIZES:
+        raise HTTPException(status_code=400, detail=f"Invalid size: {size}")
+    if format is not None and format not in media.FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid format: {format}")
+
+    entry = media.get_variant(apt_id, filename, size, format)
+    if entry is None:
+        # Videos, photos not in the manifest (yet) or no Pillow: stream the original
+        if not os.path.exists(filepath):
+            raise HTTPException(status_code=404, detail=f"File not found: {filename}")
+        content_type, _ = mimetypes.guess_type(filepath)
+        return FileResponse(
+            filepath,
+            media_type=content_type or "application/octet-stream",
+            filename=filename,
+        )
 
-    filepath = os.path.join(MEDIA_DIR, folder, filename)
+    current_version = media.version(apt_id, filename)
+    headers = {
+        "ETag": entry["etag"],
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "public, max-age=31536000, immutable" if v and v == current_version else "public, max-age=86400",
+    }
 
-    if not os.path.exists(filepath):
-        raise HTTPException(status_code=404, detail=f"File not found: {filename}")
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match:
+        candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if "*" in candidates or entry["etag"] in candidates:
+            return Response(status_code=304, headers=headers)
 
-    # Detect content type
-    content_type, _ = mimetypes.guess_type(filepath)
-    if content_type is None:
-        content_type = "application/octet-stream"
+    body = entry["body"]
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range == entry["etag"]):
+        try:
+            byte_range = media.byte_range(range_header, len(body))
+        except ValueError:
+            headers["Content-Range"] = f"bytes */{len(body)}"
+            return Response(status_code=416, headers=headers)
+        if byte_range:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(body)}"
+            return Response(content=body[start:end + 1], status_code=206, media_type=entry["content_type"], headers=headers)
 
-    return FileResponse(
-        filepath,
-        media_type=content_type,
-        filename=filename,
-    )
+    return Response(content=body, media_type=entry["content_type"], headers=headers)
 
 
 # --- Booking Confirmation ---
 
-class BookingRequest(BaseModel):
-    apt: str
-    guest_name: str
-    guest_phone: str = ""
-    guest_email: str = ""
-    check_in: str   # YYYY-MM-DD
-    check_out: str  # YYYY-MM-DD
-    num_guests: int
-    price_per_night: int
-    total_price: int
-    notes: str = ""
-
-
 @app.post("/bookings")
 async def confirm_booking(
     request: Request,
@@ -697,99 +674,10 @@ async def confirm_booking(
     Confirm a booking: blocks the dates and returns booking data for email.
     This endpoint is called by the n8n AI Agent when a guest confirms.
     """
-    config = avail_checker.load_config()
-    details = load_details()
-
-    if booking.apt not in config:
-        raise HTTPException(status_code=404, detail=f"Apartment '{booking.apt}' not found")
-
-    # First verify availability
-    avail_result = avail_checker.check_apartment_availability(
-        booking.apt, booking.check_in, booking.check_out, config
-    )
-    if not avail_result.get("available", False):
-        raise HTTPException(
-            status_code=409,
-            detail="Las fechas solicitadas ya no están disponibles. Conflicto con reservas existentes."
-        )
-
-    # Bloquear las fechas en el calendario
-    block_result = block_dates.add_block(booking.apt, booking.check_in, booking.check_out)
-
-    # Registrar reserva en PostgreSQL
-    global db_pool
-    db_success = False
-    if db_pool:
-        try:
-            async with db_pool.acquire() as conn:
-                # 1. Asegurar que el contacto existe
-                if booking.guest_phone:
-                    await conn.execute(
-                        """
-                        INSERT INTO conversaciones (telefono, nombre_contacto, es_nombre_valido)
-                        VALUES ($1, $2, TRUE)
-                        ON CONFLICT (telefono) DO UPDATE SET nombre_contacto = $2, es_nombre_valido = TRUE
-                        """,
-                        booking.guest_phone, booking.guest_name
-                    )
-
-                    # 2. Insertar reserva
-                    import datetime
-                    d_in = datetime.datetime.strptime(booking.check_in, "%Y-%m-%d").date()
-                    d_out = datetime.datetime.strptime(booking.check_out, "%Y-%m-%d").date()
-
-                    await conn.execute(
-                        """
-                        INSERT INTO reservas (fk_telefono, apartamento_id, nombre_reserva, check_in, check_out, num_huespedes, precio_total)
-                        VALUES ($1, $2, $3, $4, $5, $6, $7)
-                        """,
-                        booking.guest_phone, booking.apt, booking.guest_name, d_in, d_out, booking.num_guests, float(booking.total_price)
-                    )
-                    db_success = True
-        except Exception as e:
-            print(f"Error saving to database: {e}")
-
-    # Build booking confirmation data
-    apt_name = details.get(booking.apt, {}).get("name", booking.apt)
-    apt_address = details.get(booking.apt, {}).get("location", {}).get("address", "")
-    
-    # Send confirmation email
-    email_sent = False
-    if booking.guest_email:
-        base_url_dynamic = str(request.base_url).rstrip("/")
-        email_sent = send_confirmation_email(booking, apt_name, apt_address, base_url_dynamic)
-
-    confirmation = {
-        "status": "confirmed",
-        "booking": {
-            "apartment_name": apt_name,
-            "apartment_id": booking.apt,
-            "address": apt_address,
-            "guest_name": booking.guest_name,
-            "guest_phone": booking.guest_phone,
-            "guest_email": booking.guest_email,
-            "check_in": booking.check_in,
-            "check_out": booking.check_out,
-            "check_in_time": "3:00 PM",
-            "check_out_time": "11:00 AM",
-            "num_guests": booking.num_guests,
-            "price_per_night": booking.price_per_night,
-            "total_price": booking.total_price,
-            "currency": "COP",
-            "notes": booking.notes,
-            "db_saved": db_success,
-            "email_sent": email_sent
-        },
-        "block_created": block_result.get("status") == "success",
-        "emails_to_notify": [
-            "nirlevin89@gmail.com",
-            "sofia.henao96@gmail.com"
-        ],
-        "payment_methods": details.get(booking.apt, {}).get("payment_methods", {}),
-        "message": f"Reserva confirmada para {apt_name}. Fechas bloqueadas exitosamente. Correo enviado: {'Sí' if email_sent else 'No'}"
-    }
-
-    return confirmation
+    try:
+        return await services.create_booking(booking, str(request.base_url).rstrip("/"))
+    except ServiceError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
 
 
 @app.get("/bookings/contact/{phone}")
@@ -801,62 +689,10 @@ async def get_booking_history(
     Get booking history and last conversation summary for a specific phone number.
     Used by the AI Agent to remember previous interactions and validate context.
     """
-    global db_pool
-    if not db_pool:
-        # En caso de no tener DB, retornar vacío temporalmente
-        return {"phone": phone, "history": [], "last_summary": ""}
-
-    # Remover el '+' posible para normalizar, aunque asuma formato uniforme
-    clean_phone = phone.replace(" ", "").strip()
-
-    history = []
-    summary = ""
-    es_nombre_valido = False
-    nombre_contacto = ""
-
     try:
-        async with db_pool.acquire() as conn:
-            # Info del contacto
-            row_contact = await conn.fetchrow(
-                "SELECT nombre_contacto, ultimo_resumen, es_nombre_valido FROM conversaciones WHERE telefono = $1", 
-                clean_phone
-            )
-            if row_contact:
-                nombre_contacto = row_contact["nombre_contacto"]
-                summary = row_contact["ultimo_resumen"] or ""
-                es_nombre_valido = row_contact["es_nombre_valido"]
-
-            # Reservas previas
-            rows_reservas = await conn.fetch(
-                """
-                SELECT apartamento_id, check_in, check_out, num_huespedes, precio_total, creado_en 
-                FROM reservas 
-                WHERE fk_telefono = $1 
-                ORDER BY check_in DESC
-                """, 
-                clean_phone
-            )
-            for r in rows_reservas:
-                history.append({
-                    "apartment_id": r["apartamento_id"],
-                    "check_in": r["check_in"].isoformat(),
-                    "check_out": r["check_out"].isoformat(),
-                    "num_guests": r["num_huespedes"],
-                    "total_price": float(r["precio_total"]),
-                    "booked_at": r["creado_en"].isoformat() if r["creado_en"] else None
-                })
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Database error: {e}")
-
-    return {
-        "phone": clean_phone,
-        "name": nombre_contacto,
-        "valid_name": es_nombre_valido,
-        "last_summary": summary,
-        "past_bookings": history,
-        "has_history": len(history) > 0
-    }
+        return await services.get_contact_history(phone)
+    except ServiceError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
 
 class SummaryRequest(BaseModel):
     phone: str
@@ -871,14 +707,13 @@ async def save_conversation_summary(
     """
     Guarda el resumen de la última conversación de un usuario en la tabla `conversaciones`.
     """
-    global db_pool
-    if not db_pool:
+    if not services.db_pool:
          return {"error": "Database not configured"}
     
     clean_phone = data.phone.replace(" ", "").strip()
     
     try:
-         async with db_pool.acquire() as conn:
+         async with services.db_pool.acquire() as conn:
              await conn.execute(
                  """
                  INSERT INTO conversaciones (telefono, nombre_contacto, ultimo_resumen, fecha_ultimo_mensaje)
@@ -911,6 +746,7 @@ async def add_block(
     if "error" in result:
         raise HTTPException(status_code=400, detail=result["error"])
 
+    avail_checker.refresh_local_blocks(block.apt, avail_checker.load_config())
     return result
 
 
@@ -920,14 +756,22 @@ async def delete_block(
     api_key: str = Security(verify_api_key),
 ):
     """
-    Remove a manual date block by its start date.
+    Remove a manual date block by its start date (or by its UID).
     Also regenerates the ICS file for the apartment.
     """
-    result = block_dates.remove_block(block.apt, block.start)
+    if block.uid:
+        result = block_dates.remove_block_by_uid(block.apt, block.uid)
+    elif block.start:
+        result = block_dates.remove_block(block.apt, block.start)
+    else:
+        raise HTTPException(status_code=400, detail="Provide start or uid to identify the block")
 
     if "error" in result:
         raise HTTPException(status_code=400, detail=result["error"])
 
+    avail_checker.refresh_local_blocks(block.apt, avail_checker.load_config())
+    # A released booking block frees its reservas row too (cancellation)
+    await services.deactivate_reservations(result.get("uids", []))
     return result
 
 
@@ -949,21 +793,40 @@ async def get_blocks(
 # --- ICS Files ---
 
 @app.get("/public/{filename}")
-async def serve_ics_file(filename: str):
+async def serve_ics_file(filename: str, request: Request):
     """
     Serve generated ICS files (public calendar feeds).
     No authentication required so Airbnb/Booking can fetch them.
+    Feeds are precomputed in memory; answers If-None-Match with 304 and gzip when accepted.
     """
-    filepath = os.path.join(BASE_DIR, "data", "public", filename)
+    feed = block_dates.get_public_feed(filename)
 
-    if not os.path.exists(filepath):
+    if not feed:
         raise HTTPException(status_code=404, detail="File not found")
 
-    return FileResponse(
-        filepath,
-        media_type="text/calendar",
-        filename=filename,
-    )
+    use_gzip = accepts_gzip(request.headers.get("accept-encoding", ""))
+    etag = feed["gzip_etag"] if use_gzip else feed["etag"]
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "public, max-age=300",
+        "Vary": "Accept-Encoding",
+        "Content-Disposition": f'attachment; filename="{filename}"',
+    }
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match:
+        candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        # Either representation of the current feed is still valid for the client
+        matched = next((tag for tag in (etag, feed["etag"], feed["gzip_etag"]) if tag in candidates), None)
+        if "*" in candidates or matched:
+            headers["ETag"] = matched or etag
+            return Response(status_code=304, headers=headers)
+
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=feed["gzip"], media_type="text/calendar", headers=headers)
+
+    return Response(content=feed["body"], media_type="text/calendar", headers=headers)
 
 
 # --- Error Handler ---
@@ -1001,23 +864,14 @@ async def send_to_agent(conversation_id: int):
     
     try:
         import agent
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(
-            None, 
-            agent.process_message, 
-            account_id, 
-            conversation_id, 
-            sender_name, 
-            sender_phone, 
-            consolidated_text
-        )
+        # Runs on the event loop (async LLM + Chatwoot calls); concurrency is capped inside the agent
+        await agent.process_message(account_id, conversation_id, sender_name, sender_phone, consolidated_text)
     except Exception as e:
         print(f"Error sending to Agent: {e}")
 
 async def auto_register_contact(payload: dict):
     """Auto-register contact in PostgreSQL from incoming webhook payload."""
-    global db_pool
-    if not db_pool:
+    if not services.db_pool:
         return
     try:
         sender = payload.get("sender", {}) or payload.get("conversation", {}).get("meta", {}).get("sender", {})
@@ -1025,7 +879,7 @@ async def auto_register_contact(payload: dict):
         name = sender.get("name", "").strip()
         if not phone:
             return
-        async with db_pool.acquire() as conn:
+        async with services.db_pool.acquire() as conn:
             await conn.execute(
                 """
                 INSERT INTO conversaciones (telefono, nombre_contacto, fecha_ultimo_mensaje)
@@ -1041,30 +895,9 @@ async def auto_register_contact(payload: dict):
         print(f"Error auto-registering contact: {e}")
 
 
-async def apply_chatwoot_label(conversation_id: int, labels: list):
-    """Apply labels to a Chatwoot conversation via their API."""
-    if not CHATWOOT_USER_TOKEN:
-        print("Skipping label: No Chatwoot USER API token configured.")
-        return False
-    url = f"{CHATWOOT_API_URL}/api/v1/accounts/{CHATWOOT_ACCOUNT_ID}/conversations/{conversation_id}/labels"
-    headers = {
-        "Content-Type": "application/json",
-        "api_access_token": CHATWOOT_USER_TOKEN
-    }
-    try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            resp = await client.post(url, json={"labels": labels}, headers=headers)
-            print(f"Chatwoot label response ({conversation_id}): {resp.status_code} - {labels}")
-            return resp.status_code == 200
-    except Exception as e:
-        print(f"Error applying Chatwoot label: {e}")
-        return False
-
-
 async def auto_label_new_contact(conversation_id: int, payload: dict):
     """Auto-label conversation as 'nuevo' or 'repetido' based on DB history."""
-    global db_pool
-    if not db_pool or not CHATWOOT_USER_TOKEN:
+    if not services.db_pool or not chatwoot_client.CHATWOOT_USER_TOKEN:
         return
     try:
         # Check if conversation already has labels
@@ -1083,13 +916,13 @@ async def auto_label_new_contact(conversation_id: int, payload: dict):
         phone = sender.get("phone_number", "").replace(" ", "").strip()
         if not phone:
             return
-        async with db_pool.acquire() as conn:
+        async with services.db_pool.acquire() as conn:
             row = await conn.fetchrow(
                 "SELECT COUNT(*) as cnt FROM reservas WHERE fk_telefono = $1", phone
             )
             has_history = row and row["cnt"] > 0
         label = "repetido" if has_history else "nuevo"
-        await apply_chatwoot_label(conversation_id, [label])
+        await services.apply_labels(conversation_id, [label])
     except Exception as e:
         print(f"Error auto-labeling contact: {e}")
 
@@ -1104,7 +937,7 @@ async def label_conversation(
     api_key: str = Security(verify_api_key),
 ):
     """Apply labels to a Chatwoot conversation. Called by n8n after agent processing."""
-    success = await apply_chatwoot_label(data.conversation_id, data.labels)
+    success = await services.apply_labels(data.conversation_id, data.labels)
     if not success:
         raise HTTPException(status_code=502, detail="Failed to apply labels in Chatwoot")
     return {"status": "success", "conversation_id": data.conversation_id, "labels": data.labels}
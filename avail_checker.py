@@ -1,17 +1,45 @@
 import json
+import re
 import argparse
 import sys
 import os
 import datetime
-import requests
+import io
+import struct
+import tempfile
+import asyncio
+from array import array
 import threading
-from icalendar import Calendar
+import time
+import httpx
+from dateutil import tz
 from dateutil.rrule import rrulestr
 
+import block_dates
+from occupancy import OccupancyIndex
+
 # --- Configuration ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, 'data')
 CONFIG_FILE = os.path.join(DATA_DIR, 'apartments.json')
+SNAPSHOT_FILE = os.path.join(DATA_DIR, 'calendar_snapshot.bin')
+
+# Seconds a downloaded feed is served from memory before it is revalidated
+FEED_CACHE_TTL_SECONDS = int(os.environ.get("FEED_CACHE_TTL_SECONDS", 300))
+
+# Synced calendar data older than this is treated like a failed fetch (failsafe)
+MAX_STALENESS_MINUTES = int(os.environ.get("CALENDAR_MAX_STALENESS_MINUTES", 30))
+
+# Events that ended more than this many days ago are dropped while parsing
+ICS_PAST_HORIZON_DAYS = int(os.environ.get("ICS_PAST_HORIZON_DAYS", 1))
+# Recurring events (RRULE) are expanded up to this many days ahead
+ICS_RRULE_EXPANSION_DAYS = int(os.environ.get("ICS_RRULE_EXPANSION_DAYS", 730))
+
+# Per-source circuit breaker: open after N consecutive failures, probe again after the reset time
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", 3))
+CIRCUIT_RESET_SECONDS = int(os.environ.get("CIRCUIT_RESET_SECONDS", 120))
+# A second (hedged) request is sent if a feed has not answered after this many seconds (0 disables)
+HEDGE_DELAY_SECONDS = float(os.environ.get("HEDGE_DELAY_SECONDS", 2.5))
 
 def load_config():
     try:
@@ -21,115 +49,709 @@ def load_config():
         print(json.dumps({"error": f"Config file {CONFIG_FILE} not found", "available": False}))
         sys.exit(1)
 
+# --- HTTP Client ---
+
+# One pooled client (HTTP/2 + keep-alive) shared by every feed download.
+# Owned by the API event loop: opened in api.py's startup hook, or temporarily
+# by run_sync() when the module is used from the CLI.
+_http_client = None
+_http_loop = None
+
+async def open_http_client():
+    global _http_client, _http_loop
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            http2=True,
+            timeout=10.0,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60),
+        )
+        _http_loop = asyncio.get_running_loop()
+    return _http_client
+
+async def close_http_client():
+    global _http_client, _http_loop
+    if _http_client is not None:
+        await _http_client.aclose()
+    _http_client = None
+    _http_loop = None
+
+async def _run_with_client(coro):
+    await open_http_client()
+    try:
+        return await coro
+    finally:
+        await close_http_client()
+
+def run_sync(coro):
+    """
+    Runs an async availability coroutine from synchronous code.
+    From a worker thread while the API is running, it is scheduled on the API
+    loop (reusing the pooled client); otherwise (CLI) it runs in a fresh loop.
+    """
+    loop = _http_loop
+    if loop is not None and loop.is_running():
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            coro.close()
+            raise RuntimeError("run_sync() called from the event loop; await the async variant instead")
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+    return asyncio.run(_run_with_client(coro))
+
 # --- Core Logic ---
 
-def fetch_ics(url):
-    """Downloads ICS content from a URL."""
+hedged_requests = 0
+
+async def _hedged_get(client, url, headers):
+    """
+    GET with a hedged retry: if the first request is still running after
+    HEDGE_DELAY_SECONDS a second one is sent and the first good answer wins.
+    """
+    global hedged_requests
+    first = asyncio.ensure_future(client.get(url, headers=headers))
+    if HEDGE_DELAY_SECONDS <= 0:
+        return await first
+
+    done, _ = await asyncio.wait({first}, timeout=HEDGE_DELAY_SECONDS)
+    if done:
+        return first.result()
+
+    hedged_requests += 1
+    pending = {first, asyncio.ensure_future(client.get(url, headers=headers))}
+    error = None
     try:
-        response = requests.get(url, timeout=10)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def fetch_ics_conditional_async(url, etag=None, last_modified=None):
+    """
+    Downloads ICS content using the cached validators.
+    Returns (status, body, etag, last_modified); status is 304 when the feed
+    did not change and None when the request failed.
+    """
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    try:
+        client = await open_http_client()
+        response = await _hedged_get(client, url, headers)
+        if response.status_code == 304:
+            return 304, None, etag, last_modified
         response.raise_for_status()
-        return response.text
+        return (
+            response.status_code,
+            response.text,
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+        )
     except Exception as e:
         # We log to stderr to avoid polluting the JSON stdout
         sys.stderr.write(f"Error fetching {url}: {e}\n")
+        return None, None, etag, last_modified
+
+def _ics_date(value):
+    """Date part of an ICS DATE or DATE-TIME value (20260410 / 20260410T150000Z)."""
+    value = value.strip()
+    return datetime.date(int(value[0:4]), int(value[4:6]), int(value[6:8]))
+
+def _ics_datetime(value):
+    """Naive datetime of an ICS DATE or DATE-TIME value (midnight for DATE, UTC "Z" dropped)."""
+    value = value.strip().rstrip("Zz")
+    if "T" not in value:
+        return datetime.datetime.combine(_ics_date(value), datetime.time())
+    return datetime.datetime.strptime(value, "%Y%m%dT%H%M%S")
+
+_ICS_DURATION = re.compile(r"^\+?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$")
+
+def _ics_duration(value):
+    """timedelta of an RFC 5545 DURATION value (P2D, PT3H, P1W, P1DT12H). Raises on malformed or negative ones."""
+    value = value.strip().upper()
+    match = _ICS_DURATION.match(value)
+    if not match or value.rstrip("T") in ("P", "+P"):
+        raise ValueError(f"invalid DURATION {value!r}")
+    weeks, days, hours, minutes, seconds = (int(part or 0) for part in match.groups())
+    return datetime.timedelta(weeks=weeks, days=days, hours=hours, minutes=minutes, seconds=seconds)
+
+def scan_vevents(ics_content):
+    """
+    Line-oriented VEVENT scanner. Unfolds continuation lines and yields, per
+    event, only the properties availability needs: DTSTART, DTEND, DURATION,
+    RRULE, UID and STATUS (raw string values), DTSTART's TZID parameter as
+    "TZID", plus EXDATE as a list of every excluded value. No calendar
+    objects are built.
+    """
+    event = None
+    pending = None
+
+    def handle(line):
+        nonlocal event
+        if line == "BEGIN:VEVENT":
+            event = {}
+        elif line == "END:VEVENT":
+            found, event = event, None
+            return found
+        elif event is not None:
+            name, sep, value = line.partition(":")
+            if not sep:
+                return None
+            name, _, params = name.partition(";")
+            name = name.upper()
+            if name in ("DTSTART", "DTEND", "DURATION", "RRULE", "UID", "STATUS"):
+                event[name] = value
+            if name == "DTSTART":
+                for param in params.split(";"):
+                    key, _, param_value = param.partition("=")
+                    if key.upper() == "TZID":
+                        event["TZID"] = param_value.strip('"')
+            elif name == "EXDATE":
+                event.setdefault("EXDATE", []).extend(v for v in value.split(",") if v.strip())
         return None
 
-def parse_ics(ics_content):
-    """Parses ICS content and returns a list of occupied date ranges."""
+    for raw in io.StringIO(ics_content):
+        raw = raw.rstrip("\r\n")
+        if raw[:1] in (" ", "\t"):
+            # Folded line (RFC 5545 3.1): continuation of the previous one
+            if pending is not None:
+                pending += raw[1:]
+            continue
+        if pending is not None:
+            found = handle(pending)
+            if found is not None:
+                yield found
+        pending = raw
+
+    if pending is not None:
+        found = handle(pending)
+        if found is not None:
+            yield found
+
+# UNTIL in UTC ("...Z"), as Airbnb and Booking.com send it; dtstart is naive, see _naive_until()
+_RRULE_UTC_UNTIL = re.compile(r"UNTIL=(\d{8}(?:T\d{6})?)Z", re.IGNORECASE)
+
+def _naive_until(match, tzid):
+    """
+    Rewrites a UTC UNTIL in the naive time of DTSTART: converted to its TZID
+    when it has a known one, kept as UTC otherwise (UTC or floating DTSTART).
+    """
+    until = _ics_datetime(match.group(1))
+    zone = tz.gettz(tzid) if tzid else None
+    if zone is not None:
+        until = until.replace(tzinfo=datetime.timezone.utc).astimezone(zone).replace(tzinfo=None)
+    return "UNTIL=" + until.strftime("%Y%m%dT%H%M%S")
+
+def _event_ranges(event, horizon, expansion_end):
+    """Occupied (start, end) ranges of one scanned VEVENT. Raises on malformed values."""
+    if event.get("STATUS", "").strip().upper() == "CANCELLED" or "DTSTART" not in event:
+        return []
+
+    # Normalized to date objects (ignore time for whole-day bookings).
+    # ICS end date is exclusive: Booking/Airbnb send checkout day as end date.
+    # Without DTEND, DURATION applies; without both, an all-day event lasts one day.
+    start = _ics_datetime(event["DTSTART"])
+    s_date = start.date()
+    if "DTEND" in event:
+        e_date = _ics_date(event["DTEND"])
+    elif "DURATION" in event:
+        e_date = (start + _ics_duration(event["DURATION"])).date()
+    elif "T" not in event["DTSTART"]:
+        e_date = s_date + datetime.timedelta(days=1)
+    else:
+        return []
+
+    rrule = event.get("RRULE")
+    if not rrule:
+        return [(s_date, e_date)] if e_date >= horizon else []
+
+    duration = e_date - s_date
+    excluded = {_ics_date(value) for value in event.get("EXDATE", [])}
+    # Expanded from the real DTSTART time so an UNTIL earlier that day excludes it
+    rule = rrulestr(
+        "RRULE:" + _RRULE_UTC_UNTIL.sub(lambda m: _naive_until(m, event.get("TZID")), rrule.strip()),
+        dtstart=start,
+    )
+    after = datetime.datetime.combine(horizon - duration, datetime.time())
+    before = datetime.datetime.combine(expansion_end, datetime.time())
+    ranges = []
+    for occurrence in rule.between(after, before, inc=True):
+        occurrence = occurrence.date()
+        if occurrence not in excluded and occurrence + duration >= horizon:
+            ranges.append((occurrence, occurrence + duration))
+    return ranges
+
+def parse_ics(ics_content, horizon=None):
+    """
+    Parses ICS content and returns a list of occupied date ranges.
+    Events ending before `horizon` (default: today minus ICS_PAST_HORIZON_DAYS)
+    are dropped before any further work, and RRULEs are expanded up to
+    ICS_RRULE_EXPANSION_DAYS ahead, skipping EXDATE occurrences.
+    Returns None if any event cannot be parsed: a partial calendar would
+    show booked dates as free, so callers treat it as a failed fetch.
+    """
     occupied_ranges = []
     if not ics_content:
         return occupied_ranges
 
+    if horizon is None:
+        horizon = datetime.date.today() - datetime.timedelta(days=ICS_PAST_HORIZON_DAYS)
+    expansion_end = datetime.date.today() + datetime.timedelta(days=ICS_RRULE_EXPANSION_DAYS)
+
+    failed = 0
     try:
-        cal = Calendar.from_ical(ics_content)
-        for component in cal.walk():
-            if component.name == "VEVENT":
-                start = component.get('dtstart')
-                end = component.get('dtend')
-                
-                if start and end:
-                    # Normalized to date objects (ignore time for whole-day bookings)
-                    s_date = start.dt
-                    e_date = end.dt
-                    
-                    if isinstance(s_date, datetime.datetime):
-                        s_date = s_date.date()
-                    if isinstance(e_date, datetime.datetime):
-                        e_date = e_date.date()
-                        
-                    # Calculate duration for single day events if needed, 
-                    # but typically ICS end date is exclusive. 
-                    # Booking/Airbnb usually send checkout day as end date.
-                    
-                    occupied_ranges.append((s_date, e_date))
+        for event in scan_vevents(ics_content):
+            try:
+                occupied_ranges.extend(_event_ranges(event, horizon, expansion_end))
+            except Exception as e:
+                failed += 1
+                sys.stderr.write(f"Error parsing ICS event {event.get('UID', '?').strip()}: {e}\n")
     except Exception as e:
         sys.stderr.write(f"Error parsing ICS: {e}\n")
+        return None
 
+    if failed:
+        return None
     return occupied_ranges
 
-def is_date_range_available(occupied_ranges, check_in, check_out):
+def is_date_range_available(occupied, check_in, check_out):
     """
     Checks if the requested [check_in, check_out) range overlaps with any occupied range.
     Note: check_out is exclusive in logic (you leave that morning), 
     so overlap occurs if (RequestStart < ExistingEnd) and (RequestEnd > ExistingStart).
+    `occupied` is an OccupancyIndex or a plain list of (start, end) tuples;
+    conflicts are reported as merged intervals.
     """
-    conflicts = []
-    for start, end in occupied_ranges:
-        # Standard overlap check:
-        # Request:   |------|
-        # Existing:      |------|
-        if check_in < end and check_out > start:
-            conflicts.append(f"{start} to {end}")
-            
+    index = occupied if isinstance(occupied, OccupancyIndex) else OccupancyIndex(occupied)
+    conflicts = [f"{start} to {end}" for start, end in index.conflicts(check_in, check_out)]
     return len(conflicts) == 0, conflicts
 
-def check_apartment_availability(apt_id, check_in_str, check_out_str, config):
-    if apt_id not in config:
-        return {"error": "Apartment ID not found", "available": False}
+# --- Source Health ---
+
+class CircuitBreaker:
+    """
+    Per-source circuit breaker. After CIRCUIT_FAILURE_THRESHOLD consecutive
+    failures the source is "open" (not requested at all); once
+    CIRCUIT_RESET_SECONDS have passed a single "half_open" probe is allowed
+    and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_seconds=CIRCUIT_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._sources = {}
+        self._lock = threading.Lock()
+        self.short_circuited = 0
+
+    def _state(self, url):
+        return self._sources.setdefault(url, {"state": "closed", "failures": 0, "opened_at": None})
+
+    def allow_request(self, url):
+        with self._lock:
+            health = self._state(url)
+            if health["state"] == "closed":
+                return True
+            # Also re-probe if a previous half-open probe never reported back
+            if time.time() - health["opened_at"] >= self.reset_seconds:
+                health.update(state="half_open", opened_at=time.time())
+                return True
+            # Open, or a half-open probe is already in flight
+            self.short_circuited += 1
+            return False
+
+    def record_success(self, url):
+        with self._lock:
+            health = self._state(url)
+            health.update(state="closed", failures=0, opened_at=None)
+
+    def record_failure(self, url):
+        with self._lock:
+            health = self._state(url)
+            health["failures"] += 1
+            if health["state"] == "half_open" or health["failures"] >= self.failure_threshold:
+                if health["state"] != "open":
+                    sys.stderr.write(f"Circuit opened for {url} after {health['failures']} failures\n")
+                health.update(state="open", opened_at=time.time())
+
+    def stats(self):
+        with self._lock:
+            return {
+                "short_circuited": self.short_circuited,
+                "open": {url: h["failures"] for url, h in self._sources.items() if h["state"] != "closed"},
+            }
+
+
+source_health = CircuitBreaker()
+
+# --- Feed Cache ---
+
+class FeedCache:
+    """
+    Process-wide cache of OTA calendar feeds keyed by source URL.
+    Each entry keeps the raw body, the parsed ranges and the ETag/Last-Modified
+    validators; stale entries are revalidated with a conditional GET.
+    """
+
+    def __init__(self, ttl_seconds=FEED_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        # Bumped whenever the ranges of any feed change (see data_version())
+        self.version = 0
+
+    async def get_ranges_async(self, url, force=False):
+        """
+        Returns the occupied ranges for a feed, or None if it could not be fetched
+        (or its circuit is open). With force=True the TTL is ignored and the
+        feed is always revalidated.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(url)
+            if not force and entry and entry["last_success"] and now - entry["last_success"] < self.ttl_seconds:
+                self.hits += 1
+                return entry["ranges"]
+            self.misses += 1
+
+        if not source_health.allow_request(url):
+            return None
+
+        etag = entry["etag"] if entry else None
+        last_modified = entry["last_modified"] if entry else None
+        status, body, etag, last_modified = await fetch_ics_conditional_async(url, etag, last_modified)
+
+        ranges = None
+        if status is not None and not (status == 304 and entry):
+            # A feed that cannot be parsed completely counts as a failed fetch (failsafe),
+            # never as a successful one with some bookings missing
+            ranges = parse_ics(body)
+            if ranges is None:
+                status = None
+
+        if status is None:
+            source_health.record_failure(url)
+        else:
+            source_health.record_success(url)
+
+        with self._lock:
+            if status is None:
+                if entry:
+                    entry["last_error"] = time.time()
+                return None
+            if status == 304 and entry:
+                entry["last_success"] = time.time()
+                self.revalidated += 1
+                return entry["ranges"]
+            if not entry or entry["ranges"] != ranges:
+                self.version += 1
+            entry = {
+                "body": body,
+                "ranges": ranges,
+                "etag": etag,
+                "last_modified": last_modified,
+                "last_success": time.time(),
+                "last_error": None,
+            }
+            self._entries[url] = entry
+            return entry["ranges"]
+
+    def peek(self, url):
+        """Returns the last-known-good (ranges, last_success) from memory without any network I/O."""
+        with self._lock:
+            entry = self._entries.get(url)
+            if not entry:
+                return None, None
+            return entry["ranges"], entry["last_success"]
+
+    def export_entries(self):
+        """[(url, ranges, etag, last_modified, last_success)] of every successfully fetched feed."""
+        with self._lock:
+            return [
+                (url, e["ranges"], e["etag"], e["last_modified"], e["last_success"])
+                for url, e in self._entries.items() if e["last_success"]
+            ]
+
+    def import_entry(self, url, ranges, etag, last_modified, last_success):
+        """Seeds a feed from a snapshot unless a newer copy is already in memory."""
+        with self._lock:
+            current = self._entries.get(url)
+            if current and current["last_success"] and current["last_success"] >= last_success:
+                return
+            self.version += 1
+            self._entries[url] = {
+                "body": None,
+                "ranges": ranges,
+                "etag": etag,
+                "last_modified": last_modified,
+                "last_success": last_success,
+                "last_error": None,
+            }
+
+    def invalidate(self, url=None):
+        """Drops one feed (or every feed) so the next lookup downloads it again."""
+        with self._lock:
+            self.version += 1
+            if url is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(url, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidated": self.revalidated,
+                "hedged_requests": hedged_requests,
+                "ttl_seconds": self.ttl_seconds,
+                "sources": source_health.stats(),
+            }
+
+
+feed_cache = FeedCache()
+
+# --- On-disk Snapshot ---
+# Layout: magic | uint32 header length | JSON header | per source, uint32
+# little-endian date ordinals (start, end, start, end, ...) in header order.
+
+SNAPSHOT_MAGIC = b"AMCS1\n"
+
+# Apartment sync loops save concurrently from worker threads; one writer at a time
+_snapshot_lock = threading.Lock()
 
+def save_snapshot(path=SNAPSHOT_FILE):
+    """Writes the parsed ranges and validators of every feed atomically to disk."""
+    entries = feed_cache.export_entries()
+    header = {"saved_at": time.time(), "sources": []}
+    blobs = []
+    for url, ranges, etag, last_modified, last_success in entries:
+        ordinals = array("I")
+        for start, end in ranges:
+            ordinals.append(start.toordinal())
+            ordinals.append(end.toordinal())
+        if sys.byteorder != "little":
+            ordinals.byteswap()
+        header["sources"].append({
+            "url": url, "etag": etag, "last_modified": last_modified,
+            "last_success": last_success, "count": len(ranges),
+        })
+        blobs.append(ordinals.tobytes())
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    directory = os.path.dirname(os.path.abspath(path))
+    with _snapshot_lock:
+        os.makedirs(directory, exist_ok=True)
+        # Unique temp file in the same directory, so os.replace stays atomic
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".calendar_snapshot-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(SNAPSHOT_MAGIC)
+                f.write(struct.pack("<I", len(header_bytes)))
+                f.write(header_bytes)
+                for blob in blobs:
+                    f.write(blob)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+    return len(entries)
+
+def load_snapshot(path=SNAPSHOT_FILE):
+    """Seeds the feed cache from the snapshot on disk. Returns the number of sources loaded."""
     try:
-        check_in = datetime.datetime.strptime(check_in_str, "%Y-%m-%d").date()
-        check_out = datetime.datetime.strptime(check_out_str, "%Y-%m-%d").date()
-    except ValueError:
-        return {"error": "Invalid date format. Use YYYY-MM-DD", "available": False}
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return 0
 
-    sources = config[apt_id]['sources']
-    
-    # Fetch all calendars in parallel
-    ics_contents = []
-    threads = []
-    
-    def fetch_worker(url):
-        content = fetch_ics(url)
-        if content:
-            ics_contents.append(content)
+    try:
+        if not data.startswith(SNAPSHOT_MAGIC):
+            raise ValueError("unknown snapshot format")
+        offset = len(SNAPSHOT_MAGIC)
+        (header_len,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+        header = json.loads(data[offset:offset + header_len])
+        offset += header_len
+
+        for source in header["sources"]:
+            size = source["count"] * 2 * 4
+            ordinals = array("I")
+            ordinals.frombytes(data[offset:offset + size])
+            offset += size
+            if sys.byteorder != "little":
+                ordinals.byteswap()
+            ranges = [
+                (datetime.date.fromordinal(ordinals[i]), datetime.date.fromordinal(ordinals[i + 1]))
+                for i in range(0, len(ordinals), 2)
+            ]
+            feed_cache.import_entry(
+                source["url"], ranges, source["etag"], source["last_modified"], source["last_success"]
+            )
+        return len(header["sources"])
+    except Exception as e:
+        sys.stderr.write(f"Ignoring unreadable calendar snapshot {path}: {e}\n")
+        return 0
+
+# --- Occupancy Model (filled by calendar_sync) ---
+
+# When True, availability is answered from the in-memory occupancy model and
+# the request path performs no network I/O. Enabled by calendar_sync.start().
+serve_from_model = False
+
+# { apt_id: {"sources": (url, ...), "index": OccupancyIndex,
+#            "last_success": {url: timestamp}, "built_at": timestamp} }
+occupancy = {}
+
+# Bumped whenever a rebuild changes an apartment's occupied intervals (see data_version())
+occupancy_version = 0
+
+def local_block_ranges(apt_id):
+    """Manual/API blocks of an apartment (block_dates store) as date ranges."""
+    return [
+        (
+            datetime.datetime.strptime(block['start'], "%Y-%m-%d").date(),
+            datetime.datetime.strptime(block['end'], "%Y-%m-%d").date(),
+        )
+        for block in block_dates.list_blocks(apt_id)
+    ]
+
+def rebuild_occupancy(apt_id, sources):
+    """Rebuilds the occupancy model of an apartment from the feed cache and its local blocks."""
+    global occupancy_version
+    all_ranges = local_block_ranges(apt_id)
+    last_success = {}
+    for url in sources:
+        ranges, fetched_at = feed_cache.peek(url)
+        last_success[url] = fetched_at
+        if ranges:
+            all_ranges.extend(ranges)
 
+    index = OccupancyIndex(all_ranges)
+    previous = occupancy.get(apt_id)
+    if not previous or previous["index"].intervals() != index.intervals():
+        occupancy_version += 1
+    occupancy[apt_id] = {
+        "sources": tuple(sources),
+        "index": index,
+        "last_success": last_success,
+        "built_at": time.time(),
+    }
+    return occupancy[apt_id]
+
+def data_version():
+    """
+    Changes whenever availability answers may change in this process: a manual
+    block written or removed, a feed with new ranges, or an occupancy rebuild
+    with different intervals. Callers caching derived results compare it.
+    """
+    return (block_dates.version(), feed_cache.version, occupancy_version)
+
+def refresh_local_blocks(apt_id, config):
+    """Re-indexes an apartment after its manual blocks changed so the next check sees them."""
+    if serve_from_model and apt_id in config:
+        rebuild_occupancy(apt_id, config[apt_id].get('sources', []))
+
+def stale_sources(apt_id, sources, now=None):
+    """Lists the sources whose data is missing or older than MAX_STALENESS_MINUTES."""
+    model = occupancy.get(apt_id)
+    if not model or model["sources"] != tuple(sources):
+        return list(sources)
+    now = now or time.time()
+    max_age = MAX_STALENESS_MINUTES * 60
+    return [
+        url for url in sources
+        if not model["last_success"].get(url) or now - model["last_success"][url] > max_age
+    ]
+
+def stale_source_ages(sources, now=None):
+    """{url: age_seconds} for sources whose data is older than the feed cache TTL."""
+    now = now or time.time()
+    ages = {}
     for url in sources:
-        t = threading.Thread(target=fetch_worker, args=(url,))
-        threads.append(t)
-        t.start()
-        
-    for t in threads:
-        t.join()
-
-    # Verify all calendars were fetched successfully
-    if len(sources) > 0 and len(ics_contents) < len(sources):
+        _, last_success = feed_cache.peek(url)
+        if last_success and now - last_success > FEED_CACHE_TTL_SECONDS:
+            ages[url] = round(now - last_success)
+    return ages
+
+def occupancy_stats():
+    now = time.time()
+    return {
+        apt_id: {
+            "intervals": len(model["index"]),
+            "built_at": model["built_at"],
+            "source_age_seconds": {
+                url: (round(now - ts) if ts else None) for url, ts in model["last_success"].items()
+            },
+        }
+        for apt_id, model in occupancy.items()
+    }
+
+async def load_occupancy_index(apt_id, config):
+    """
+    Returns (OccupancyIndex, None) for an apartment, or (None, reason) when the
+    failsafe applies because a source could not be fetched or is too old.
+    """
+    sources = config[apt_id]['sources']
+
+    if serve_from_model:
+        if stale_sources(apt_id, sources):
+            return None, f"Error fetching one or more calendar sources (data older than {MAX_STALENESS_MINUTES} minutes). Failsafe activated to prevent double booking."
+        model = occupancy.get(apt_id) or await asyncio.to_thread(rebuild_occupancy, apt_id, sources)
+        return model["index"], None
+
+    # Fetch all calendars concurrently (served from the feed cache when fresh),
+    # reading the manual blocks from SQLite in a worker thread meanwhile
+    blocks, *results = await asyncio.gather(
+        asyncio.to_thread(local_block_ranges, apt_id),
+        *[feed_cache.get_ranges_async(url) for url in sources],
+    )
+
+    # A failing source (or one with an open circuit) falls back to its
+    # last-known-good calendar while it is younger than MAX_STALENESS_MINUTES
+    now = time.time()
+    for i, url in enumerate(sources):
+        if results[i] is None:
+            ranges, last_success = feed_cache.peek(url)
+            if last_success and now - last_success <= MAX_STALENESS_MINUTES * 60:
+                results[i] = ranges
+
+    if any(ranges is None for ranges in results):
+        return None, "Error fetching one or more calendar sources. Failsafe activated to prevent double booking."
+
+    all_occupied_ranges = blocks
+    for ranges in results:
+        all_occupied_ranges.extend(ranges)
+    return OccupancyIndex(all_occupied_ranges), None
+
+def _availability_result(apt_id, config, check_in_str, check_out_str, index, failsafe_reason, check_in, check_out):
+    if failsafe_reason:
         return {
             "apartment": config[apt_id]['name'],
             "check_in": check_in_str,
             "check_out": check_out_str,
             "available": False,
-            "reason": "Error fetching one or more calendar sources. Failsafe activated to prevent double booking.",
+            "reason": failsafe_reason,
             "conflicts": []
         }
 
-    # Parse all
-    all_occupied_ranges = []
-    for content in ics_contents:
-        all_occupied_ranges.extend(parse_ics(content))
-
-    # Check availability
-    is_available, conflicts = is_date_range_available(all_occupied_ranges, check_in, check_out)
+    is_available, conflicts = is_date_range_available(index, check_in, check_out)
 
     return {
         "apartment": config[apt_id]['name'],
@@ -140,6 +762,179 @@ def check_apartment_availability(apt_id, check_in_str, check_out_str, config):
         "conflicts": conflicts
     }
 
+async def check_apartment_availability_async(apt_id, check_in_str, check_out_str, config):
+    if apt_id not in config:
+        return {"error": "Apartment ID not found", "available": False}
+
+    try:
+        check_in = datetime.datetime.strptime(check_in_str, "%Y-%m-%d").date()
+        check_out = datetime.datetime.strptime(check_out_str, "%Y-%m-%d").date()
+    except ValueError:
+        return {"error": "Invalid date format. Use YYYY-MM-DD", "available": False}
+
+    index, failsafe_reason = await load_occupancy_index(apt_id, config)
+    result = _availability_result(apt_id, config, check_in_str, check_out_str, index, failsafe_reason, check_in, check_out)
+
+    # Staleness marker: sources answered from a last-known-good calendar
+    stale = stale_source_ages(config[apt_id]['sources'])
+    if stale and not failsafe_reason:
+        result["stale_sources"] = stale
+    return result
+
+def check_apartment_availability(apt_id, check_in_str, check_out_str, config):
+    """Sync wrapper for the CLI and other synchronous callers."""
+    return run_sync(check_apartment_availability_async(apt_id, check_in_str, check_out_str, config))
+
+MAX_BATCH_NIGHTS = 366
+
+# Bounds of find_free_windows_async()
+MAX_SEARCH_NIGHTS = 90
+MAX_SEARCH_RESULTS = 20
+
+async def check_availability_batch_async(config, windows=None, month=None):
+    """
+    Answers many date windows with a single feed load and index build per apartment.
+    `windows` is a list of (apt_id, check_in, check_out) and/or `month` is "YYYY-MM".
+    Returns the result of every window plus per-night free/occupied maps for
+    every apartment covering the month (or the span of all windows).
+    """
+    windows = windows or []
+    if not windows and not month:
+        return {"error": "Provide windows or a month (YYYY-MM)"}
+
+    parsed = []
+    try:
+        for apt_id, check_in_str, check_out_str in windows:
+            check_in = datetime.datetime.strptime(check_in_str, "%Y-%m-%d").date()
+            check_out = datetime.datetime.strptime(check_out_str, "%Y-%m-%d").date()
+            if check_in >= check_out:
+                return {"error": f"Window {check_in_str} to {check_out_str} of {apt_id}: check-in must be before check-out"}
+            parsed.append((apt_id, check_in_str, check_out_str, check_in, check_out))
+    except (TypeError, ValueError):
+        return {"error": "Invalid date format. Use YYYY-MM-DD"}
+
+    if month:
+        try:
+            range_start = datetime.datetime.strptime(month, "%Y-%m").date()
+        except ValueError:
+            return {"error": "Invalid month format. Use YYYY-MM"}
+        next_month = (range_start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+        range_end = next_month
+    else:
+        range_start = min(p[3] for p in parsed)
+        range_end = max(p[4] for p in parsed)
+
+    if (range_end - range_start).days > MAX_BATCH_NIGHTS:
+        return {"error": f"Requested span exceeds {MAX_BATCH_NIGHTS} nights"}
+
+    apt_ids = list(config.keys())
+    loaded = dict(zip(apt_ids, await asyncio.gather(*[load_occupancy_index(apt_id, config) for apt_id in apt_ids])))
+
+    window_results = []
+    for apt_id, check_in_str, check_out_str, check_in, check_out in parsed:
+        if apt_id not in config:
+            window_results.append({"apt": apt_id, "error": "Apartment ID not found", "available": False})
+            continue
+        index, failsafe_reason = loaded[apt_id]
+        result = _availability_result(apt_id, config, check_in_str, check_out_str, index, failsafe_reason, check_in, check_out)
+        result["apt"] = apt_id
+        window_results.append(result)
+
+    nights = {}
+    failsafe = {}
+    for apt_id, (index, failsafe_reason) in loaded.items():
+        apt_nights = {}
+        day = range_start
+        while day < range_end:
+            # Failsafe: if the calendar is unknown every night counts as occupied
+            free = not failsafe_reason and index.is_available(day, day + datetime.timedelta(days=1))
+            apt_nights[day.isoformat()] = "free" if free else "occupied"
+            day += datetime.timedelta(days=1)
+        nights[apt_id] = apt_nights
+        if failsafe_reason:
+            failsafe[apt_id] = failsafe_reason
+
+    response = {
+        "range": {"start": range_start.isoformat(), "end": range_end.isoformat()},
+        "windows": window_results,
+        "nights": nights,
+    }
+    if failsafe:
+        response["failsafe"] = failsafe
+    return response
+
+async def find_free_windows_async(config, nights, start=None, horizon_days=90, limit=5, num_guests=None, max_guests=None):
+    """
+    Finds the `limit` nearest free stays of `nights` nights across all apartments,
+    scanning the gaps of each occupancy index from `start` (default today) up to
+    `horizon_days` ahead. A long gap yields back-to-back windows (one every
+    `nights` days), so `limit` is filled whenever the gaps have room for it.
+    `max_guests` maps apt_id -> capacity; apartments that cannot host
+    `num_guests` are skipped.
+    """
+    if not isinstance(nights, int) or not 1 <= nights <= MAX_SEARCH_NIGHTS:
+        return {"error": f"nights must be between 1 and {MAX_SEARCH_NIGHTS}"}
+    if not isinstance(limit, int) or not 1 <= limit <= MAX_SEARCH_RESULTS:
+        return {"error": f"limit must be between 1 and {MAX_SEARCH_RESULTS}"}
+    if not isinstance(horizon_days, int) or not 1 <= horizon_days <= MAX_BATCH_NIGHTS:
+        return {"error": f"horizon_days must be between 1 and {MAX_BATCH_NIGHTS}"}
+
+    today = datetime.date.today()
+    if start:
+        try:
+            search_start = datetime.datetime.strptime(start, "%Y-%m-%d").date()
+        except ValueError:
+            return {"error": "Invalid date format. Use YYYY-MM-DD"}
+        search_start = max(search_start, today)
+    else:
+        search_start = today
+    search_end = search_start + datetime.timedelta(days=horizon_days)
+
+    apt_ids = [
+        apt_id for apt_id in config
+        if not (num_guests and max_guests and num_guests > max_guests.get(apt_id, num_guests))
+    ]
+    loaded = await asyncio.gather(*[load_occupancy_index(apt_id, config) for apt_id in apt_ids])
+
+    stay = datetime.timedelta(days=nights)
+    candidates = []
+    failsafe = {}
+    for apt_id, (index, failsafe_reason) in zip(apt_ids, loaded):
+        if failsafe_reason:
+            failsafe[apt_id] = failsafe_reason
+            continue
+        # Gaps come in date order, so only an apartment's first `limit` windows can make the cut
+        found = 0
+        for gap_start, gap_end in index.free_gaps(search_start, search_end):
+            check_in = gap_start
+            while check_in + stay <= gap_end and found < limit:
+                candidates.append((check_in, apt_id, gap_end))
+                check_in += stay
+                found += 1
+            if found == limit:
+                break
+
+    candidates.sort()
+    windows = [
+        {
+            "apt": apt_id,
+            "apartment": config[apt_id]['name'],
+            "check_in": check_in.isoformat(),
+            "check_out": (check_in + stay).isoformat(),
+            "free_until": gap_end.isoformat(),
+        }
+        for check_in, apt_id, gap_end in candidates[:limit]
+    ]
+
+    response = {
+        "nights": nights,
+        "search_range": {"start": search_start.isoformat(), "end": search_end.isoformat()},
+        "windows": windows,
+    }
+    if failsafe:
+        response["failsafe"] = failsafe
+    return response
+
 # --- CLI Entrypoint ---
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Check apartment availability from ICS feeds.")
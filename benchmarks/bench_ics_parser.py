@@ -0,0 +1,84 @@
+"""
+Benchmark: line-oriented avail_checker.parse_ics vs the previous
+icalendar Calendar.from_ical path, on synthetic OTA feeds.
+
+Run from the repo root: python benchmarks/bench_ics_parser.py [num_events ...]
+"""
+
+import os
+import sys
+import time
+import datetime
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from icalendar import Calendar
+
+import avail_checker
+
+
+def parse_ics_icalendar(ics_content):
+    """The previous implementation: full Calendar.from_ical + walk()."""
+    occupied_ranges = []
+    cal = Calendar.from_ical(ics_content)
+    for component in cal.walk():
+        if component.name == "VEVENT":
+            start = component.get('dtstart')
+            end = component.get('dtend')
+            if start and end:
+                s_date = start.dt
+                e_date = end.dt
+                if isinstance(s_date, datetime.datetime):
+                    s_date = s_date.date()
+                if isinstance(e_date, datetime.datetime):
+                    e_date = e_date.date()
+                occupied_ranges.append((s_date, e_date))
+    return occupied_ranges
+
+
+def synthetic_feed(num_events):
+    """Airbnb-style export: mostly past 2-4 night stays, the last ~5% in the future."""
+    today = datetime.date.today()
+    first = today - datetime.timedelta(days=int(num_events * 0.95) * 3)
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//Airbnb Inc//Hosting Calendar 1.0//EN", "CALSCALE:GREGORIAN"]
+    for i in range(num_events):
+        start = first + datetime.timedelta(days=i * 3)
+        end = start + datetime.timedelta(days=2 + i % 3)
+        lines += [
+            "BEGIN:VEVENT",
+            f"DTSTAMP:{today:%Y%m%d}T000000Z",
+            f"DTSTART;VALUE=DATE:{start:%Y%m%d}",
+            f"DTEND;VALUE=DATE:{end:%Y%m%d}",
+            f"UID:{i:08d}-synthetic@airbnb.com",
+            "SUMMARY:Reserved",
+            "DESCRIPTION:Reservation URL: https://www.airbnb.com/hosting/reservations/details/HM",
+            " ABCDEFGH\\nPhone Number (Last 4 Digits): 1234",
+            "END:VEVENT",
+        ]
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(lines) + "\r\n"
+
+
+def measure(fn, content):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = fn(content)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, len(result)
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 25_000]
+    print(f"{'events':>8} | {'parser':<22} | {'time (s)':>9} | {'peak MB':>8} | {'ranges':>7}")
+    for size in sizes:
+        content = synthetic_feed(size)
+        for name, fn in (("icalendar from_ical", parse_ics_icalendar), ("line scanner", avail_checker.parse_ics)):
+            elapsed, peak, count = measure(fn, content)
+            print(f"{size:>8} | {name:<22} | {elapsed:>9.3f} | {peak / 1e6:>8.1f} | {count:>7}")
+
+
+if __name__ == "__main__":
+    main()
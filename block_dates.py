@@ -3,13 +3,19 @@ import argparse
 import sys
 import os
 import datetime
+import gzip
+import hashlib
+import sqlite3
+import threading
+from contextlib import contextmanager
 from icalendar import Calendar, Event
 import uuid
 
 # --- Configuration ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, 'data')
-BLOCKS_DB = os.path.join(DATA_DIR, 'blocks.json')
+BLOCKS_DB = os.path.join(DATA_DIR, 'blocks.db')
+LEGACY_BLOCKS_JSON = os.path.join(DATA_DIR, 'blocks.json')
 PUBLIC_DIR = os.path.join(DATA_DIR, 'public')
 CONFIG_FILE = os.path.join(DATA_DIR, 'apartments.json')
 
@@ -21,21 +27,168 @@ def load_config():
         print(json.dumps({"error": f"Config file {CONFIG_FILE} not found"}))
         sys.exit(1)
 
+# --- Block Store (SQLite, WAL mode) ---
+
+_local = threading.local()
+
+# Bumped on every block write in this process (see avail_checker.data_version())
+_version = 0
+
+def version():
+    return _version
+
+def _bump_version():
+    global _version
+    _version += 1
+
+def _init_db(conn):
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS bloqueos (
+            uid TEXT PRIMARY KEY,
+            apt_id TEXT NOT NULL,
+            start TEXT NOT NULL,
+            "end" TEXT NOT NULL,
+            created_at TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_bloqueos_apt_start ON bloqueos(apt_id, start);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        """
+    )
+    _migrate_legacy_json(conn)
+
+def _migrate_legacy_json(conn):
+    """One-time import of the old blocks.json into the store."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_blocks_json'").fetchone():
+            conn.execute("COMMIT")
+            return
+        legacy = {}
+        if os.path.exists(LEGACY_BLOCKS_JSON):
+            try:
+                with open(LEGACY_BLOCKS_JSON, 'r', encoding='utf-8') as f:
+                    legacy = json.load(f)
+            except Exception:
+                legacy = {}
+        for apt_id, blocks in legacy.items():
+            for block in blocks:
+                conn.execute(
+                    'INSERT OR IGNORE INTO bloqueos (uid, apt_id, start, "end", created_at) VALUES (?, ?, ?, ?, ?)',
+                    (block.get('uid') or str(uuid.uuid4()), apt_id, block['start'], block['end'], block.get('created_at')),
+                )
+        conn.execute("INSERT INTO meta (key, value) VALUES ('migrated_blocks_json', ?)", (str(datetime.datetime.now()),))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def _connection():
+    """One connection per thread (sqlite3 connections are not shared across threads)."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        conn = sqlite3.connect(BLOCKS_DB, timeout=10, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        _init_db(conn)
+        _local.conn = conn
+    return conn
+
+@contextmanager
+def _transaction():
+    """Write transaction; BEGIN IMMEDIATE takes the database write lock up front."""
+    conn = _connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def _row_to_block(row):
+    return {"start": row["start"], "end": row["end"], "uid": row["uid"], "created_at": row["created_at"]}
+
+def _apt_blocks(conn, apt_id):
+    rows = conn.execute(
+        'SELECT uid, start, "end", created_at FROM bloqueos WHERE apt_id = ? ORDER BY start', (apt_id,)
+    ).fetchall()
+    return [_row_to_block(r) for r in rows]
+
 def load_blocks():
-    if not os.path.exists(BLOCKS_DB):
-        return {}
+    """All blocks grouped by apartment: {apt_id: [block, ...]}."""
+    blocks_db = {}
+    rows = _connection().execute('SELECT apt_id, uid, start, "end", created_at FROM bloqueos ORDER BY apt_id, start')
+    for row in rows:
+        blocks_db.setdefault(row["apt_id"], []).append(_row_to_block(row))
+    return blocks_db
+
+def find_blocks(apt_id, start_date, end_date):
+    """Blocks of an apartment overlapping [start_date, end_date) (indexed range lookup)."""
+    rows = _connection().execute(
+        'SELECT uid, start, "end", created_at FROM bloqueos WHERE apt_id = ? AND start < ? AND "end" > ? ORDER BY start',
+        (apt_id, end_date, start_date),
+    ).fetchall()
+    return [_row_to_block(r) for r in rows]
+
+# --- Public Feeds (precomputed bytes served by /public) ---
+
+# { filename: {"body": bytes, "gzip": bytes, "etag": str, "gzip_etag": str} }
+_public_feeds = {}
+
+def _feed_entry(body):
+    # The gzip body is a different representation, so it gets its own strong ETag
+    digest = hashlib.sha256(body).hexdigest()[:32]
+    return {"body": body, "gzip": gzip.compress(body, mtime=0), "etag": f'"{digest}"', "gzip_etag": f'"{digest}-gzip"'}
+
+def _block_dtstamp(block):
+    """Stable DTSTAMP: when the block was created, so OTAs don't re-import unchanged events."""
     try:
-        with open(BLOCKS_DB, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except:
-        return {}
+        return datetime.datetime.fromisoformat(block.get('created_at') or '')
+    except ValueError:
+        return datetime.datetime.combine(
+            datetime.datetime.strptime(block['start'], '%Y-%m-%d').date(), datetime.time()
+        )
+
+def publish_feed(filename, body):
+    """Keeps a feed's bytes, gzip variant and strong ETag in memory; writes the file only if it changed."""
+    etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+    current = _public_feeds.get(filename)
+    if current and current["etag"] == etag:
+        return os.path.join(PUBLIC_DIR, filename)
 
-def save_blocks(blocks):
-    with open(BLOCKS_DB, 'w', encoding='utf-8') as f:
-        json.dump(blocks, f, indent=2)
+    _public_feeds[filename] = _feed_entry(body)
+
+    # Ensure public dir exists
+    if not os.path.exists(PUBLIC_DIR):
+        os.makedirs(PUBLIC_DIR)
+    path = os.path.join(PUBLIC_DIR, filename)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(body)
+    os.replace(tmp_path, path)
+    return path
+
+def get_public_feed(filename):
+    """Precomputed feed for /public, loading it from disk after a restart. None if unknown."""
+    feed = _public_feeds.get(filename)
+    if feed:
+        return feed
+    if os.path.basename(filename) != filename or not filename.endswith('.ics'):
+        return None
+    path = os.path.join(PUBLIC_DIR, filename)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        body = f.read()
+    feed = _feed_entry(body)
+    _public_feeds[filename] = feed
+    return feed
 
 def generate_ics(apt_id, blocks_list, apt_name):
-    """Generates an ICS file for the given apartment blocks."""
+    """Generates the ICS feed for the given apartment blocks (stable UIDs and DTSTAMPs)."""
     cal = Calendar()
     cal.add('prodid', f'-//Parallext API//Amazon Minimalist//{apt_id}')
     cal.add('version', '2.0')
@@ -45,14 +198,9 @@ def generate_ics(apt_id, blocks_list, apt_name):
 
     for block in blocks_list:
         event = Event()
-        # Create a unique UID for the event if stored, otherwise generate one (stable if possible)
-        # Here we generate one on fly, but better reuse if we had ID. 
-        # For simplicity, we use startdate-apt as seed or just random.
-        # Since we regenerate the whole file, it's safer to have stable UIDs if we want updates to verify well,
-        # but for simple blocking, a fresh UID each gen is usually accepted by OTAs as "new event" replacing old if calendar is refreshed.
-        # Ideally, we should store a UID in blocks.json.
-        
-        uid = block.get('uid', str(uuid.uuid4()))
+        # UIDs are stored with each block, so the same block always exports
+        # the same event and OTAs update it instead of re-importing it
+        uid = block.get('uid') or f"{apt_id}-{block['start']}-{block['end']}"
         event.add('summary', 'Bloqueo Manual')
         
         # Parse dates
@@ -64,78 +212,76 @@ def generate_ics(apt_id, blocks_list, apt_name):
         
         event.add('dtstart', dt_start)
         event.add('dtend', dt_end) 
-        event.add('dtstamp', datetime.datetime.now())
+        event.add('dtstamp', _block_dtstamp(block))
         event.add('uid', uid)
         
         cal.add_component(event)
 
-    # Ensure public dir exists
-    if not os.path.exists(PUBLIC_DIR):
-        os.makedirs(PUBLIC_DIR)
-        
-    filename = os.path.join(PUBLIC_DIR, f'{apt_id}_blocks.ics')
-    
-    with open(filename, 'wb') as f:
-        f.write(cal.to_ical())
-        
-    return filename
+    return publish_feed(f'{apt_id}_blocks.ics', cal.to_ical())
 
 # --- Standalone Functions (importable from api.py) ---
 
-def add_block(apt_id, start_date, end_date):
-    """Add a manual block for an apartment. Returns result dict."""
+def add_block(apt_id, start_date, end_date, regenerate=True):
+    """
+    Add a manual block for an apartment. Returns result dict.
+    With regenerate=False the ICS is left for the caller to regenerate later.
+    """
     config = load_config()
     if apt_id not in config:
         return {"error": "Apartment ID not found in configuration"}
 
-    blocks_db = load_blocks()
-    if apt_id not in blocks_db:
-        blocks_db[apt_id] = []
-
     new_block = {
         "start": start_date,
         "end": end_date,
         "uid": str(uuid.uuid4()),
         "created_at": str(datetime.datetime.now())
     }
-    blocks_db[apt_id].append(new_block)
-    save_blocks(blocks_db)
+    # The ICS is regenerated inside the write transaction so concurrent
+    # changes cannot overwrite the file with an older block list
+    with _transaction() as conn:
+        conn.execute(
+            'INSERT INTO bloqueos (uid, apt_id, start, "end", created_at) VALUES (?, ?, ?, ?, ?)',
+            (new_block['uid'], apt_id, start_date, end_date, new_block['created_at']),
+        )
+        ics_path = generate_ics(apt_id, _apt_blocks(conn, apt_id), config[apt_id]['name']) if regenerate else None
+    _bump_version()
 
-    ics_path = generate_ics(apt_id, blocks_db[apt_id], config[apt_id]['name'])
     return {
         "status": "success",
-        "message": "Block added and ICS regenerated",
+        "message": "Block added and ICS regenerated" if regenerate else "Block added",
         "ics_file": ics_path,
         "uid": new_block['uid'],
         "block": new_block
     }
 
-def remove_block(apt_id, start_date):
-    """Remove a block by start date. Returns result dict."""
+def _remove_where(apt_id, clause, value, not_found_message):
     config = load_config()
     if apt_id not in config:
         return {"error": "Apartment ID not found in configuration"}
 
-    blocks_db = load_blocks()
-    if apt_id not in blocks_db:
-        return {"status": "no_change", "message": "No blocks found for this apartment"}
+    with _transaction() as conn:
+        if not conn.execute("SELECT 1 FROM bloqueos WHERE apt_id = ? LIMIT 1", (apt_id,)).fetchone():
+            return {"status": "no_change", "message": "No blocks found for this apartment"}
+        uids = [row["uid"] for row in conn.execute(f"SELECT uid FROM bloqueos WHERE apt_id = ? AND {clause} = ?", (apt_id, value))]
+        if not uids:
+            return {"status": "no_change", "message": not_found_message}
+        conn.execute(f"DELETE FROM bloqueos WHERE apt_id = ? AND {clause} = ?", (apt_id, value))
+        ics_path = generate_ics(apt_id, _apt_blocks(conn, apt_id), config[apt_id]['name'])
+    _bump_version()
 
-    current_blocks = blocks_db[apt_id]
-    initial_len = len(current_blocks)
-    current_blocks = [b for b in current_blocks if b['start'] != start_date]
+    return {"status": "success", "message": "Block removed and ICS regenerated", "ics_file": ics_path, "uids": uids}
 
-    if len(current_blocks) == initial_len:
-        return {"status": "no_change", "message": "No block found with that start date"}
+def remove_block(apt_id, start_date):
+    """Remove a block by start date. Returns result dict."""
+    return _remove_where(apt_id, "start", start_date, "No block found with that start date")
 
-    blocks_db[apt_id] = current_blocks
-    save_blocks(blocks_db)
-    ics_path = generate_ics(apt_id, current_blocks, config[apt_id]['name'])
-    return {"status": "success", "message": "Block removed and ICS regenerated", "ics_file": ics_path}
+def remove_block_by_uid(apt_id, uid):
+    """Remove a block by its UID. Returns result dict."""
+    return _remove_where(apt_id, "uid", uid, "No block found with that UID")
 
 def list_blocks(apt_id):
     """List all blocks for an apartment. Returns list."""
-    blocks_db = load_blocks()
-    return blocks_db.get(apt_id, [])
+    return _apt_blocks(_connection(), apt_id)
 
 def regenerate_ics_for_apt(apt_id):
     """Regenerate the ICS file for an apartment. Returns result dict."""
@@ -143,9 +289,8 @@ def regenerate_ics_for_apt(apt_id):
     if apt_id not in config:
         return {"error": "Apartment ID not found in configuration"}
 
-    blocks_db = load_blocks()
-    current_blocks = blocks_db.get(apt_id, [])
-    ics_path = generate_ics(apt_id, current_blocks, config[apt_id]['name'])
+    with _transaction() as conn:
+        ics_path = generate_ics(apt_id, _apt_blocks(conn, apt_id), config[apt_id]['name'])
     return {"status": "success", "message": "ICS regenerated", "ics_file": ics_path}
 
 
@@ -154,6 +299,7 @@ def main():
     parser.add_argument("--apt", required=True, help="Apartment ID")
     parser.add_argument("--start", help="Start date YYYY-MM-DD")
     parser.add_argument("--end", help="End date YYYY-MM-DD")
+    parser.add_argument("--uid", help="Block UID (alternative to --start for remove)")
     parser.add_argument("--action", choices=['add', 'remove', 'list', 'regenerate'], default='list', help="Action to perform")
 
     args = parser.parse_args()
@@ -166,10 +312,10 @@ def main():
         print(json.dumps(result, indent=2))
 
     elif args.action == 'remove':
-        if not args.start:
+        if not args.start and not args.uid:
             print(json.dumps({"error": "Start date required to identify block to remove"}))
             sys.exit(1)
-        result = remove_block(args.apt, args.start)
+        result = remove_block_by_uid(args.apt, args.uid) if args.uid else remove_block(args.apt, args.start)
         print(json.dumps(result, indent=2))
 
     elif args.action == 'list':
@@ -0,0 +1,226 @@
+"""
+Background calendar sync: keeps the occupancy model in avail_checker warm so
+availability requests never wait on Airbnb/Booking.com.
+Started from api.py's startup hook. A watcher re-reads apartments.json so
+apartments added or removed while running get their loop started or stopped.
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+
+import avail_checker
+import channel_feeds
+
+# --- Configuration ---
+SYNC_INTERVAL_SECONDS = int(os.environ.get("CALENDAR_SYNC_INTERVAL_SECONDS", 120))
+SYNC_JITTER_SECONDS = int(os.environ.get("CALENDAR_SYNC_JITTER_SECONDS", 15))
+SYNC_MAX_BACKOFF_SECONDS = int(os.environ.get("CALENDAR_SYNC_MAX_BACKOFF_SECONDS", 900))
+SYNC_STARTUP_TIMEOUT_SECONDS = float(os.environ.get("CALENDAR_SYNC_STARTUP_TIMEOUT_SECONDS", 15))
+
+# { apt_id: {"task": asyncio.Task, "wakeup": asyncio.Event, "failures": int, "last_run": ts, "next_run": ts} }
+_apartments = {}
+
+# async callable(apt_id) -> [(check_in, check_out), ...] of confirmed reservas, set by start()
+_reservations_loader = None
+
+# {"task": asyncio.Task, "wakeup": asyncio.Event} of the config watcher, set by start()
+_watcher = {}
+
+
+async def sync_apartment(apt_id, sources):
+    """Revalidates every source of an apartment and rebuilds its occupancy model. Returns True if all succeeded."""
+    results = await asyncio.gather(
+        *[avail_checker.feed_cache.get_ranges_async(url, force=True) for url in sources]
+    )
+    avail_checker.rebuild_occupancy(apt_id, sources)
+    return all(r is not None for r in results)
+
+
+def _next_delay(failures):
+    """Regular interval when healthy, exponential backoff while a source keeps failing, plus jitter."""
+    if failures:
+        delay = min(SYNC_INTERVAL_SECONDS * (2 ** failures), SYNC_MAX_BACKOFF_SECONDS)
+    else:
+        delay = SYNC_INTERVAL_SECONDS
+    return delay + random.uniform(0, SYNC_JITTER_SECONDS)
+
+
+def _reload_config(owner, last_config):
+    """
+    Re-reads apartments.json, keeping the last good config if it is missing or
+    unreadable (load_config() calls sys.exit, which would silently end the task).
+    """
+    try:
+        return avail_checker.load_config()
+    except (Exception, SystemExit) as e:
+        sys.stderr.write(f"Calendar sync for {owner}: could not reload config ({e!r}), using the last good one\n")
+        return last_config
+
+
+async def _after_sync(apt_id, config, ok):
+    """Publishes the apartment's channel feeds and saves the snapshot after a sync, then schedules the next one."""
+    state = _apartments[apt_id]
+    if channel_feeds.CHANNEL_FEEDS_ENABLED:
+        await publish_channel_feeds(apt_id, config)
+
+    try:
+        await asyncio.to_thread(avail_checker.save_snapshot)
+    except Exception as e:
+        sys.stderr.write(f"Could not write calendar snapshot: {e}\n")
+
+    state["failures"] = 0 if ok else state["failures"] + 1
+    state["last_run"] = time.time()
+    delay = _next_delay(state["failures"])
+    state["next_run"] = state["last_run"] + delay
+    return delay
+
+
+async def _apartment_loop(apt_id, config, initial_sync):
+    """
+    Per-apartment loop. Starts by waiting for the startup sync (already running)
+    instead of syncing again right away, then syncs every interval.
+    """
+    state = _apartments[apt_id]
+    try:
+        ok = await initial_sync
+    except Exception as e:
+        sys.stderr.write(f"Calendar sync failed for {apt_id}: {e}\n")
+        ok = False
+    delay = await _after_sync(apt_id, config, ok)
+
+    while True:
+        state["wakeup"].clear()
+        try:
+            await asyncio.wait_for(state["wakeup"].wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+        config = _reload_config(apt_id, config)
+        if apt_id not in config:
+            _remove_apartment(apt_id, state)
+            return
+
+        try:
+            ok = await sync_apartment(apt_id, config[apt_id].get("sources", []))
+        except Exception as e:
+            sys.stderr.write(f"Calendar sync failed for {apt_id}: {e}\n")
+            ok = False
+        delay = await _after_sync(apt_id, config, ok)
+
+
+async def publish_channel_feeds(apt_id, config):
+    """Rebuilds the merged outbound feeds of an apartment (see channel_feeds)."""
+    try:
+        reserved = await _reservations_loader(apt_id) if _reservations_loader else []
+        await asyncio.to_thread(channel_feeds.build_channel_feeds, apt_id, config, reserved)
+    except Exception as e:
+        sys.stderr.write(f"Could not publish channel feeds for {apt_id}: {e}\n")
+
+
+def _start_loop(apt_id, config, initial_sync):
+    _apartments[apt_id] = {"wakeup": asyncio.Event(), "failures": 0, "last_run": None, "next_run": None}
+    _apartments[apt_id]["task"] = asyncio.create_task(_apartment_loop(apt_id, config, initial_sync))
+
+
+def _remove_apartment(apt_id, state):
+    """Forgets an apartment that left apartments.json (unless a newer loop already replaced it)."""
+    if _apartments.get(apt_id) is state:
+        del _apartments[apt_id]
+        avail_checker.occupancy.pop(apt_id, None)
+
+
+def _reconcile(config):
+    """Starts loops for apartments new in `config` and cancels those of removed ones."""
+    for apt_id, apt in config.items():
+        if apt_id not in _apartments:
+            print(f"Calendar sync: new apartment {apt_id}, starting its sync loop.")
+            _start_loop(apt_id, config, asyncio.create_task(sync_apartment(apt_id, apt.get("sources", []))))
+    for apt_id, state in list(_apartments.items()):
+        if apt_id not in config:
+            print(f"Calendar sync: apartment {apt_id} removed, stopping its sync loop.")
+            state["task"].cancel()
+            _remove_apartment(apt_id, state)
+
+
+async def _config_watcher(config):
+    """Re-reads apartments.json every interval (or when woken by request_resync) and reconciles the loops."""
+    wakeup = _watcher["wakeup"]
+    while True:
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout=SYNC_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        wakeup.clear()
+        config = _reload_config("apartments.json", config)
+        _reconcile(config)
+
+
+async def start(reservations_loader=None):
+    """
+    Loads the on-disk snapshot so availability is answered immediately with
+    known-age data, runs a first sync for every apartment (bounded wait) and
+    starts the per-apartment loops and the config watcher.
+    """
+    global _reservations_loader
+    _reservations_loader = reservations_loader
+    config = avail_checker.load_config()
+    avail_checker.serve_from_model = True
+
+    loaded = avail_checker.load_snapshot()
+    if loaded:
+        for apt_id, apt in config.items():
+            avail_checker.rebuild_occupancy(apt_id, apt.get("sources", []))
+        print(f"Calendar sync: loaded {loaded} sources from snapshot.")
+
+    # Initial syncs are not cancelled on timeout: each apartment loop picks up its own
+    initial_syncs = {
+        apt_id: asyncio.create_task(sync_apartment(apt_id, apt.get("sources", [])))
+        for apt_id, apt in config.items()
+    }
+    if initial_syncs:
+        _, pending = await asyncio.wait(initial_syncs.values(), timeout=SYNC_STARTUP_TIMEOUT_SECONDS)
+        if pending:
+            print("Calendar sync: initial sync still running, serving failsafe until it completes.")
+
+    for apt_id in config:
+        _start_loop(apt_id, config, initial_syncs[apt_id])
+    _watcher["wakeup"] = asyncio.Event()
+    _watcher["task"] = asyncio.create_task(_config_watcher(config))
+    print(f"Calendar sync started for {len(config)} apartments (every {SYNC_INTERVAL_SECONDS}s).")
+
+
+async def stop():
+    if _watcher:
+        _watcher["task"].cancel()
+        _watcher.clear()
+    for state in list(_apartments.values()):
+        state["task"].cancel()
+    _apartments.clear()
+    avail_checker.serve_from_model = False
+
+
+def request_resync(apt_id):
+    """
+    Wakes the loop of an apartment so it syncs now (e.g. after its sources
+    changed). An apartment without a loop wakes the config watcher instead,
+    which starts one if it is now in apartments.json.
+    """
+    state = _apartments.get(apt_id)
+    if state:
+        state["wakeup"].set()
+    elif _watcher:
+        _watcher["wakeup"].set()
+
+
+def stats():
+    return {
+        apt_id: {
+            "failures": state["failures"],
+            "last_run": state["last_run"],
+            "next_run": state["next_run"],
+        }
+        for apt_id, state in _apartments.items()
+    }
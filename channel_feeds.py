@@ -0,0 +1,95 @@
+"""
+Unified outbound channel-manager feeds.
+
+For every apartment and every OTA it imports from, publishes
+/public/{apt_id}_channel_{channel}.ics combining the API blocks, confirmed
+`reservas` rows and every imported OTA feed except that channel's own
+(so Airbnb never re-imports its own bookings). {apt_id}_channel_all.ics
+contains everything, for channels that are not imported yet.
+Ranges are merged into minimal intervals, which also de-duplicates the same
+stay arriving from several sources. Built by calendar_sync after each sync.
+"""
+
+import os
+import datetime
+from urllib.parse import urlparse
+
+from icalendar import Calendar, Event
+
+import avail_checker
+import block_dates
+from occupancy import merge_ranges
+
+CHANNEL_FEEDS_ENABLED = os.environ.get("CHANNEL_FEEDS_ENABLED", "false").lower() in ("1", "true", "yes")
+
+
+def source_channel(url):
+    """Channel name of an iCal source: 'airbnb', 'booking' or its hostname."""
+    host = (urlparse(url).hostname or "").lower()
+    if "airbnb." in host:
+        return "airbnb"
+    if "booking.com" in host:
+        return "booking"
+    return host or "unknown"
+
+
+def render_intervals_ics(apt_id, apt_name, intervals, channel):
+    """ICS with one all-day event per merged interval; UIDs and DTSTAMPs derive from the dates so output is stable."""
+    cal = Calendar()
+    cal.add('prodid', f'-//Parallext API//Amazon Minimalist//{apt_id}')
+    cal.add('version', '2.0')
+    cal.add('calscale', 'GREGORIAN')
+    cal.add('method', 'PUBLISH')
+    cal.add('X-WR-CALNAME', f'Ocupacion - {apt_name} ({channel})')
+
+    for start, end in intervals:
+        event = Event()
+        event.add('summary', 'No disponible')
+        event.add('dtstart', start)
+        event.add('dtend', end)
+        event.add('dtstamp', datetime.datetime.combine(start, datetime.time()))
+        event.add('uid', f'{apt_id}-{start:%Y%m%d}-{end:%Y%m%d}@amazon-minimalist')
+        cal.add_component(event)
+
+    return cal.to_ical()
+
+
+def build_channel_feeds(apt_id, config, reserved_ranges=()):
+    """
+    Publishes the merged feeds of an apartment. A channel feed is only
+    refreshed when every OTA source it needs has data, so a missing calendar
+    never publishes dates as free. Returns the filenames published.
+    """
+    apt = config[apt_id]
+    sources = apt.get("sources", [])
+
+    ota_ranges = {}
+    for url in sources:
+        ranges, last_success = avail_checker.feed_cache.peek(url)
+        ota_ranges[url] = ranges if last_success else None
+
+    local_ranges = list(reserved_ranges)
+    for block in block_dates.list_blocks(apt_id):
+        local_ranges.append((
+            datetime.datetime.strptime(block['start'], '%Y-%m-%d').date(),
+            datetime.datetime.strptime(block['end'], '%Y-%m-%d').date(),
+        ))
+
+    today = datetime.date.today()
+    published = []
+    channels = sorted({source_channel(url) for url in sources}) + ["all"]
+    for channel in channels:
+        needed = [url for url in sources if source_channel(url) != channel]
+        if any(ota_ranges[url] is None for url in needed):
+            continue
+
+        ranges = list(local_ranges)
+        for url in needed:
+            ranges.extend(ota_ranges[url])
+        intervals = [(start, end) for start, end in merge_ranges(ranges) if end >= today]
+
+        filename = f"{apt_id}_channel_{channel}.ics"
+        block_dates.publish_feed(filename, render_intervals_ics(apt_id, apt["name"], intervals, channel))
+        published.append(filename)
+
+    return published
@@ -0,0 +1,178 @@
+"""
+Chatwoot HTTP client shared by the agent and the API.
+
+One long-lived pooled client per flavour (async for the event loop, sync for
+scripts) with HTTP/2 and keep-alive, so a conversation turn reuses the same
+connection for typing toggles, messages, labels and photo uploads instead of
+a new TCP + TLS handshake per call. Retries 429 and gateway errors with
+backoff (only 429/503 and connection failures for POSTs, see RETRY_STATUSES)
+and keeps per-operation timing counters (see stats()).
+"""
+
+import os
+import time
+import asyncio
+import logging
+
+import httpx
+
+logger = logging.getLogger("Chatwoot")
+
+# --- Configuration ---
+CHATWOOT_API_URL = os.environ.get("CHATWOOT_API_URL", "https://chatwoot.parallext.cloud")
+CHATWOOT_API_TOKEN = os.environ.get("CHATWOOT_API_TOKEN", "")
+CHATWOOT_USER_TOKEN = os.environ.get("CHATWOOT_USER_TOKEN", CHATWOOT_API_TOKEN)
+CHATWOOT_ACCOUNT_ID = os.environ.get("CHATWOOT_ACCOUNT_ID", "1")
+
+CHATWOOT_TIMEOUT_SECONDS = float(os.environ.get("CHATWOOT_TIMEOUT_SECONDS", 10))
+CHATWOOT_MAX_RETRIES = int(os.environ.get("CHATWOOT_MAX_RETRIES", 2))
+
+# Idempotent requests are retried on 429 and gateway errors. A 502/504 does not
+# mean Chatwoot did not process a POST (the message or upload may already be
+# stored), so non-idempotent requests are only retried when the request was
+# rejected before processing: 429, 503 or a failed connection.
+RETRY_STATUSES = {429, 502, 503, 504}
+NON_IDEMPOTENT_RETRY_STATUSES = {429, 503}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+RETRY_BASE_SECONDS = 0.5
+RETRY_MAX_SECONDS = 5.0
+
+_LIMITS = httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=120)
+
+_async_client = None
+_async_loop = None
+_sync_client = None
+
+# { op: {"calls", "errors", "retries", "total_ms", "max_ms"} }
+_metrics = {}
+
+
+def get_async_client():
+    """The pooled AsyncClient of the running loop (recreated if the loop changed, e.g. CLI runs)."""
+    global _async_client, _async_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_loop is not loop:
+        _async_client = httpx.AsyncClient(
+            base_url=CHATWOOT_API_URL, http2=True, timeout=CHATWOOT_TIMEOUT_SECONDS, limits=_LIMITS
+        )
+        _async_loop = loop
+    return _async_client
+
+
+def get_sync_client():
+    global _sync_client
+    if _sync_client is None:
+        _sync_client = httpx.Client(
+            base_url=CHATWOOT_API_URL, http2=True, timeout=CHATWOOT_TIMEOUT_SECONDS, limits=_LIMITS
+        )
+    return _sync_client
+
+
+async def close():
+    global _async_client, _async_loop, _sync_client
+    if _async_client is not None:
+        await _async_client.aclose()
+    if _sync_client is not None:
+        _sync_client.close()
+    _async_client = None
+    _async_loop = None
+    _sync_client = None
+
+
+def _record(op, started, ok, retries):
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    m = _metrics.setdefault(op, {"calls": 0, "errors": 0, "retries": 0, "total_ms": 0.0, "max_ms": 0.0})
+    m["calls"] += 1
+    m["retries"] += retries
+    m["total_ms"] += elapsed_ms
+    m["max_ms"] = max(m["max_ms"], elapsed_ms)
+    if not ok:
+        m["errors"] += 1
+
+
+def _retry_delay(attempt, resp=None):
+    if resp is not None and resp.headers.get("retry-after", "").isdigit():
+        return min(float(resp.headers["retry-after"]), RETRY_MAX_SECONDS)
+    return min(RETRY_BASE_SECONDS * (2 ** attempt), RETRY_MAX_SECONDS)
+
+
+def _retry_statuses(method):
+    return RETRY_STATUSES if method.upper() in IDEMPOTENT_METHODS else NON_IDEMPOTENT_RETRY_STATUSES
+
+
+def _headers(token, extra):
+    headers = {"api_access_token": token if token is not None else CHATWOOT_API_TOKEN}
+    if extra:
+        headers.update(extra)
+    return headers
+
+
+async def request(op, method, path, token=None, headers=None, **kwargs):
+    """
+    Sends a request to Chatwoot (`path` is relative to CHATWOOT_API_URL) and
+    returns the response. `op` names the call in stats(). Raises the last
+    transport error if every attempt fails.
+    """
+    client = get_async_client()
+    retry_statuses = _retry_statuses(method)
+    started = time.perf_counter()
+    attempt = 0
+    while True:
+        try:
+            resp = await client.request(method, path, headers=_headers(token, headers), **kwargs)
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+            if attempt >= CHATWOOT_MAX_RETRIES:
+                _record(op, started, False, attempt)
+                raise
+            logger.warning(f"Chatwoot {op} connection failed ({e}), retrying")
+            await asyncio.sleep(_retry_delay(attempt))
+        except Exception:
+            _record(op, started, False, attempt)
+            raise
+        else:
+            if resp.status_code not in retry_statuses or attempt >= CHATWOOT_MAX_RETRIES:
+                _record(op, started, resp.status_code < 400, attempt)
+                return resp
+            logger.warning(f"Chatwoot {op} answered {resp.status_code}, retrying")
+            await asyncio.sleep(_retry_delay(attempt, resp))
+        attempt += 1
+
+
+def request_sync(op, method, path, token=None, headers=None, **kwargs):
+    """Blocking variant of request() for scripts and worker threads."""
+    client = get_sync_client()
+    retry_statuses = _retry_statuses(method)
+    started = time.perf_counter()
+    attempt = 0
+    while True:
+        try:
+            resp = client.request(method, path, headers=_headers(token, headers), **kwargs)
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+            if attempt >= CHATWOOT_MAX_RETRIES:
+                _record(op, started, False, attempt)
+                raise
+            logger.warning(f"Chatwoot {op} connection failed ({e}), retrying")
+            time.sleep(_retry_delay(attempt))
+        except Exception:
+            _record(op, started, False, attempt)
+            raise
+        else:
+            if resp.status_code not in retry_statuses or attempt >= CHATWOOT_MAX_RETRIES:
+                _record(op, started, resp.status_code < 400, attempt)
+                return resp
+            logger.warning(f"Chatwoot {op} answered {resp.status_code}, retrying")
+            time.sleep(_retry_delay(attempt, resp))
+        attempt += 1
+
+
+def stats():
+    return {
+        op: {
+            "calls": m["calls"],
+            "errors": m["errors"],
+            "retries": m["retries"],
+            "avg_ms": round(m["total_ms"] / m["calls"], 1) if m["calls"] else 0.0,
+            "max_ms": round(m["max_ms"], 1),
+        }
+        for op, m in _metrics.items()
+    }
@@ -0,0 +1,240 @@
+"""
+Conversation state for the agent: an in-memory LRU tier (bounded by the
+serialized size of the messages) in front of a SQLite table in
+data/conversations.db, so active chats survive restarts. SQLite is only
+touched from worker threads, never on the event loop.
+
+Writes are write-behind: put() updates memory and marks the conversation
+dirty; a flusher task persists dirty conversations every
+CONVERSATION_FLUSH_SECONDS (0 = write-through). Conversations untouched for
+CONVERSATION_TTL_SECONDS expire in both tiers, as the old TTLCache did.
+lock() serializes the turns of one conversation so two debounced batches
+never interleave. Both the lock and the memory tier live in this process:
+run the API with a single uvicorn worker.
+"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger("ConversationStore")
+
+# --- Configuration ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BASE_DIR, "data")
+CONVERSATIONS_DB = os.path.join(DATA_DIR, "conversations.db")
+
+CONVERSATION_TTL_SECONDS = int(os.environ.get("CONVERSATION_TTL_SECONDS", 7200))
+CONVERSATION_CACHE_MAX_BYTES = int(os.environ.get("CONVERSATION_CACHE_MAX_MB", 32)) * 1024 * 1024
+CONVERSATION_FLUSH_SECONDS = float(os.environ.get("CONVERSATION_FLUSH_SECONDS", 2))
+
+# { conversation_id: {"messages": [...], "size": bytes, "updated_at": epoch} } in LRU order
+_memory = OrderedDict()
+_memory_bytes = 0
+
+# Not yet persisted: { conversation_id: (payload_json, updated_at) }; guarded by _dirty_lock
+# because flush() runs in a worker thread
+_dirty = {}
+_dirty_lock = threading.Lock()
+
+# { conversation_id: {"lock": asyncio.Lock, "users": holders + waiters} }; an entry
+# exists only while some turn of that conversation holds or waits for its lock
+_locks = {}
+
+_flusher = None
+_stats = {"hits": 0, "loads": 0, "misses": 0, "evictions": 0, "flushes": 0}
+
+_local = threading.local()
+
+
+# --- SQLite tier ---
+
+def _connection():
+    """One connection per thread (sqlite3 connections are not shared across threads)."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        conn = sqlite3.connect(CONVERSATIONS_DB, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS conversaciones_agente (
+                conversation_id INTEGER PRIMARY KEY,
+                messages TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        _local.conn = conn
+    return conn
+
+
+def _db_load(conversation_id):
+    row = _connection().execute(
+        "SELECT messages, updated_at FROM conversaciones_agente WHERE conversation_id = ?", (conversation_id,)
+    ).fetchone()
+    return (row[0], row[1]) if row else None
+
+
+def _db_write(items):
+    """Persists [(conversation_id, payload_json, updated_at)] in one transaction and drops expired rows."""
+    conn = _connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(
+            """
+            INSERT INTO conversaciones_agente (conversation_id, messages, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT (conversation_id) DO UPDATE SET messages = excluded.messages, updated_at = excluded.updated_at
+            WHERE excluded.updated_at >= conversaciones_agente.updated_at
+            """,
+            items,
+        )
+        conn.execute(
+            "DELETE FROM conversaciones_agente WHERE updated_at < ?", (time.time() - CONVERSATION_TTL_SECONDS,)
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+# --- Memory tier ---
+
+def _expired(updated_at):
+    return time.time() - updated_at > CONVERSATION_TTL_SECONDS
+
+
+def _remember(conversation_id, messages, size, updated_at):
+    global _memory_bytes
+    old = _memory.pop(conversation_id, None)
+    if old:
+        _memory_bytes -= old["size"]
+    _memory[conversation_id] = {"messages": messages, "size": size, "updated_at": updated_at}
+    _memory_bytes += size
+
+    # Evict least recently used conversations (dirty ones stay in _dirty until flushed)
+    while _memory_bytes > CONVERSATION_CACHE_MAX_BYTES and len(_memory) > 1:
+        evicted_id, evicted = _memory.popitem(last=False)
+        _memory_bytes -= evicted["size"]
+        _stats["evictions"] += 1
+
+
+def _forget(conversation_id):
+    global _memory_bytes
+    entry = _memory.pop(conversation_id, None)
+    if entry:
+        _memory_bytes -= entry["size"]
+
+
+@asynccontextmanager
+async def lock(conversation_id):
+    """
+    Per-conversation lock; hold it for the whole get → process → put turn.
+    Reference-counted: the lock is dropped when its last holder or waiter
+    leaves, so idle or expired conversations keep no lock around.
+    """
+    entry = _locks.get(conversation_id)
+    if entry is None:
+        entry = _locks[conversation_id] = {"lock": asyncio.Lock(), "users": 0}
+    entry["users"] += 1
+    try:
+        async with entry["lock"]:
+            yield
+    finally:
+        entry["users"] -= 1
+        if entry["users"] == 0 and _locks.get(conversation_id) is entry:
+            del _locks[conversation_id]
+
+
+async def get(conversation_id):
+    """
+    Messages of a live conversation, or None if it is unknown or expired.
+    The returned list may be mutated in place; call put() to save it.
+    """
+    entry = _memory.get(conversation_id)
+    if entry and not _expired(entry["updated_at"]):
+        _memory.move_to_end(conversation_id)
+        _stats["hits"] += 1
+        return entry["messages"]
+    _forget(conversation_id)
+
+    pending = _dirty.get(conversation_id)
+    stored = pending or await asyncio.to_thread(_db_load, conversation_id)
+    if not stored or _expired(stored[1]):
+        _stats["misses"] += 1
+        return None
+    payload, updated_at = stored
+    messages = json.loads(payload)
+    _remember(conversation_id, messages, len(payload), updated_at)
+    _stats["loads"] += 1
+    return messages
+
+
+async def put(conversation_id, messages):
+    """
+    Saves the conversation in memory and schedules it for persistence; writes
+    through (in a worker thread) when the flusher is not running.
+    """
+    payload = json.dumps(messages, ensure_ascii=False, default=str)
+    updated_at = time.time()
+    _remember(conversation_id, messages, len(payload), updated_at)
+    with _dirty_lock:
+        _dirty[conversation_id] = (payload, updated_at)
+    if _flusher is None or _flusher.done() or CONVERSATION_FLUSH_SECONDS <= 0:
+        try:
+            await asyncio.to_thread(flush)
+        except Exception as e:
+            logger.error(f"Conversation flush failed: {e}")
+
+
+def flush():
+    """Persists every dirty conversation now (blocking)."""
+    with _dirty_lock:
+        items = [(cid, payload, updated_at) for cid, (payload, updated_at) in _dirty.items()]
+    if not items:
+        return
+    _db_write(items)
+    with _dirty_lock:
+        for cid, _, updated_at in items:
+            current = _dirty.get(cid)
+            if current and current[1] == updated_at:
+                del _dirty[cid]
+    _stats["flushes"] += 1
+
+
+async def _flush_loop():
+    while True:
+        await asyncio.sleep(CONVERSATION_FLUSH_SECONDS)
+        try:
+            await asyncio.to_thread(flush)
+        except Exception as e:
+            logger.error(f"Conversation flush failed: {e}")
+
+
+async def start():
+    global _flusher
+    if CONVERSATION_FLUSH_SECONDS > 0 and (_flusher is None or _flusher.done()):
+        _flusher = asyncio.create_task(_flush_loop())
+
+
+async def stop():
+    global _flusher
+    if _flusher is not None:
+        _flusher.cancel()
+        try:
+            await _flusher
+        except asyncio.CancelledError:
+            pass
+    _flusher = None
+    await asyncio.to_thread(flush)
+
+
+def stats():
+    return dict(_stats, conversations=len(_memory), bytes=_memory_bytes, dirty=len(_dirty), locks=len(_locks))
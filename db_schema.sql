@@ -30,5 +30,42 @@ CREATE INDEX IF NOT EXISTS idx_conversaciones_telefono ON conversaciones(telefon
 CREATE INDEX IF NOT EXISTS idx_reservas_telefono ON reservas(fk_telefono);
 CREATE INDEX IF NOT EXISTS idx_reservas_fechas ON reservas(check_in, check_out);
 
+-- Estado de la reserva y bloqueo de calendario que la respalda (para liberarla al cancelar)
+ALTER TABLE reservas ADD COLUMN IF NOT EXISTS status VARCHAR(20) NOT NULL DEFAULT 'activa';
+ALTER TABLE reservas ADD COLUMN IF NOT EXISTS bloqueo_uid VARCHAR(64);
+CREATE INDEX IF NOT EXISTS idx_reservas_bloqueo_uid ON reservas(bloqueo_uid);
+
+-- Evita reservas activas solapadas del mismo apartamento aunque dos confirmaciones lleguen al mismo tiempo
+-- (rango [check_in, check_out): el día de salida puede ser el de entrada de la siguiente reserva).
+-- Las reservas canceladas no cuentan.
+CREATE EXTENSION IF NOT EXISTS btree_gist;
+DO $$
+BEGIN
+    -- Versión anterior de la restricción (sin filtro de estado)
+    IF EXISTS (
+        SELECT 1 FROM pg_constraint
+        WHERE conname = 'reservas_sin_solapamiento' AND pg_get_constraintdef(oid) NOT LIKE '%status%'
+    ) THEN
+        ALTER TABLE reservas DROP CONSTRAINT reservas_sin_solapamiento;
+    END IF;
+
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'reservas_sin_solapamiento') THEN
+        -- Solapamientos históricos: la reserva más antigua queda activa y las posteriores
+        -- se marcan 'solapada' para revisión manual, de lo contrario la restricción no se puede crear
+        UPDATE reservas r SET status = 'solapada'
+        WHERE r.status = 'activa' AND EXISTS (
+            SELECT 1 FROM reservas o
+            WHERE o.apartamento_id = r.apartamento_id
+              AND o.status = 'activa'
+              AND o.id < r.id
+              AND daterange(o.check_in, o.check_out, '[)') && daterange(r.check_in, r.check_out, '[)')
+        );
+
+        ALTER TABLE reservas ADD CONSTRAINT reservas_sin_solapamiento
+            EXCLUDE USING gist (apartamento_id WITH =, daterange(check_in, check_out, '[)') WITH &&)
+            WHERE (status = 'activa');
+    END IF;
+END $$;
+
 COMMENT ON TABLE conversaciones IS 'Tabla para que el Agente IA recuerde la última charla con el cliente';
 COMMENT ON TABLE reservas IS 'Historial de reservas confirmadas por el Agente IA';
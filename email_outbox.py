@@ -0,0 +1,206 @@
+"""
+Email outbox: messages are spooled as JSON files under data/outbox/ and
+delivered by a background worker that reuses one authenticated SMTP session,
+retrying with exponential backoff. Spooled messages survive restarts.
+Callers (api.py, agent.py) only pay for a small local file write.
+"""
+
+import os
+import json
+import time
+import uuid
+import logging
+import smtplib
+import threading
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+
+logger = logging.getLogger("Outbox")
+
+# --- Configuration ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+OUTBOX_DIR = os.path.join(BASE_DIR, "data", "outbox")
+FAILED_DIR = os.path.join(OUTBOX_DIR, "failed")
+
+SMTP_SERVER = os.environ.get("SMTP_SERVER", "smtp.gmail.com")
+SMTP_PORT = int(os.environ.get("SMTP_PORT", 587))
+SMTP_USER = os.environ.get("SMTP_USER", "")
+SMTP_PASSWORD = os.environ.get("SMTP_PASSWORD", "")
+
+MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 8))
+RETRY_BASE_SECONDS = int(os.environ.get("OUTBOX_RETRY_BASE_SECONDS", 30))
+RETRY_MAX_SECONDS = 3600
+# An idle SMTP session is closed after this many seconds without messages
+SESSION_IDLE_SECONDS = 60
+
+_wakeup = threading.Event()
+_stop = threading.Event()
+_worker = None
+_session = None
+_session_used_at = 0.0
+_stats = {"sent": 0, "retried": 0, "failed": 0}
+
+
+def is_configured():
+    return bool(SMTP_USER and SMTP_PASSWORD)
+
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def enqueue(to_addrs, subject, body, subtype="plain", display_to=None, bcc=None):
+    """
+    Spools a message for delivery. `to_addrs` are the SMTP envelope recipients;
+    `display_to` / `bcc` only set the headers. Returns False if SMTP is not configured.
+    """
+    if not is_configured():
+        logger.warning(f"Skipping email '{subject}': Missing SMTP credentials.")
+        return False
+
+    os.makedirs(OUTBOX_DIR, exist_ok=True)
+    message_id = f"{time.time():.6f}-{uuid.uuid4().hex[:8]}"
+    _write_atomic(os.path.join(OUTBOX_DIR, f"{message_id}.json"), {
+        "id": message_id,
+        "to_addrs": list(to_addrs),
+        "display_to": display_to or ", ".join(to_addrs),
+        "bcc": bcc,
+        "subject": subject,
+        "body": body,
+        "subtype": subtype,
+        "attempts": 0,
+        "next_attempt_at": 0,
+        "last_error": None,
+    })
+    _wakeup.set()
+    return True
+
+
+def _build_mime(message):
+    msg = MIMEMultipart()
+    msg['From'] = SMTP_USER
+    msg['To'] = message["display_to"]
+    if message.get("bcc"):
+        msg['Bcc'] = message["bcc"]
+    msg['Subject'] = message["subject"]
+    msg.attach(MIMEText(message["body"], message["subtype"]))
+    return msg
+
+
+def _close_session():
+    global _session
+    if _session is not None:
+        try:
+            _session.quit()
+        except Exception:
+            pass
+    _session = None
+
+
+def _get_session():
+    """Reuses the authenticated SMTP session while it is alive, reconnecting when needed."""
+    global _session, _session_used_at
+    if _session is not None:
+        try:
+            if _session.noop()[0] == 250:
+                _session_used_at = time.time()
+                return _session
+        except Exception:
+            pass
+        _close_session()
+
+    if SMTP_PORT == 465:
+        server = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, timeout=20)
+    else:
+        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=20)
+        server.starttls()
+    server.login(SMTP_USER, SMTP_PASSWORD)
+    _session = server
+    _session_used_at = time.time()
+    return _session
+
+
+def _pending_messages():
+    try:
+        names = sorted(n for n in os.listdir(OUTBOX_DIR) if n.endswith(".json"))
+    except FileNotFoundError:
+        return []
+    return [os.path.join(OUTBOX_DIR, n) for n in names]
+
+
+def drain():
+    """Delivers every due message once. Returns seconds until the next retry is due (or None)."""
+    next_due = None
+    for path in _pending_messages():
+        if _stop.is_set():
+            break
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                message = json.load(f)
+        except Exception as e:
+            logger.error(f"Unreadable outbox message {path}: {e}")
+            os.makedirs(FAILED_DIR, exist_ok=True)
+            os.replace(path, os.path.join(FAILED_DIR, os.path.basename(path)))
+            continue
+
+        wait = message["next_attempt_at"] - time.time()
+        if wait > 0:
+            next_due = wait if next_due is None else min(next_due, wait)
+            continue
+
+        try:
+            _get_session().send_message(_build_mime(message), to_addrs=message["to_addrs"])
+            os.remove(path)
+            _stats["sent"] += 1
+            logger.info(f"Email sent: {message['subject']} -> {message['display_to']}")
+        except Exception as e:
+            _close_session()
+            message["attempts"] += 1
+            message["last_error"] = str(e)
+            if message["attempts"] >= MAX_ATTEMPTS:
+                os.makedirs(FAILED_DIR, exist_ok=True)
+                _write_atomic(os.path.join(FAILED_DIR, os.path.basename(path)), message)
+                os.remove(path)
+                _stats["failed"] += 1
+                logger.error(f"Giving up on email '{message['subject']}' after {message['attempts']} attempts: {e}")
+            else:
+                delay = min(RETRY_BASE_SECONDS * (2 ** (message["attempts"] - 1)), RETRY_MAX_SECONDS)
+                message["next_attempt_at"] = time.time() + delay
+                _write_atomic(path, message)
+                _stats["retried"] += 1
+                next_due = delay if next_due is None else min(next_due, delay)
+                logger.warning(f"Email '{message['subject']}' failed (attempt {message['attempts']}), retrying in {delay}s: {e}")
+    return next_due
+
+
+def _run():
+    while not _stop.is_set():
+        next_due = drain()
+        timeout = SESSION_IDLE_SECONDS if next_due is None else min(next_due, SESSION_IDLE_SECONDS)
+        woke = _wakeup.wait(timeout=timeout)
+        _wakeup.clear()
+        if not woke and _session is not None and time.time() - _session_used_at >= SESSION_IDLE_SECONDS:
+            _close_session()
+    _close_session()
+
+
+def start():
+    """Starts the delivery worker (also delivers messages spooled before a restart)."""
+    global _worker
+    if _worker and _worker.is_alive():
+        return
+    _stop.clear()
+    _worker = threading.Thread(target=_run, name="email-outbox", daemon=True)
+    _worker.start()
+
+
+def stop():
+    _stop.set()
+    _wakeup.set()
+
+
+def stats():
+    return dict(_stats, pending=len(_pending_messages()))
@@ -0,0 +1,256 @@
+"""
+Photo derivatives for outgoing and served media.
+
+WhatsApp recompresses every image to roughly 1600 px anyway, so uploading the
+full-size originals only costs bytes and time. whatsapp_derivative() resizes
+and re-encodes a photo once, caches it under data/media_cache/ (keyed by the
+original's size and mtime) and keeps the bytes in memory for later sends.
+
+build_manifest() does the same for /media at startup: every photo listed in
+apartments_details.json gets thumb/medium/full variants in JPEG and WebP,
+held in memory with a content hash used as strong ETag and as the `v=`
+cache-busting parameter of the public URLs. Bytes live only in `_memory`;
+manifest entries point at them by key.
+Pillow is optional: without it the originals are used unchanged.
+"""
+
+import os
+import io
+import hashlib
+import logging
+import mimetypes
+import threading
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow not installed: derivatives are disabled
+    Image = None
+
+logger = logging.getLogger("Media")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MEDIA_DIR = os.path.join(BASE_DIR, "multimedia")
+CACHE_DIR = os.path.join(BASE_DIR, "data", "media_cache")
+
+# Map apt_id to folder names under multimedia/
+MEDIA_FOLDERS = {
+    "amazon_minimalist": "Amazon_minimalist",
+    "family_amazon_minimalist": "Family_Amazon_minimalist",
+}
+
+# Longest side in px per size variant; "full" keeps the original dimensions
+SIZES = {"thumb": 320, "medium": 960, "full": None}
+FORMATS = {"jpeg": ("jpg", "image/jpeg"), "webp": ("webp", "image/webp")}
+VARIANT_QUALITY = {"jpeg": 80, "webp": 78}
+
+WHATSAPP_MAX_SIDE = 1600
+WHATSAPP_JPEG_QUALITY = 80
+
+# { cache_path (or original path for untouched files): bytes }
+_memory = {}
+_lock = threading.Lock()
+
+
+def _cache_path(path, variant, ext):
+    st = os.stat(path)
+    key = hashlib.sha1(f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}".encode()).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(CACHE_DIR, variant, f"{stem}-{key}.{ext}")
+
+
+def _encode(path, max_side, fmt, quality):
+    with Image.open(path) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        if max_side:
+            img.thumbnail((max_side, max_side), Image.LANCZOS)
+        out = io.BytesIO()
+        if fmt == "webp":
+            img.save(out, "WEBP", quality=quality, method=4)
+        else:
+            img.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+        return out.getvalue()
+
+
+def _cached_encode(path, variant, ext, encoder):
+    """
+    (key, bytes) of a derivative from the memory or disk cache, encoding and
+    storing it on a miss. `key` is its entry in `_memory`.
+    """
+    cached = _cache_path(path, variant, ext)
+    with _lock:
+        body = _memory.get(cached)
+    if body is None:
+        if os.path.exists(cached):
+            with open(cached, "rb") as f:
+                body = f.read()
+        else:
+            body = encoder()
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            tmp_path = f"{cached}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(body)
+            os.replace(tmp_path, cached)
+        with _lock:
+            _memory[cached] = body
+    return cached, body
+
+
+def whatsapp_derivative(path):
+    """
+    Returns (filename, bytes, content_type) of the WhatsApp-sized JPEG of `path`,
+    building and caching it on first use. Falls back to the original file when
+    Pillow is missing, encoding fails or the derivative would not be smaller.
+    Blocking (disk + CPU): call it from a worker thread on the event loop.
+    """
+    filename = os.path.basename(path)
+    if Image is not None:
+        try:
+            _, body = _cached_encode(
+                path, "whatsapp", "jpg",
+                lambda: _encode(path, WHATSAPP_MAX_SIDE, "jpeg", WHATSAPP_JPEG_QUALITY),
+            )
+            if body and len(body) < os.path.getsize(path):
+                return os.path.splitext(filename)[0] + ".jpg", body, "image/jpeg"
+        except Exception as e:
+            logger.warning(f"Could not build WhatsApp derivative of {path}: {e}")
+
+    with open(path, "rb") as f:
+        return filename, f.read(), "image/jpeg"
+
+
+# --- /media manifest ---
+
+# { (apt_id, filename): {(size, fmt): {"key", "etag", "content_type"}} }, "key" indexing _memory
+_manifest = {}
+
+
+def _entry(key, body, content_type):
+    digest = hashlib.sha256(body).hexdigest()
+    return {"key": key, "etag": f'"{digest[:32]}"', "content_type": content_type}
+
+
+def _build_variants(path):
+    variants = {}
+    with open(path, "rb") as f:
+        original = f.read()
+    with _lock:
+        _memory[path] = original
+    content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    # "full" in the original format is always the untouched file
+    variants[("full", "jpeg" if content_type == "image/jpeg" else "original")] = _entry(path, original, content_type)
+    if Image is None:
+        return variants
+
+    for size, max_side in SIZES.items():
+        for fmt, (ext, fmt_type) in FORMATS.items():
+            if (size, fmt) in variants:
+                continue
+            try:
+                key, body = _cached_encode(
+                    path, f"{size}-{fmt}", ext,
+                    lambda: _encode(path, max_side, fmt, VARIANT_QUALITY[fmt]),
+                )
+            except Exception as e:
+                logger.warning(f"Could not build {size}/{fmt} variant of {path}: {e}")
+                continue
+            variants[(size, fmt)] = _entry(key, body, fmt_type)
+    return variants
+
+
+def build_manifest(details):
+    """
+    Builds (or rebuilds) the in-memory variants of every photo listed in
+    apartments_details.json. Blocking: run it in a worker thread.
+    Returns the number of photos indexed.
+    """
+    manifest = {}
+    for apt_id, folder in MEDIA_FOLDERS.items():
+        for filename in details.get(apt_id, {}).get("photos", []):
+            path = os.path.join(MEDIA_DIR, folder, filename)
+            if not os.path.exists(path):
+                continue
+            try:
+                manifest[(apt_id, filename)] = _build_variants(path)
+            except Exception as e:
+                logger.warning(f"Could not index {path}: {e}")
+    # Drop the bytes of variants the new manifest no longer references (edited or removed photos)
+    live = {e["key"] for v in manifest.values() for e in v.values()}
+    stale = {e["key"] for v in _manifest.values() for e in v.values()} - live
+    with _lock:
+        for key in stale:
+            _memory.pop(key, None)
+    _manifest.clear()
+    _manifest.update(manifest)
+    logger.info(f"Media manifest ready: {len(manifest)} photos")
+    return len(manifest)
+
+
+def media_path(apt_id, filename):
+    """Path of an original under multimedia/, or None for unknown apartments / unsafe names."""
+    folder = MEDIA_FOLDERS.get(apt_id)
+    if not folder or os.path.basename(filename) != filename:
+        return None
+    return os.path.join(MEDIA_DIR, folder, filename)
+
+
+def get_variant(apt_id, filename, size="full", fmt=None):
+    """
+    Precomputed variant of a photo, or None when it is not in the manifest
+    (videos, photos not listed in the details, or Pillow missing for resized sizes).
+    `fmt` None picks JPEG, falling back to the original's format.
+    """
+    variants = _manifest.get((apt_id, filename))
+    if not variants:
+        return None
+    if fmt:
+        entry = variants.get((size, fmt))
+    else:
+        entry = variants.get((size, "jpeg")) or variants.get((size, "original"))
+    if not entry:
+        return None
+    with _lock:
+        body = _memory.get(entry["key"])
+    return dict(entry, body=body) if body is not None else None
+
+
+def version(apt_id, filename):
+    """Short content hash of the full-size photo for cache-busting URLs, or None."""
+    entry = get_variant(apt_id, filename)
+    return entry["etag"].strip('"')[:12] if entry else None
+
+
+def manifest_stats():
+    return {
+        "photos": len(_manifest),
+        "variants": sum(len(v) for v in _manifest.values()),
+        "bytes": sum(len(_memory.get(e["key"], b"")) for v in _manifest.values() for e in v.values()),
+    }
+
+
+def byte_range(header, length):
+    """
+    (start, end) inclusive of a single-range `Range: bytes=...` header, or None
+    to send the whole body (absent, malformed or multi-range). Raises
+    ValueError when the range cannot be satisfied.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start_s, _, end_s = header[len("bytes="):].strip().partition("-")
+    try:
+        start = int(start_s) if start_s else None
+        end = int(end_s) if end_s else None
+    except ValueError:
+        return None
+    if start is None:
+        if end is None:
+            return None
+        if end <= 0:
+            raise ValueError("empty suffix range")
+        return max(0, length - end), length - 1
+    if end is None:
+        end = length - 1
+    if start >= length or end < start:
+        raise ValueError("range not satisfiable")
+    return start, min(end, length - 1)
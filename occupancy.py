@@ -0,0 +1,71 @@
+"""
+Compact occupancy index for an apartment: occupied [start, end) date ranges
+merged into a sorted interval array so overlap checks are O(log n) with bisect.
+Built once per calendar refresh (see avail_checker.rebuild_occupancy).
+"""
+
+from bisect import bisect_right
+
+
+def merge_ranges(ranges):
+    """Sorts [start, end) ranges and merges overlapping or touching ones."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+
+class OccupancyIndex:
+    """Merged, sorted occupied intervals with bisect lookups."""
+
+    def __init__(self, ranges=()):
+        merged = merge_ranges(ranges)
+        self.starts = [start for start, _ in merged]
+        self.ends = [end for _, end in merged]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def intervals(self):
+        return list(zip(self.starts, self.ends))
+
+    def _first_candidate(self, check_in):
+        # First merged interval that ends after check_in (ends are sorted too)
+        return bisect_right(self.ends, check_in)
+
+    def is_available(self, check_in, check_out):
+        """True if [check_in, check_out) does not overlap any occupied interval."""
+        i = self._first_candidate(check_in)
+        return i == len(self.starts) or self.starts[i] >= check_out
+
+    def conflicts(self, check_in, check_out):
+        """Merged occupied intervals overlapping [check_in, check_out)."""
+        found = []
+        i = self._first_candidate(check_in)
+        while i < len(self.starts) and self.starts[i] < check_out:
+            found.append((self.starts[i], self.ends[i]))
+            i += 1
+        return found
+
+    def batch_available(self, windows):
+        """Availability of many (check_in, check_out) windows, in order."""
+        return [self.is_available(check_in, check_out) for check_in, check_out in windows]
+
+    def free_gaps(self, start, end):
+        """Free [gap_start, gap_end) stretches inside [start, end), in date order."""
+        gaps = []
+        cursor = start
+        i = self._first_candidate(start)
+        while cursor < end:
+            if i == len(self.starts) or self.starts[i] >= end:
+                gaps.append((cursor, end))
+                break
+            if self.starts[i] > cursor:
+                gaps.append((cursor, self.starts[i]))
+            cursor = max(cursor, self.ends[i])
+            i += 1
+        return gaps
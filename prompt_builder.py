@@ -0,0 +1,86 @@
+"""
+Builds the static, cacheable prefix of every LLM request: the system prompt
+and the tool schema, minified once at import so each call resends as few
+tokens as possible and providers see a byte-identical prefix they can cache.
+
+Run it to compare raw vs minified sizes:
+    python prompt_builder.py [model]
+"""
+
+import re
+import sys
+import copy
+import json
+
+_HTML_COMMENT = re.compile(r"<!--.*?-->", re.DOTALL)
+_HORIZONTAL_RULE = re.compile(r"^\s*([-*_])(\s*\1){2,}\s*$")
+_INNER_SPACES = re.compile(r"(?<=\S)[ \t]{2,}")
+
+
+def minify_text(text):
+    """
+    Whitespace-only minification of Markdown instructions: drops HTML comments,
+    horizontal rules, blank lines and repeated inner spaces. Wording, emphasis
+    markers and list indentation are left untouched.
+    """
+    text = _HTML_COMMENT.sub("", text)
+    lines = []
+    for line in text.splitlines():
+        line = _INNER_SPACES.sub(" ", line.rstrip())
+        if not line.strip() or _HORIZONTAL_RULE.match(line):
+            continue
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def compact_tools(tools):
+    """Copy of an OpenAI-style tool list with every description minified to one line."""
+    def walk(node):
+        if isinstance(node, dict):
+            for key, value in list(node.items()):
+                if key == "description" and isinstance(value, str):
+                    node[key] = " ".join(value.split())
+                else:
+                    walk(value)
+        elif isinstance(node, list):
+            for item in node:
+                walk(item)
+
+    compacted = copy.deepcopy(tools)
+    walk(compacted)
+    return compacted
+
+
+def load_system_prompt(path, fallback, minify=True):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+    except FileNotFoundError:
+        text = fallback
+    return minify_text(text) if minify else text
+
+
+def count_tokens(model, text):
+    import litellm
+    return litellm.token_counter(model=model, text=text)
+
+
+def main():
+    import agent
+
+    model = sys.argv[1] if len(sys.argv) > 1 else agent.LLM_MODEL
+    raw_prompt = load_system_prompt(agent.SYSTEM_PROMPT_FILE, "", minify=False)
+    rows = [
+        ("system prompt", raw_prompt, minify_text(raw_prompt)),
+        ("tools", json.dumps(agent.RAW_LLM_TOOLS, ensure_ascii=False), json.dumps(compact_tools(agent.RAW_LLM_TOOLS), ensure_ascii=False)),
+    ]
+    print(f"{'part':<15}{'raw chars':>11}{'min chars':>11}{'raw tokens':>12}{'min tokens':>12}")
+    for name, raw, minified in rows:
+        print(
+            f"{name:<15}{len(raw):>11}{len(minified):>11}"
+            f"{count_tokens(model, raw):>12}{count_tokens(model, minified):>12}"
+        )
+
+
+if __name__ == "__main__":
+    main()
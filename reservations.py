@@ -0,0 +1,80 @@
+"""
+Reservation engine: atomic availability-check-and-block per apartment.
+
+The check (cached occupancy index + block store) and the block insert run in
+one critical section guarded by a per-apartment asyncio lock. No network I/O
+happens while the lock is held; slow side effects (email, ICS regeneration,
+channel feeds) are queued to run after it is released.
+"""
+
+import sys
+import asyncio
+
+import avail_checker
+import block_dates
+
+# { apt_id: asyncio.Lock }
+_locks = {}
+
+# Keeps references to queued side effects so they are not garbage collected mid-run
+_background_tasks = set()
+
+
+def apartment_lock(apt_id):
+    lock = _locks.get(apt_id)
+    if lock is None:
+        lock = _locks[apt_id] = asyncio.Lock()
+    return lock
+
+
+async def reserve(apt_id, check_in, check_out, config):
+    """
+    Atomically verifies [check_in, check_out) is free and blocks it.
+    Returns {"reserved": True, "block": {...}}, {"reserved": False, "reason": ...,
+    "conflicts": [...]} when the dates are taken, or {"reserved": False, "error": ...}.
+    """
+    async with apartment_lock(apt_id):
+        # Served from the occupancy model kept warm by calendar_sync (no network I/O)
+        availability = await avail_checker.check_apartment_availability_async(apt_id, check_in, check_out, config)
+        if "error" in availability:
+            return {"reserved": False, "error": availability["error"]}
+        if not availability.get("available", False):
+            return {"reserved": False, "reason": availability.get("reason", ""), "conflicts": availability.get("conflicts", [])}
+
+        # The block store is the source of truth for local blocks (e.g. added from the CLI)
+        overlapping = block_dates.find_blocks(apt_id, check_in, check_out)
+        if overlapping:
+            return {
+                "reserved": False,
+                "reason": "Conflict with existing manual block",
+                "conflicts": [f"{b['start']} to {b['end']}" for b in overlapping],
+            }
+
+        result = block_dates.add_block(apt_id, check_in, check_out, regenerate=False)
+        if "error" in result:
+            return {"reserved": False, "error": result["error"]}
+
+        avail_checker.refresh_local_blocks(apt_id, config)
+        return {"reserved": True, "block": result["block"]}
+
+
+async def release(apt_id, uid, config):
+    """Undoes a reservation's block (e.g. when the database rejects the booking)."""
+    async with apartment_lock(apt_id):
+        result = block_dates.remove_block_by_uid(apt_id, uid)
+        avail_checker.refresh_local_blocks(apt_id, config)
+        return result
+
+
+def queue_side_effect(func, *args):
+    """Runs a blocking side effect in a worker thread after the response path; errors are logged."""
+    async def runner():
+        try:
+            await asyncio.to_thread(func, *args)
+        except Exception as e:
+            sys.stderr.write(f"Reservation side effect {getattr(func, '__name__', func)} failed: {e}\n")
+
+    task = asyncio.create_task(runner())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
@@ -0,0 +1,344 @@
+"""
+In-process service layer shared by the FastAPI routes (api.py) and the agent
+tools (agent.py): bookings, contact history and Chatwoot labels.
+
+All services are coroutines bound to the API event loop (the asyncpg pool and
+HTTP clients live there); the agent awaits them directly instead of making an
+HTTP request back to our own server.
+"""
+
+import os
+import json
+import html
+import string
+import datetime
+
+import asyncpg
+from pydantic import BaseModel
+
+import avail_checker
+import block_dates
+import calendar_sync
+import chatwoot_client
+import reservations
+import email_outbox
+
+# --- Configuration ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BASE_DIR, "data")
+DETAILS_FILE = os.path.join(DATA_DIR, "apartments_details.json")
+TEMPLATES_DIR = os.path.join(BASE_DIR, "templates")
+
+# --- Database Config ---
+DB_USER = os.environ.get("DB_USER", "postgres")
+DB_PASSWORD = os.environ.get("DB_PASSWORD", "postgres")
+DB_HOST = os.environ.get("DB_HOST", "localhost")
+DB_PORT = os.environ.get("DB_PORT", "5432")
+DB_NAME = os.environ.get("DB_NAME", "postgres")
+
+# Global pool (created on the API loop at startup)
+db_pool = None
+
+HOST_EMAILS = ["nirlevin89@gmail.com", "sofia.henao96@gmail.com"]
+
+UNAVAILABLE_DETAIL = "Las fechas solicitadas ya no están disponibles. Conflicto con reservas existentes."
+
+
+class ServiceError(Exception):
+    """A service failure with the HTTP status the API should answer with."""
+
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class BookingRequest(BaseModel):
+    apt: str
+    guest_name: str
+    guest_phone: str = ""
+    guest_email: str = ""
+    check_in: str   # YYYY-MM-DD
+    check_out: str  # YYYY-MM-DD
+    num_guests: int
+    price_per_night: int
+    total_price: int
+    notes: str = ""
+
+
+async def open_db_pool():
+    global db_pool
+    try:
+        db_pool = await asyncpg.create_pool(
+            user=DB_USER, password=DB_PASSWORD, database=DB_NAME, host=DB_HOST, port=DB_PORT
+        )
+        print("Connected to PostgreSQL database.")
+    except Exception as e:
+        print(f"Warning: Could not connect to database at startup: {e}")
+
+
+async def close_db_pool():
+    global db_pool
+    if db_pool:
+        await db_pool.close()
+    db_pool = None
+
+
+def load_details():
+    """Load the full apartment details JSON."""
+    try:
+        with open(DETAILS_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+# --- Booking service ---
+
+# Compiled once at import; rendering is a plain substitution per booking
+with open(os.path.join(TEMPLATES_DIR, "booking_confirmation.html"), "r", encoding="utf-8") as _f:
+    CONFIRMATION_TEMPLATE = string.Template(_f.read())
+
+
+def send_confirmation_email(booking, apt_name, apt_address, base_url):
+    """Renders the V2 confirmation email and queues it for the guest and hosts (see email_outbox)."""
+    if not booking.guest_email:
+        print("Skipping email: Missing guest email.")
+        return False
+
+    host_wa_link = "https://wa.me/573208010737"
+
+    # Static URLs
+    base_url = "https://availability-api.parallext.cloud"
+    logo_url = f"{base_url}/multimedia/Logo.png"
+
+    apt_id = booking.apt
+    if apt_id == "amazon_minimalist":
+        cover_image = f"{base_url}/multimedia/Amazon_minimalist/Casa_frente.jpg"
+    else:
+        cover_image = f"{base_url}/multimedia/Family_Amazon_minimalist/Casa_frente.jpg"
+
+    html_body = CONFIRMATION_TEMPLATE.substitute(
+        logo_url=logo_url,
+        cover_image=cover_image,
+        guest_name=html.escape(booking.guest_name),
+        apt_name=html.escape(apt_name),
+        check_in=html.escape(booking.check_in),
+        check_out=html.escape(booking.check_out),
+        num_guests=booking.num_guests,
+        guest_phone=html.escape(booking.guest_phone),
+        notes=html.escape(booking.notes) if booking.notes else "Ninguna",
+        total_price=f"{booking.total_price:,.0f}",
+        host_wa_link=host_wa_link,
+    )
+
+    queued = email_outbox.enqueue(
+        [booking.guest_email] + HOST_EMAILS,
+        f"Tu Reserva Está Confirmada 🌿 - {apt_name}",
+        html_body,
+        subtype="html",
+        display_to=booking.guest_email,
+        bcc=", ".join(HOST_EMAILS),
+    )
+    if queued:
+        print(f"Elite confirmation email queued for {booking.guest_email} and hosts")
+    return queued
+
+
+async def create_booking(booking: BookingRequest, base_url: str = ""):
+    """
+    Confirms a booking: blocks the dates, records it in PostgreSQL and queues
+    the confirmation email. Raises ServiceError (404/400/409) when it cannot.
+    """
+    config = avail_checker.load_config()
+    details = load_details()
+
+    if booking.apt not in config:
+        raise ServiceError(404, f"Apartment '{booking.apt}' not found")
+
+    # Check availability and block the dates atomically (per-apartment lock,
+    # answered from the cached occupancy index, no network I/O while locked)
+    reservation = await reservations.reserve(booking.apt, booking.check_in, booking.check_out, config)
+    if "error" in reservation:
+        raise ServiceError(400, reservation["error"])
+    if not reservation["reserved"]:
+        raise ServiceError(409, UNAVAILABLE_DETAIL)
+
+    # Registrar reserva en PostgreSQL
+    db_success = False
+    if db_pool:
+        try:
+            async with db_pool.acquire() as conn:
+                # 1. Asegurar que el contacto existe
+                if booking.guest_phone:
+                    await conn.execute(
+                        """
+                        INSERT INTO conversaciones (telefono, nombre_contacto, es_nombre_valido)
+                        VALUES ($1, $2, TRUE)
+                        ON CONFLICT (telefono) DO UPDATE SET nombre_contacto = $2, es_nombre_valido = TRUE
+                        """,
+                        booking.guest_phone, booking.guest_name
+                    )
+
+                # 2. Insertar reserva (siempre, con o sin teléfono: la restricción
+                # reservas_sin_solapamiento solo protege las filas que existen)
+                d_in = datetime.datetime.strptime(booking.check_in, "%Y-%m-%d").date()
+                d_out = datetime.datetime.strptime(booking.check_out, "%Y-%m-%d").date()
+
+                await conn.execute(
+                    """
+                    INSERT INTO reservas (fk_telefono, apartamento_id, nombre_reserva, check_in, check_out, num_huespedes, precio_total, bloqueo_uid)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+                    """,
+                    booking.guest_phone or None, booking.apt, booking.guest_name, d_in, d_out, booking.num_guests,
+                    float(booking.total_price), reservation["block"]["uid"]
+                )
+                db_success = True
+        except asyncpg.exceptions.ExclusionViolationError:
+            # Another process booked overlapping dates (reservas_sin_solapamiento constraint)
+            await reservations.release(booking.apt, reservation["block"]["uid"], config)
+            raise ServiceError(409, UNAVAILABLE_DETAIL)
+        except Exception as e:
+            print(f"Error saving to database: {e}")
+
+    # Build booking confirmation data
+    apt_name = details.get(booking.apt, {}).get("name", booking.apt)
+    apt_address = details.get(booking.apt, {}).get("location", {}).get("address", "")
+
+    # Slow side effects run after the response: ICS regeneration, channel feeds
+    reservations.queue_side_effect(block_dates.regenerate_ics_for_apt, booking.apt)
+    calendar_sync.request_resync(booking.apt)
+    # Rendering + spooling to the email outbox is a local file write; delivery happens in its worker
+    email_queued = send_confirmation_email(booking, apt_name, apt_address, base_url)
+
+    return {
+        "status": "confirmed",
+        "booking": {
+            "apartment_name": apt_name,
+            "apartment_id": booking.apt,
+            "address": apt_address,
+            "guest_name": booking.guest_name,
+            "guest_phone": booking.guest_phone,
+            "guest_email": booking.guest_email,
+            "check_in": booking.check_in,
+            "check_out": booking.check_out,
+            "check_in_time": "3:00 PM",
+            "check_out_time": "11:00 AM",
+            "num_guests": booking.num_guests,
+            "price_per_night": booking.price_per_night,
+            "total_price": booking.total_price,
+            "currency": "COP",
+            "notes": booking.notes,
+            "db_saved": db_success,
+            # email_sent is kept for existing clients; delivery itself happens in the outbox worker
+            "email_sent": email_queued,
+            "email_queued": email_queued
+        },
+        "block_created": True,
+        "emails_to_notify": list(HOST_EMAILS),
+        "payment_methods": details.get(booking.apt, {}).get("payment_methods", {}),
+        "message": f"Reserva confirmada para {apt_name}. Fechas bloqueadas exitosamente. Correo de confirmación: {'en cola' if email_queued else 'No'}"
+    }
+
+
+async def deactivate_reservations(block_uids):
+    """
+    Marks the reservas rows of released blocks as cancelled so their dates
+    leave the reservas_sin_solapamiento constraint and can be booked again.
+    Returns the number of rows updated.
+    """
+    if not db_pool or not block_uids:
+        return 0
+    try:
+        async with db_pool.acquire() as conn:
+            result = await conn.execute(
+                "UPDATE reservas SET status = 'cancelada' WHERE bloqueo_uid = ANY($1::text[]) AND status = 'activa'",
+                list(block_uids)
+            )
+        return int(result.split()[-1])
+    except Exception as e:
+        print(f"Error deactivating reservas for blocks {block_uids}: {e}")
+        return 0
+
+
+# --- Contact service ---
+
+async def get_contact_history(phone: str):
+    """
+    Booking history and last conversation summary of a phone number.
+    Raises ServiceError(500) on database errors.
+    """
+    if not db_pool:
+        # En caso de no tener DB, retornar vacío temporalmente
+        return {"phone": phone, "history": [], "last_summary": ""}
+
+    # Remover el '+' posible para normalizar, aunque asuma formato uniforme
+    clean_phone = phone.replace(" ", "").strip()
+
+    history = []
+    summary = ""
+    es_nombre_valido = False
+    nombre_contacto = ""
+
+    try:
+        async with db_pool.acquire() as conn:
+            # Info del contacto
+            row_contact = await conn.fetchrow(
+                "SELECT nombre_contacto, ultimo_resumen, es_nombre_valido FROM conversaciones WHERE telefono = $1",
+                clean_phone
+            )
+            if row_contact:
+                nombre_contacto = row_contact["nombre_contacto"]
+                summary = row_contact["ultimo_resumen"] or ""
+                es_nombre_valido = row_contact["es_nombre_valido"]
+
+            # Reservas previas
+            rows_reservas = await conn.fetch(
+                """
+                SELECT apartamento_id, check_in, check_out, num_huespedes, precio_total, creado_en
+                FROM reservas
+                WHERE fk_telefono = $1 AND status = 'activa'
+                ORDER BY check_in DESC
+                """,
+                clean_phone
+            )
+            for r in rows_reservas:
+                history.append({
+                    "apartment_id": r["apartamento_id"],
+                    "check_in": r["check_in"].isoformat(),
+                    "check_out": r["check_out"].isoformat(),
+                    "num_guests": r["num_huespedes"],
+                    "total_price": float(r["precio_total"]),
+                    "booked_at": r["creado_en"].isoformat() if r["creado_en"] else None
+                })
+
+    except Exception as e:
+        raise ServiceError(500, f"Database error: {e}")
+
+    return {
+        "phone": clean_phone,
+        "name": nombre_contacto,
+        "valid_name": es_nombre_valido,
+        "last_summary": summary,
+        "past_bookings": history,
+        "has_history": len(history) > 0
+    }
+
+
+# --- Label service ---
+
+async def apply_labels(conversation_id: int, labels: list):
+    """Apply labels to a Chatwoot conversation via their API."""
+    if not chatwoot_client.CHATWOOT_USER_TOKEN:
+        print("Skipping label: No Chatwoot USER API token configured.")
+        return False
+    path_url = f"/api/v1/accounts/{chatwoot_client.CHATWOOT_ACCOUNT_ID}/conversations/{conversation_id}/labels"
+    try:
+        resp = await chatwoot_client.request(
+            "labels", "POST", path_url, token=chatwoot_client.CHATWOOT_USER_TOKEN, json={"labels": labels}
+        )
+        print(f"Chatwoot label response ({conversation_id}): {resp.status_code} - {labels}")
+        return resp.status_code == 200
+    except Exception as e:
+        print(f"Error applying Chatwoot label: {e}")
+        return False
@@ -17,10 +17,8 @@ if [ ! -f "$DATA_DIR/apartments_details.json" ]; then
     cp /app/defaults/apartments_details.json "$DATA_DIR/apartments_details.json"
 fi
 
-if [ ! -f "$DATA_DIR/blocks.json" ]; then
-    echo "First run: creating empty blocks.json..."
-    echo "{}" > "$DATA_DIR/blocks.json"
-fi
+# Manual blocks live in $DATA_DIR/blocks.db (SQLite, created on first use).
+# A legacy blocks.json found there is imported once automatically.
 
 # Always update apartments_details.json with latest version from image
 echo "Updating apartments_details.json..."
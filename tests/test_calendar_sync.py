@@ -0,0 +1,75 @@
+"""
+Tests for calendar_sync picking up apartments added or removed at runtime.
+
+Run from the repo root: python -m pytest tests
+"""
+
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import avail_checker
+import calendar_sync
+
+
+def apartment(name):
+    return {"name": name, "sources": [f"https://example.com/{name}.ics"]}
+
+
+def run_with_config(monkeypatch, scenario):
+    config = {"apt_a": apartment("A")}
+    synced = []
+
+    async def fake_sync(apt_id, sources):
+        synced.append(apt_id)
+        return True
+
+    async def no_publish(apt_id, config):
+        pass
+
+    monkeypatch.setattr(avail_checker, "load_config", lambda: dict(config))
+    monkeypatch.setattr(avail_checker, "load_snapshot", lambda: 0)
+    monkeypatch.setattr(avail_checker, "save_snapshot", lambda: None)
+    monkeypatch.setattr(calendar_sync, "sync_apartment", fake_sync)
+    monkeypatch.setattr(calendar_sync, "publish_channel_feeds", no_publish)
+
+    async def main():
+        await calendar_sync.start()
+        try:
+            await scenario(config, synced)
+        finally:
+            await calendar_sync.stop()
+
+    asyncio.run(main())
+
+
+def test_apartment_added_after_start_gets_a_loop(monkeypatch):
+    async def scenario(config, synced):
+        assert set(calendar_sync.stats()) == {"apt_a"}
+        config["apt_b"] = apartment("B")
+        calendar_sync.request_resync("apt_b")
+        for _ in range(50):
+            if "apt_b" in synced:
+                break
+            await asyncio.sleep(0.01)
+        assert set(calendar_sync.stats()) == {"apt_a", "apt_b"}
+        assert "apt_b" in synced
+
+    run_with_config(monkeypatch, scenario)
+
+
+def test_removed_apartment_loop_is_cancelled(monkeypatch):
+    async def scenario(config, synced):
+        task = calendar_sync._apartments["apt_a"]["task"]
+        del config["apt_a"]
+        calendar_sync.request_resync("apt_b")
+        for _ in range(50):
+            if task.done():
+                break
+            await asyncio.sleep(0.01)
+        assert task.cancelled()
+        assert calendar_sync.stats() == {}
+
+    run_with_config(monkeypatch, scenario)
@@ -0,0 +1,80 @@
+"""
+Regression tests for avail_checker.parse_ics on OTA-style feeds.
+
+Run from the repo root: python -m pytest tests
+"""
+
+import os
+import sys
+import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import avail_checker
+
+HORIZON = datetime.date(2027, 1, 1)
+
+
+def feed(*events):
+    body = "\r\n".join(f"BEGIN:VEVENT\r\n{event}\r\nEND:VEVENT" for event in events)
+    return f"BEGIN:VCALENDAR\r\nVERSION:2.0\r\n{body}\r\nEND:VCALENDAR\r\n"
+
+
+def test_rrule_with_utc_until_keeps_following_events():
+    ics = feed(
+        "UID:weekly\r\nDTSTART;VALUE=DATE:20270110\r\nDTEND;VALUE=DATE:20270111\r\n"
+        "RRULE:FREQ=WEEKLY;UNTIL=20270124T000000Z",
+        "UID:booking\r\nDTSTART;VALUE=DATE:20270401\r\nDTEND;VALUE=DATE:20270405",
+    )
+    ranges = avail_checker.parse_ics(ics, horizon=HORIZON)
+    assert ranges == [
+        (datetime.date(2027, 1, 10), datetime.date(2027, 1, 11)),
+        (datetime.date(2027, 1, 17), datetime.date(2027, 1, 18)),
+        (datetime.date(2027, 1, 24), datetime.date(2027, 1, 25)),
+        (datetime.date(2027, 4, 1), datetime.date(2027, 4, 5)),
+    ]
+
+
+def test_exdate_occurrences_are_free():
+    ics = feed(
+        "UID:weekly\r\nDTSTART;VALUE=DATE:20270110\r\nDTEND;VALUE=DATE:20270111\r\n"
+        "RRULE:FREQ=WEEKLY;COUNT=3\r\nEXDATE;VALUE=DATE:20270117",
+    )
+    ranges = avail_checker.parse_ics(ics, horizon=HORIZON)
+    assert ranges == [
+        (datetime.date(2027, 1, 10), datetime.date(2027, 1, 11)),
+        (datetime.date(2027, 1, 24), datetime.date(2027, 1, 25)),
+    ]
+
+
+def test_unparseable_event_fails_the_whole_feed():
+    ics = feed(
+        "UID:broken\r\nDTSTART;VALUE=DATE:2027XX10\r\nDTEND;VALUE=DATE:20270111",
+        "UID:booking\r\nDTSTART;VALUE=DATE:20270401\r\nDTEND;VALUE=DATE:20270405",
+    )
+    assert avail_checker.parse_ics(ics, horizon=HORIZON) is None
+
+
+def test_duration_without_dtend():
+    ics = feed(
+        "UID:allday\r\nDTSTART;VALUE=DATE:20270301\r\nDURATION:P3D",
+        "UID:timed\r\nDTSTART:20270310T150000Z\r\nDURATION:P2DT20H",
+    )
+    ranges = avail_checker.parse_ics(ics, horizon=HORIZON)
+    assert ranges == [
+        (datetime.date(2027, 3, 1), datetime.date(2027, 3, 4)),
+        (datetime.date(2027, 3, 10), datetime.date(2027, 3, 13)),
+    ]
+
+
+def test_timed_dtstart_stops_at_earlier_until_on_the_same_day():
+    ics = feed(
+        "UID:weekly\r\nDTSTART;TZID=America/Bogota:20270110T150000\r\n"
+        "DTEND;TZID=America/Bogota:20270111T110000\r\n"
+        "RRULE:FREQ=WEEKLY;UNTIL=20270124T100000Z",
+    )
+    ranges = avail_checker.parse_ics(ics, horizon=HORIZON)
+    assert ranges == [
+        (datetime.date(2027, 1, 10), datetime.date(2027, 1, 11)),
+        (datetime.date(2027, 1, 17), datetime.date(2027, 1, 18)),
+    ]